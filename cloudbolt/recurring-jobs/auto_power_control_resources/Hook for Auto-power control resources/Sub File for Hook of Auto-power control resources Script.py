@@ -2,23 +2,48 @@
 
 """
 The module for the 'Auto-power control resources' recurring job.
-The job is set by default to run hourly and looks at the power schedule for resources.
-It checks for any resources with a power schedule set for the current hour on the current day, and will
-power on or off all servers in that resource when scheduled.
+The job is set by default to run every hour on the hour and looks at the power schedule for resources.
+Each run is one tick of a PowerTimeWheel: it checks for any resources with a power schedule that has come due since the
+last run, and will power on or off all servers in that resource when scheduled. Schedules missed within the last
+CATCH_UP_MINUTES are caught up on, and when a resource comes due to power both off and on in the same run, only the
+latest power change is made. The last run is recorded in the database once its servers have been powered, so a run that
+fails part way is repeated on the next one. To spread the schedules over the first minutes of their hour, set
+SPREAD_MINUTES and run the job every minute.
 
-The servers get powered as a group, using the deploy sequence as the order in which they are powered on or off in.
-The deploy sequence is set on the server tiers in the blueprint that the resource was deployed from. The servers are
-powered on in the deploy sequence and powered off in the reverse of the deploy sequence.
+The servers get powered one server tier at a time, using the deploy sequence as the order in which they are powered on
+or off in. The deploy sequence is set on the server tiers in the blueprint that the resource was deployed from. The
+tiers are powered on in the deploy sequence and powered off in the reverse of the deploy sequence. All the servers in a
+tier are powered at the same time, and the next tier is only started once they have all finished, or TIER_TIMEOUT has
+passed since they started powering. Servers still powering at that point are not interrupted, and the job still waits
+for them to finish before it ends. They are reported as timed out rather than failed, and are not retried.
 
 This also tracks and logs the servers that fail to power on or off, but continues to power the other servers in a
 resource if any fail.
 
 This uses multi-threading for resources, such that each resource gets a new thread and runs in parallel with other
-resources, but the servers for each resource get powered in series.
+resources. The servers themselves are powered on a pool of workers per resource handler, sized by MAX_CONCURRENCY for
+the handler's technology. When a handler starts throttling requests, the number of servers allowed to power against it
+at once is halved, and it then grows back by one as servers are powered successfully (AIMD). Servers that fail to power
+for other reasons are counted separately and do not change the limit. The number of throttled and failed power
+operations, queue depth, latency and final limit for each handler are reported at the end of the job.
+
+To flatten the load on the resource handlers, the resources on each handler with more than WAVE_THRESHOLD of them are
+started at points spread evenly over WAVE_WINDOW_MINUTES, and the expected completion time for each handler is reported
+before they start. A resource's tiers are still powered in order from its start time.
+
+Resources with servers that fail to power are put on a retry queue in the database, and retried on later runs with
+exponential backoff, for up to RETRY_WINDOW seconds. The last known power state of each server is cached for
+POWER_STATE_CACHE_TIMEOUT seconds after it is powered, long enough to cover the retries, and servers already in the
+target state are skipped, so a retry only powers the servers that failed.
+
+The number of servers targeted, skipped, powered and failed, the latency of the power operations and the estimated
+hourly savings from the servers powered off are appended to METRICS_FILE for each resource handler after every run.
 """
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
+import json
+import time
 import pytz
 
 
@@ -32,30 +57,129 @@ if __name__ == "__main__":
 
     django.setup()
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
 from django.template.defaultfilters import pluralize
 
 from common.methods import set_progress
-from infrastructure.models import ScheduledTime
+from infrastructure.models import CustomField, ScheduledTime, Server
+from orders.models import CustomFieldValue
+from resources.models import Resource
 from utilities.logger import _get_thread_logger
+from utilities.models import GlobalPreferences
 
 parent_thread_logger = _get_thread_logger(__name__)
 
+# Schedules can be spread over the first SPREAD_MINUTES minutes of their hour, so
+# that they do not all fire at the top of the hour. This is off by default, as it
+# moves most schedules to a later minute than the one they were set for. To turn
+# it on, set it to e.g. 15 and schedule the recurring job to run every minute.
+SPREAD_MINUTES = 0
+
+# Number of minutes to look back for schedules that were missed because the job
+# ran late or did not run
+CATCH_UP_MINUTES = 60
+
+# Custom field holding the last minute slot this job has run the schedules up to,
+# as a UTC TICK_FORMAT string in the str_value of its only value
+LAST_TICK_FIELD = "auto_power_control_resources_last_tick"
+LAST_TICK_LABEL = "Auto-power control resources last tick"
+TICK_FORMAT = "%Y%m%d%H%M"
+
+# Number of seconds to wait for the servers in one tier to finish powering before
+# moving on to the next tier. This is counted from when each server's power
+# operation starts running, not from when it was queued. Operations still
+# running after it are not interrupted: the next tier is started without them,
+# but the job waits for them to finish before it ends.
+TIER_TIMEOUT = 30 * 60
+
+# Number of seconds between checks for timed out power operations in a tier
+TIER_POLL_SECONDS = 5
+
+# Custom field holding the queue of failed resource power operations to retry.
+# Each resource on the queue has its own value of it, with the resource ID in
+# str_value and its retry entry as JSON in txt_value.
+RETRY_QUEUE_FIELD = "auto_power_control_resources_retry_queue"
+RETRY_QUEUE_LABEL = "Auto-power control resources retry queue"
+
+# Seconds to wait before the first retry of a failed power operation. The wait
+# doubles with each attempt, and retries are given up once RETRY_MAX_ATTEMPTS is
+# reached or the next attempt would be more than RETRY_WINDOW seconds after the
+# first failure.
+RETRY_BASE_DELAY = 60
+RETRY_MAX_ATTEMPTS = 5
+RETRY_WINDOW = 60 * 60
+
+# File the metrics for each run are appended to, as one JSON object per line for
+# each resource handler and one for the totals
+METRICS_FILE = "/var/opt/cloudbolt/proserv/auto_power_metrics.jsonl"
+
+# Number of hours in each of the rate time units, used to convert server rates
+# to hourly rates
+HOURS_PER_RATE_TIME_UNIT = {
+    "HOUR": 1,
+    "DAY": 24,
+    "WEEK": 168,
+    "MONTH": 720,  # assumes 30-day month
+    "YEAR": 8760,  # assumes 365-day year
+}
+
+# Number of minutes to spread each resource handler's power operations over in a
+# run, when it has more than WAVE_THRESHOLD of them. The operations for handlers
+# with fewer are all started at once. Set this to 0 to always start them at once.
+WAVE_WINDOW_MINUTES = 10
+WAVE_THRESHOLD = 20
+
+# Rough number of seconds a single power operation takes, used to estimate when
+# a run will complete
+EXPECTED_OPERATION_SECONDS = 120
+
+# Cache key and timeout of the last known power state ("on" or "off") of a
+# server. This is shared with the Auto-power control servers job. The state is
+# kept for as long as a failed power operation can be retried for, plus the time
+# a run can take to power a server, so that it is still there for the retries.
+POWER_STATE_CACHE_KEY = "auto_power_control:power_state:{server_id}"
+POWER_STATE_CACHE_TIMEOUT = RETRY_WINDOW + WAVE_WINDOW_MINUTES * 60 + TIER_TIMEOUT
+
+# Maximum number of power operations to run at once against a single resource
+# handler, by resource technology name. Technologies not listed here use
+# DEFAULT_MAX_CONCURRENCY. Both can be overridden with the
+# AUTO_POWER_MAX_CONCURRENCY setting (see get_max_concurrency).
+MAX_CONCURRENCY = {
+    "Amazon Web Services": 20,
+    "Azure": 10,
+    "Google Cloud Platform": 10,
+    "VMware vCenter": 10,
+}
+DEFAULT_MAX_CONCURRENCY = 10
+
+# Substrings (lowercase) of error messages that indicate the provider is
+# throttling requests
+THROTTLING_ERROR_MARKERS = (
+    "throttl",
+    "rate exceeded",
+    "requestlimitexceeded",
+    "too many requests",
+    "toomanyrequests",
+)
+
 
 def run(job=None, logger=None, **kwargs):
     now = datetime.now()
+    tick = datetime.now(pytz.utc).replace(second=0, microsecond=0)
 
-    schedules = ScheduledTime.objects.all()
-    schedules_to_run = []
-    for schedule in schedules:
-        sched_tz = pytz.timezone(schedule.timezone)
-        localized_time = datetime.now().astimezone(sched_tz)
-        if (
-            localized_time.hour == schedule.hour
-            and localized_time.weekday() == schedule.day_of_week
-        ):
-            schedules_to_run.append(schedule)
-
-    if not schedules_to_run:
+    schedules_to_run = get_schedules_to_run(get_last_tick(), tick)
+    retry_queue = load_retry_queue()
+    retry_time = time.time()
+    due_retries = {
+        resource_id: entry
+        for resource_id, entry in retry_queue.items()
+        if entry["next_attempt"] <= retry_time
+    }
+
+    if not schedules_to_run and not due_retries:
+        set_last_tick(tick)
         status, errors = "SUCCESS", ""
         output = "No power schedules found at this time."
         return status, output, errors
@@ -67,117 +191,142 @@ def run(job=None, logger=None, **kwargs):
         )
     )
 
-    power_off_resources = []
-    power_on_resources = []
-
+    # The schedules are in the order they came due, so when a run catches up on
+    # an earlier slot and finds a resource scheduled to power both off and on,
+    # only the latest power change is kept
+    scheduled_power = {}
     for schedule in schedules_to_run:
 
         # get the queryset of ACTIVE servers that are scheduled to be powered off
         # Note: we specifically only want active servers here - we do not want to power off servers
         # that are currently provisioning, decommissioning, or being modified.
         off_resources = schedule.resources_to_power_off.filter(lifecycle="ACTIVE")
-        power_off_resources.extend(off_resources)
+        for resource in off_resources:
+            scheduled_power[resource.id] = (resource, "off")
 
         # get the ACTIVE servers that are scheduled to be powered on
         # Note: we specifically only want active servers here - we do not want to power on servers
         # that are currently provisioning, decommissioning, or being modified.
         on_resources = schedule.resources_to_power_on.filter(lifecycle="ACTIVE")
-        power_on_resources.extend(on_resources)
+        for resource in on_resources:
+            scheduled_power[resource.id] = (resource, "on")
 
-    # Run power off and power on tasks in parallel using ThreadPoolExecutor.
-    # Use a with statement to ensure threads are cleaned up.
-    with ThreadPoolExecutor(max_workers=100) as pool:
-        # Accessing the result of the future object generated by submit()
-        # causes the job to block until the power on/off task completes, so
-        # store all the future objects without looking at the results until all
-        # the tasks have been kicked off.
-        future_map = {}
-        total_attempts = 0
-        for resource in power_on_resources:
-            power_on_servers = resource.server_set.order_by("service_item__deploy_seq")
-            set_progress(
-                "Resource '{}' is set to power on {} server{}".format(
-                    resource,
-                    power_on_servers.count(),
-                    pluralize(power_on_servers.count()),
-                )
-            )
-            # check for any servers that are no longer associated with a service item, aka server tier.
-            # this is caused by a user deleting a server tier from the blueprint after the resource was deployed.
-            power_on_tierless_servers = resource.server_set.filter(service_item=None)
-            if power_on_tierless_servers:
-                power_on_tierless_servers_str = ", ".join(
-                    [svr.hostname for svr in power_on_tierless_servers]
-                )
-                set_progress(
-                    "Found {} server{} without a server tier: '{}' which will be powered on first.".format(
-                        power_on_tierless_servers.count(),
-                        pluralize(power_on_tierless_servers.count()),
-                        power_on_tierless_servers_str,
-                    )
-                )
-            total_attempts += power_on_servers.count()
-            power_on_servers_str = ", ".join([svr.hostname for svr in power_on_servers])
+    power_off_resources = [
+        resource for resource, on_off in scheduled_power.values() if on_off == "off"
+    ]
+    power_on_resources = [
+        resource for resource, on_off in scheduled_power.values() if on_off == "on"
+    ]
 
-            set_progress(
-                "Will power on a total of {} server{} in sequence: {}".format(
-                    power_on_servers.count(),
-                    pluralize(power_on_servers.count()),
-                    power_on_servers_str,
-                )
+    # A scheduled power change replaces any retry of the resource's last one
+    scheduled_ids = {
+        resource.id for resource in power_on_resources + power_off_resources
+    }
+    retry_ids = [
+        resource_id for resource_id in due_retries if resource_id not in scheduled_ids
+    ]
+    retry_resources = Resource.objects.filter(id__in=retry_ids, lifecycle="ACTIVE")
+    for resource in retry_resources:
+        if due_retries[resource.id]["on_off"] == "on":
+            power_on_resources.append(resource)
+        else:
+            power_off_resources.append(resource)
+        set_progress(
+            "Retrying power {} of resource '{}', attempt {} of {}.".format(
+                due_retries[resource.id]["on_off"],
+                resource,
+                due_retries[resource.id]["attempts"] + 1,
+                RETRY_MAX_ATTEMPTS + 1,
             )
+        )
+    retried_ids = {resource.id for resource in retry_resources}
+    for resource_id in due_retries:
+        if resource_id not in retried_ids:
+            retry_queue.pop(resource_id)
 
-            future = pool.submit(threaded_power_on, resource, job)
-            future_map[future] = ("on", resource)
+    servers_by_resource = get_servers_by_resource(
+        power_on_resources + power_off_resources
+    )
 
-        for resource in power_off_resources:
-            power_off_servers = resource.server_set.order_by(
-                "-service_item__deploy_seq"
-            )
-            set_progress(
-                "Resource '{}' is set to power off {} server{}".format(
-                    resource,
-                    power_off_servers.count(),
-                    pluralize(power_off_servers.count()),
+    # Run power off and power on tasks for the resources in parallel, with the
+    # servers powered on a pool of workers per resource handler. Use a with
+    # statement to ensure threads are cleaned up.
+    with HandlerPools() as pools, ThreadPoolExecutor(max_workers=100) as pool:
+        waves = WavePlanner()
+        total_attempts = 0
+        for on_off, resources in [
+            ("on", power_on_resources),
+            ("off", power_off_resources),
+        ]:
+            for resource in resources:
+                tiers = group_servers_by_tier(
+                    servers_by_resource.get(resource.id, []), on_off
                 )
-            )
-            # check for any servers that are no longer associated with a service item, aka server tier.
-            # this is caused by a user deleting a server tier from the blueprint after the resource was deployed.
-            power_off_tierless_servers = resource.server_set.filter(service_item=None)
-            if power_off_tierless_servers:
-                power_off_tierless_servers_str = ", ".join(
-                    [svr.hostname for svr in power_off_tierless_servers]
+                servers = [
+                    server for _, tier_servers in tiers for server in tier_servers
+                ]
+                set_progress(
+                    "Resource '{}' is set to power {} {} server{}".format(
+                        resource, on_off, len(servers), pluralize(len(servers))
+                    )
                 )
+                # check for any servers that are no longer associated with a service item, aka server tier.
+                # this is caused by a user deleting a server tier from the blueprint after the resource was deployed.
+                tierless_servers = [
+                    server for server in servers if server.service_item_id is None
+                ]
+                if tierless_servers:
+                    set_progress(
+                        "Found {} server{} without a server tier: '{}' which will be powered {}.".format(
+                            len(tierless_servers),
+                            pluralize(len(tierless_servers)),
+                            ", ".join([svr.hostname for svr in tierless_servers]),
+                            "on first" if on_off == "on" else "off last",
+                        )
+                    )
+                total_attempts += len(servers)
+
                 set_progress(
-                    "Found {} server{} without a server tier: '{}' which will be powered off last.".format(
-                        power_off_tierless_servers.count(),
-                        pluralize(power_off_tierless_servers.count()),
-                        power_off_tierless_servers_str,
+                    "Will power {} a total of {} server{} in sequence: {}".format(
+                        on_off,
+                        len(servers),
+                        pluralize(len(servers)),
+                        ", ".join([svr.hostname for svr in servers]),
                     )
                 )
-            total_attempts += power_off_servers.count()
-            power_off_servers_str = ", ".join(
-                [svr.hostname for svr in power_off_servers]
-            )
 
-            set_progress(
-                "Will power off a total of {} server{} in sequence: {}".format(
-                    power_off_servers.count(),
-                    pluralize(power_off_servers.count()),
-                    power_off_servers_str,
+                # Resources are planned by the handler of their first server, as
+                # they are normally deployed to a single resource handler
+                waves.add(
+                    servers[0].resource_handler if servers else None,
+                    (on_off, resource),
+                    threaded_power_resource,
+                    resource,
+                    tiers,
+                    on_off,
+                    pools,
+                    job,
+                    steps=len(tiers),
                 )
-            )
+        for message in waves.plan():
+            set_progress(message)
 
-            future = pool.submit(threaded_power_off, resource, job)
-            future_map[future] = ("off", resource)
+        # Accessing the result of the future object generated by submit()
+        # causes the job to block until the power on/off task completes, so
+        # store all the future objects without looking at the results until all
+        # the tasks have been kicked off.
+        future_map = waves.submit(lambda rh, func, *args: pool.submit(func, *args))
 
         total_server_failures = {"on": 0, "off": 0}
         total_server_successes = {"on": 0, "off": 0}
+        total_server_timeouts = {"on": 0, "off": 0}
+        failed_resource_ids = set()
+        outcomes = []
         # Use as_completed to process the result of each task as it completes
         for future in as_completed(future_map):
             on_off, resource = future_map[future]
             try:
-                successes, failures = future.result()
+                successes, failures, skipped, timed_out = future.result()
             except Exception as exc:
                 logger.info(
                     "Exception during power {} of resource {}: {}".format(
@@ -185,8 +334,23 @@ def run(job=None, logger=None, **kwargs):
                     ),
                     exc_info=True,
                 )
-                successes, failures = None, None
+                successes, failures, timed_out = None, None, None
+                failed_resource_ids.add(resource.id)
+                outcomes.extend(
+                    (server, on_off, "failed")
+                    for server in servers_by_resource.get(resource.id, [])
+                )
+            else:
+                for outcome, servers in [
+                    ("succeeded", successes),
+                    ("failed", failures),
+                    ("skipped", skipped),
+                    ("timed_out", timed_out),
+                ]:
+                    outcomes.extend((server, on_off, outcome) for server in servers)
+                successes = successes + skipped
             if failures:
+                failed_resource_ids.add(resource.id)
                 for server in failures:
                     set_progress(
                         "Failed to power {on_off} server '{server}' for resource '{resource}'.".format(
@@ -194,16 +358,56 @@ def run(job=None, logger=None, **kwargs):
                         )
                     )
                     total_server_failures[on_off] += 1
+            # The power operations of timed out servers are still running, so
+            # they are not retried
+            for server in timed_out or []:
+                set_progress(
+                    "Timed out waiting for server '{server}' to power {on_off} for resource '{resource}'.".format(
+                        on_off=on_off, server=server, resource=resource
+                    )
+                )
+                total_server_timeouts[on_off] += 1
             if successes:
                 total_server_successes[on_off] += len(successes)
 
-    if total_server_failures["on"] or total_server_failures["off"]:
+    # The servers for this run's schedules have now been powered
+    set_last_tick(tick)
+
+    for line in pools.report():
+        set_progress(line)
+
+    for on_off, resources in [
+        ("on", power_on_resources),
+        ("off", power_off_resources),
+    ]:
+        for resource in resources:
+            if resource.id not in failed_resource_ids:
+                retry_queue.pop(resource.id, None)
+            elif not schedule_retry(retry_queue, resource.id, on_off, retry_time):
+                set_progress(
+                    "Giving up on powering {} resource '{}'.".format(on_off, resource)
+                )
+    save_retry_queue(
+        retry_queue,
+        set(due_retries)
+        | {resource.id for resource in power_on_resources + power_off_resources},
+    )
+    write_run_metrics("Auto-power control resources", outcomes, pools)
+
+    timeouts = total_server_timeouts["on"] + total_server_timeouts["off"]
+    if total_server_failures["on"] or total_server_failures["off"] or timeouts:
         failures_msg = "Failed to power on {} and power off {} of {} server{}.".format(
             total_server_failures["on"],
             total_server_failures["off"],
             total_attempts,
             pluralize(total_attempts),
         )
+        if timeouts:
+            failures_msg += "\nTimed out waiting for {} server{} to power on and {} to power off.".format(
+                total_server_timeouts["on"],
+                pluralize(total_server_timeouts["on"]),
+                total_server_timeouts["off"],
+            )
         return ("WARNING", failures_msg, "")
 
     final_servers_powered_on = (
@@ -227,18 +431,714 @@ def run(job=None, logger=None, **kwargs):
     return status, output, errors
 
 
-def threaded_power_on(resource, job):
+def get_servers_by_resource(resources):
+    """
+    Fetch the servers for all the resources with one query, and return them as a
+    dict of resource ID -> servers.
+    """
+    servers_by_resource = {}
+    servers = (
+        Server.objects.filter(resource__in=resources)
+        .exclude(status="HISTORICAL")
+        .select_related("service_item", "resource_handler")
+        .order_by("id")
+    )
+    for server in servers:
+        servers_by_resource.setdefault(server.resource_id, []).append(server)
+    return servers_by_resource
+
+
+def group_servers_by_tier(servers, on_off):
+    """
+    Group the servers by the deploy sequence of their server tier. Returns a list
+    of (deploy_seq, servers) in the order the tiers should be powered: servers
+    without a tier first and then by deploy sequence for power on, and the reverse
+    for power off.
+    """
+    tiers = {}
+    for server in servers:
+        deploy_seq = server.service_item.deploy_seq if server.service_item else None
+        tiers.setdefault(deploy_seq, []).append(server)
+    order = sorted(tiers, key=lambda seq: (seq is not None, seq or 0))
+    if on_off == "off":
+        order.reverse()
+    return [(deploy_seq, tiers[deploy_seq]) for deploy_seq in order]
+
+
+def power_resource_servers(resource, tiers, on_off, pools):
+    """
+    Power on or off the servers in a resource one tier at a time, with tiers as
+    returned by group_servers_by_tier. The servers in a tier are submitted to
+    their resource handler's pool together, and the next tier is started once
+    they have all finished or TIER_TIMEOUT has passed. Returns the lists of
+    servers that were powered, that failed, that were skipped as they were
+    already in the target state, and that timed out.
+
+    TIER_TIMEOUT is counted from when each server's power operation starts
+    running. A running operation can't be interrupted, so one that times out
+    carries on in its handler's pool while the next tier is powered, and the
+    job still waits for it before it ends. Its server is returned as timed out
+    rather than failed, as it may yet be powered.
+    """
+    power_method = threaded_power_on if on_off == "on" else threaded_power_off
+    job = threading.current_thread().job
+    successes, failures, skipped, timed_out = [], [], [], []
+    for deploy_seq, tier_servers in tiers:
+        # Skip the servers already in the target state, such as the ones that
+        # were powered before a retry
+        power_states = cache.get_many(
+            [
+                POWER_STATE_CACHE_KEY.format(server_id=server.id)
+                for server in tier_servers
+            ]
+        )
+        cached_servers = [
+            server
+            for server in tier_servers
+            if power_states.get(POWER_STATE_CACHE_KEY.format(server_id=server.id))
+            == on_off
+        ]
+        skipped.extend(cached_servers)
+        future_map = {
+            pools.submit(server.resource_handler, power_method, server, job): server
+            for server in tier_servers
+            if server not in cached_servers
+        }
+        pending = set(future_map)
+        tier_timed_out = []
+        while pending:
+            done, pending = wait(pending, timeout=TIER_POLL_SECONDS)
+            for future in done:
+                server = future_map[future]
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    parent_thread_logger.info(
+                        "Exception during power {} of server {}: {}".format(
+                            on_off, server, exc
+                        ),
+                        exc_info=True,
+                    )
+                    result = False
+                if result:
+                    successes.append(server)
+                else:
+                    failures.append(server)
+            now = time.time()
+            expired = {
+                future
+                for future in pending
+                if now - future.dispatched.get("time", now) >= TIER_TIMEOUT
+            }
+            pending -= expired
+            tier_timed_out.extend(future_map[future] for future in expired)
+        if tier_timed_out:
+            set_progress(
+                "Timed out waiting for {} server{} in tier {} of resource '{}' to "
+                "power {}, moving on to the next tier. Their power operations are "
+                "still running, and the job waits for them before it ends.".format(
+                    len(tier_timed_out),
+                    pluralize(len(tier_timed_out)),
+                    deploy_seq,
+                    resource,
+                    on_off,
+                )
+            )
+            timed_out.extend(tier_timed_out)
+    return successes, failures, skipped, timed_out
+
+
+def threaded_power_resource(resource, tiers, on_off, pools, job):
+    thread = threading.current_thread()
+    thread.job = job
+    thread.logger = parent_thread_logger
+    return power_resource_servers(resource, tiers, on_off, pools)
+
+
+# Everything below this line is shared, byte for byte, by the Auto-power control
+# servers and Auto-power control resources jobs. Recurring job scripts run
+# standalone and can't import each other, so change both copies together.
+
+
+def get_schedules_to_run(last_tick, tick):
+    """
+    Return the ScheduledTimes due in the minute slots after last_tick, up to and
+    including tick, in the order they came due. Slots more than CATCH_UP_MINUTES
+    before tick are not caught up on.
+
+    Each run of the job is one tick of a PowerTimeWheel. The last tick is only
+    moved on once the run has powered its servers, so the schedules are run at
+    least once: a run that fails part way is repeated on the next tick, and the
+    servers it already powered are skipped as they are in the target state. With
+    no last tick, as on the first run after upgrading from the hourly version of
+    the job, the slots from the top of the current hour are run, so that the
+    schedules spread over the hour (see SPREAD_MINUTES) that came due before the
+    first run are not missed.
+    """
+    start = tick.replace(minute=0)
+    if last_tick:
+        start = max(
+            last_tick + timedelta(minutes=1),
+            tick - timedelta(minutes=CATCH_UP_MINUTES),
+        )
+    if start > tick:
+        return []
+    wheel = PowerTimeWheel.load(start, tick)
+    due_slots = sorted(wheel.due_slots(start, tick), key=lambda due: due[0])
+    return [schedule for _, schedule in due_slots]
+
+
+def get_last_tick():
+    """
+    Return the UTC minute slot the job last ran the schedules up to, or None if
+    it has not run yet. This is kept in the database rather than the cache, so it
+    does not depend on the cache being shared between the CloudBolt servers.
+    """
+    cfv = (
+        CustomFieldValue.objects.filter(field__name=LAST_TICK_FIELD)
+        .only("str_value")
+        .first()
+    )
+    if not (cfv and cfv.str_value):
+        return None
+    return pytz.utc.localize(datetime.strptime(cfv.str_value, TICK_FORMAT))
+
+
+def set_last_tick(tick):
+    cf, _ = CustomField.objects.get_or_create(
+        name=LAST_TICK_FIELD,
+        defaults={
+            "label": LAST_TICK_LABEL,
+            "type": "STR",
+            "description": "The last minute slot, in UTC, the job has run the "
+            "power schedules up to",
+        },
+    )
+    CustomFieldValue.objects.update_or_create(
+        field=cf, defaults={"str_value": tick.strftime(TICK_FORMAT)}
+    )
+
+
+def get_slot_minute(schedule):
+    """
+    Return the minute of the hour the schedule runs at. This is zero unless
+    SPREAD_MINUTES is set, in which case it is derived from the schedule's ID so
+    that it stays the same from one run to the next.
+    """
+    if SPREAD_MINUTES <= 1:
+        return 0
+    return schedule.id % SPREAD_MINUTES
+
+
+class PowerTimeWheel(object):
+    """
+    A hierarchical time wheel of ScheduledTimes with minute granularity. The
+    schedules are bucketed by timezone, and then by day of the week, hour and
+    minute in that timezone, so that hours with nothing scheduled can be skipped
+    without looking at each of their minutes.
+    """
+
+    def __init__(self, schedules):
+        self.wheel = {}
+        for schedule in schedules:
+            days = self.wheel.setdefault(schedule.timezone, {})
+            hours = days.setdefault(schedule.day_of_week, {})
+            minutes = hours.setdefault(schedule.hour, {})
+            minutes.setdefault(get_slot_minute(schedule), []).append(schedule)
+
+    @classmethod
+    def load(cls, start, end):
+        """
+        Load the schedules for the hours between the UTC datetimes start and end,
+        with a single query on (timezone, day_of_week, hour). Localizing the UTC
+        times with pytz takes care of DST for each timezone.
+        """
+        timezones = (
+            ScheduledTime.objects.order_by()
+            .values_list("timezone", flat=True)
+            .distinct()
+        )
+        query = Q()
+        for timezone in timezones:
+            tz = pytz.timezone(timezone)
+            hours = set()
+            utc_time = start
+            while utc_time < end + timedelta(hours=1):
+                localized_time = min(utc_time, end).astimezone(tz)
+                hours.add((localized_time.weekday(), localized_time.hour))
+                utc_time += timedelta(hours=1)
+            for day_of_week, hour in hours:
+                query |= Q(timezone=timezone, day_of_week=day_of_week, hour=hour)
+        if not query:
+            return cls([])
+        return cls(ScheduledTime.objects.filter(query))
+
+    def due_slots(self, start, end):
+        """
+        Yield (slot, schedule) for each schedule due in a minute slot between the
+        UTC datetimes start and end, inclusive. slot is the UTC start of the minute.
+        """
+        for timezone, days in self.wheel.items():
+            tz = pytz.timezone(timezone)
+            slot = start
+            while slot <= end:
+                localized_time = slot.astimezone(tz)
+                minutes = days.get(localized_time.weekday(), {}).get(
+                    localized_time.hour
+                )
+                if not minutes:
+                    # Nothing scheduled this hour, skip to the next one
+                    slot += timedelta(minutes=60 - localized_time.minute)
+                    continue
+                for schedule in minutes.get(localized_time.minute, []):
+                    yield slot, schedule
+                slot += timedelta(minutes=1)
+
+
+def schedule_retry(retry_queue, item_id, on_off, now):
+    """
+    Add or update the retry queue entry for a failed power operation, doubling
+    the wait before the next attempt each time. Returns False, and drops the
+    entry, if the operation has run out of retries.
+    """
+    entry = retry_queue.get(item_id)
+    if not entry or entry["on_off"] != on_off:
+        entry = {"on_off": on_off, "attempts": 0, "first_failure": now}
+    entry["attempts"] += 1
+    entry["next_attempt"] = now + RETRY_BASE_DELAY * 2 ** (entry["attempts"] - 1)
+    if (
+        entry["attempts"] > RETRY_MAX_ATTEMPTS
+        or entry["next_attempt"] > entry["first_failure"] + RETRY_WINDOW
+    ):
+        retry_queue.pop(item_id, None)
+        return False
+    retry_queue[item_id] = entry
+    return True
+
+
+def load_retry_queue():
+    """
+    Return the retry queue as a dict of item ID -> retry entry. The queue is kept
+    in the database, with a value of RETRY_QUEUE_FIELD for each item on it, so
+    that each item's entry is saved on its own rather than the whole queue being
+    read and written back as one value.
+    """
+    entries = CustomFieldValue.objects.filter(
+        field__name=RETRY_QUEUE_FIELD
+    ).values_list("str_value", "txt_value")
+    return {int(item_id): json.loads(entry) for item_id, entry in entries}
+
+
+def save_retry_queue(retry_queue, item_ids):
+    """
+    Save the retry queue entries of the items with the IDs given, and delete
+    those of the items no longer on the queue.
+    """
+    if not item_ids:
+        return
+    cf, _ = CustomField.objects.get_or_create(
+        name=RETRY_QUEUE_FIELD,
+        defaults={
+            "label": RETRY_QUEUE_LABEL,
+            "type": "CODE",
+            "description": "Failed power operations to retry, keyed by ID",
+        },
+    )
+    CustomFieldValue.objects.filter(
+        field=cf,
+        str_value__in=[
+            str(item_id) for item_id in item_ids if item_id not in retry_queue
+        ],
+    ).delete()
+    for item_id in item_ids:
+        if item_id in retry_queue:
+            CustomFieldValue.objects.update_or_create(
+                field=cf,
+                str_value=str(item_id),
+                defaults={"txt_value": json.dumps(retry_queue[item_id])},
+            )
+
+
+def cache_power_states(servers, on_off):
+    cache.set_many(
+        {
+            POWER_STATE_CACHE_KEY.format(server_id=server.id): on_off
+            for server in servers
+        },
+        timeout=POWER_STATE_CACHE_TIMEOUT,
+    )
+
+
+class WavePlanner(object):
+    """
+    Spreads the power operations for each resource handler with more than
+    threshold of them evenly over WAVE_WINDOW_MINUTES, rather than sending them
+    all at once. Each operation is given an equal share of its handler's window
+    and starts at the beginning of that share. An operation made up of several
+    sequential steps, such as the tiers of a resource, is planned as a single
+    unit so its order is kept.
+    """
+
+    def __init__(self, window=WAVE_WINDOW_MINUTES * 60, threshold=WAVE_THRESHOLD):
+        self.window = window
+        self.threshold = threshold
+        self.operations = {}
+        self.waves = []
+
+    def add(self, rh, context, func, *args, steps=1):
+        key = rh.id if rh else None
+        self.operations.setdefault(key, []).append((rh, steps, context, func, args))
+
+    def plan(self):
+        """
+        Plan the start time of each operation, and return a progress message for
+        each resource handler with its expected completion time.
+        """
+        now = datetime.now()
+        messages = []
+        self.waves = []
+        for operations in self.operations.values():
+            window = self.window if len(operations) > self.threshold else 0
+            share = float(window) / len(operations)
+            completion = 0
+            for i, (rh, steps, context, func, args) in enumerate(operations):
+                offset = i * share
+                self.waves.append((offset, rh, context, func, args))
+                completion = max(
+                    completion, offset + steps * EXPECTED_OPERATION_SECONDS
+                )
+            if window:
+                spread = "over {} minute{}".format(
+                    window // 60, pluralize(window // 60)
+                )
+            else:
+                spread = "at once"
+            messages.append(
+                "Will start {} power operation{} on handler '{}' {}, expected to "
+                "complete by {}.".format(
+                    len(operations),
+                    pluralize(len(operations)),
+                    operations[0][0],
+                    spread,
+                    (now + timedelta(seconds=completion)).strftime("%H:%M"),
+                )
+            )
+        self.waves.sort(key=lambda wave: wave[0])
+        return messages
+
+    def submit(self, submit):
+        """
+        Call submit(rh, func, *args) for each operation at its planned start
+        time, and return a dict of futures -> the operation's context. This does
+        not block: the operations planned for later are submitted from timers,
+        and their futures complete with the result of the future that submit
+        returns for them.
+        """
+        future_map = {}
+        for offset, rh, context, func, args in self.waves:
+            if offset <= 0:
+                future_map[submit(rh, func, *args)] = context
+                continue
+            future = Future()
+            timer = threading.Timer(
+                offset, self.submit_later, (future, submit, rh, func, args)
+            )
+            timer.daemon = True
+            timer.start()
+            future_map[future] = context
+        return future_map
+
+    @staticmethod
+    def submit_later(future, submit, rh, func, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            submitted = submit(rh, func, *args)
+        except Exception as exc:
+            future.set_exception(exc)
+            return
+
+        def copy_result(submitted):
+            exc = submitted.exception()
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(submitted.result())
+
+        submitted.add_done_callback(copy_result)
+
+
+def write_run_metrics(job_name, outcomes, pools):
+    """
+    Append the metrics for this run to METRICS_FILE, and report the estimated
+    hourly savings. outcomes is a list of (server, on_off, outcome) for each
+    server the run targeted, where outcome is "succeeded", "failed", "skipped"
+    or "timed_out". The savings are the hourly rates of the servers powered off.
+    """
+    hours = HOURS_PER_RATE_TIME_UNIT.get(GlobalPreferences.objects.get().rate_time_unit)
+    timestamp = datetime.now(pytz.utc).isoformat()
+    handler_names = {}
+    counts = {}
+    for server, on_off, outcome in outcomes:
+        handler_names[server.resource_handler_id] = str(server.resource_handler)
+        for key in [server.resource_handler_id, "total"]:
+            metrics = counts.setdefault(
+                key,
+                {
+                    "targeted": 0,
+                    "succeeded": 0,
+                    "failed": 0,
+                    "skipped": 0,
+                    "timed_out": 0,
+                    "hourly_savings": 0.0,
+                },
+            )
+            metrics["targeted"] += 1
+            metrics[outcome] += 1
+            if on_off == "off" and outcome == "succeeded" and hours and server.rate:
+                metrics["hourly_savings"] += float(server.rate) / hours
+
+    records = []
+    all_latencies = []
+    for key, metrics in counts.items():
+        if key == "total":
+            continue
+        limit = pools.limits.get(key)
+        latencies = limit.latencies if limit else []
+        all_latencies.extend(latencies)
+        records.append(
+            dict(
+                metrics,
+                handler=handler_names[key],
+                latency_p50=get_percentile(latencies, 0.5),
+                latency_p95=get_percentile(latencies, 0.95),
+            )
+        )
+    if "total" in counts:
+        records.append(
+            dict(
+                counts["total"],
+                handler="total",
+                latency_p50=get_percentile(all_latencies, 0.5),
+                latency_p95=get_percentile(all_latencies, 0.95),
+            )
+        )
+        set_progress(
+            "Estimated hourly savings from the servers powered off: {:.2f}".format(
+                counts["total"]["hourly_savings"]
+            )
+        )
+
+    try:
+        with open(METRICS_FILE, "a") as metrics_file:
+            for record in records:
+                record.update(timestamp=timestamp, job=job_name)
+                metrics_file.write(json.dumps(record, sort_keys=True) + "\n")
+    except (IOError, OSError) as exc:
+        parent_thread_logger.warning(
+            "Unable to write power metrics to {}: {}".format(METRICS_FILE, exc)
+        )
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int((len(values) - 1) * percentile)]
+
+
+def is_throttling_error(exc):
+    message = str(exc).lower()
+    return any(marker in message for marker in THROTTLING_ERROR_MARKERS)
+
+
+def get_max_concurrency(rh):
+    """
+    Return the maximum number of power operations to run at once against the
+    resource handler. The AUTO_POWER_MAX_CONCURRENCY setting, a dict of
+    technology name -> limit with the default limit under "default", overrides
+    MAX_CONCURRENCY and DEFAULT_MAX_CONCURRENCY.
+    """
+    limits = dict(MAX_CONCURRENCY, default=DEFAULT_MAX_CONCURRENCY)
+    limits.update(getattr(settings, "AUTO_POWER_MAX_CONCURRENCY", None) or {})
+    technology = getattr(rh.resource_technology, "name", None) if rh else None
+    return limits.get(technology, limits["default"])
+
+
+class AdaptiveLimit(object):
+    """
+    An AIMD concurrency limit for the power operations against one resource
+    handler. The limit is halved each time an operation is throttled, and
+    increased by one after a full limit's worth of operations succeed, up to
+    max_limit.
+
+    An operation is throttled if it raises a throttling error, or calls
+    throttle() on the limit of its thread (see get_current_limit). power_on
+    and power_off report failures by returning False without the reason, so
+    an operation returning False is counted as failed, but does not change the
+    limit.
+    """
+
+    def __init__(self, name, max_limit):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.successes = 0
+        self.throttled = 0
+        self.failed = 0
+        self.latencies = []
+        self.condition = threading.Condition()
+
+    def enqueue(self):
+        with self.condition:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.queued -= 1
+            self.active += 1
+
+    def release(self, latency, throttled, failed=False):
+        with self.condition:
+            self.active -= 1
+            self.latencies.append(latency)
+            if throttled:
+                self.throttle()
+            elif failed:
+                self.failed += 1
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.successes = 0
+                    self.limit += 1
+            self.condition.notify_all()
+
+    def throttle(self):
+        with self.condition:
+            self.throttled += 1
+            self.successes = 0
+            self.limit = max(1, self.limit // 2)
+
+    def run(self, func, *args, dispatched=None):
+        """
+        Run func(*args) once the limit allows it. The time it started running
+        is set under "time" in the dispatched dict, if one is passed.
+        """
+        self.acquire()
+        if dispatched is not None:
+            dispatched["time"] = time.time()
+        thread = threading.current_thread()
+        thread.power_limit = self
+        start = time.time()
+        throttled = failed = False
+        try:
+            result = func(*args)
+            failed = result is False
+            return result
+        except Exception as exc:
+            throttled = is_throttling_error(exc)
+            failed = not throttled
+            raise
+        finally:
+            thread.power_limit = None
+            self.release(time.time() - start, throttled, failed)
+
+    def report(self):
+        latencies = self.latencies
+        if not latencies:
+            return "Handler '{}': no power operations.".format(self.name)
+        p50 = get_percentile(latencies, 0.5)
+        p95 = get_percentile(latencies, 0.95)
+        return (
+            "Handler '{}': {} power operation{}, {} throttled, {} failed, peak "
+            "queue depth {}, latency p50 {:.1f}s p95 {:.1f}s, concurrency limit "
+            "{}/{}.".format(
+                self.name,
+                len(latencies),
+                pluralize(len(latencies)),
+                self.throttled,
+                self.failed,
+                self.max_queued,
+                p50,
+                p95,
+                self.limit,
+                self.max_limit,
+            )
+        )
+
+
+class HandlerPools(object):
+    """
+    Runs power operations on a thread pool per resource handler, each gated by
+    an AdaptiveLimit.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.pools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+
+    def submit(self, rh, func, *args):
+        key = rh.id if rh else None
+        if key not in self.limits:
+            max_limit = get_max_concurrency(rh)
+            self.limits[key] = AdaptiveLimit(str(rh), max_limit)
+            self.pools[key] = ThreadPoolExecutor(max_workers=max_limit)
+        limit = self.limits[key]
+        limit.enqueue()
+        dispatched = {}
+        future = self.pools[key].submit(limit.run, func, *args, dispatched=dispatched)
+        # Holds the time the operation started running, once it has
+        future.dispatched = dispatched
+        return future
+
+    def report(self):
+        return [limit.report() for limit in self.limits.values()]
+
+
+def get_current_limit():
+    """
+    Return the AdaptiveLimit of the power operation running on this thread, or
+    None
+    """
+    return getattr(threading.current_thread(), "power_limit", None)
+
+
+def power_server(server, on_off):
+    """
+    Power on or off a single server, caching its power state if it succeeds.
+    Returns True if it succeeded, and False otherwise.
+    """
+    result = server.power_on() if on_off == "on" else server.power_off()
+    if result:
+        cache_power_states([server], on_off)
+    return bool(result)
+
+
+def threaded_power_on(server, job):
     thread = threading.current_thread()
     thread.job = job
     thread.logger = parent_thread_logger
-    return resource.power_on_servers()
+    return power_server(server, "on")
 
 
-def threaded_power_off(resource, job):
+def threaded_power_off(server, job):
     thread = threading.current_thread()
     thread.job = job
     thread.logger = parent_thread_logger
-    return resource.power_off_servers()
+    return power_server(server, "off")
 
 
 if __name__ == "__main__":
@@ -15,15 +15,57 @@ CloudBolt will use its own server time to judge whether it is the right time to
 off VMs, so make sure you know what time it is on the CB server and that the timezone is right.
 
 Also note that the recurring job that runs this action is expected to be run
-every hour on the hour. If it is run on a different schedule, that will impact
-when servers are powered on or off. The power change will only happen if the job runs
-during the hour on the day when a power change is scheduled.
+every hour on the hour. Each run is one tick of a PowerTimeWheel: it powers the
+servers for the schedules that have come due since the last run, and catches up on
+those missed within the last CATCH_UP_MINUTES. When a server comes due to power
+both off and on in the same run, only the latest power change is made. The last
+run is recorded in the database once its servers have been powered, so a run that
+fails part way is repeated on the next one. To spread the schedules over the first
+minutes of their hour, set SPREAD_MINUTES and run the job every minute.
+
+AWS servers are powered in batches, grouped by resource handler and region, with
+a single StartInstances/StopInstances call per batch. The job then waits for the
+instances to reach the running or stopped state, and powers each server on or off
+through CloudBolt as the servers on other technologies are, so that its power
+status and history are recorded the same way. As the instance is already in the
+target state by then, this is a quick call that does not change it. Servers on
+other technologies are powered one at a time. Before powering, the current state of the
+AWS instances is fetched with one DescribeInstances call per handler and region,
+and servers that are already in the target state are skipped.
+
+Each resource handler gets its own pool of workers, sized by MAX_CONCURRENCY for
+its technology. When a handler starts throttling requests, the number of power
+operations allowed to run against it at once is halved, and it then grows back by
+one as operations succeed (AIMD). Servers that fail to power for other reasons
+are counted separately and do not change the limit. A throttled batch is retried
+with backoff, and then falls back to powering its servers one at a time. The
+number of throttled and failed operations, queue depth, latency and final limit
+for each handler are reported at the end of the job.
+
+To flatten the load on the resource handlers, the operations for each handler with
+more than WAVE_THRESHOLD of them are spread evenly over WAVE_WINDOW_MINUTES, and the
+expected completion time for each handler is reported before they start.
+
+Servers that fail to power are put on a retry queue in the database, and retried
+on later runs with exponential backoff, for up to RETRY_WINDOW seconds. The last
+known power state of each server is cached for POWER_STATE_CACHE_TIMEOUT seconds
+after it is powered or checked, long enough to cover the retries. Servers on other
+technologies already in the target state according to the cache are skipped. The
+cache is not used for the AWS servers, as their current state is checked anyway.
+
+The number of servers targeted, skipped, powered and failed, the latency of the
+power operations and the estimated hourly savings from the servers powered off are
+appended to METRICS_FILE for each resource handler after every run.
 """
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import json
+import time
 import pytz
 
+from botocore.exceptions import ClientError, WaiterError
+
 try:
     from eventlet.green import threading  # CB 7.7 and up
 except ImportError:
@@ -34,29 +76,140 @@ if __name__ == "__main__":
 
     django.setup()
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
 from django.template.defaultfilters import pluralize
 from common.methods import set_progress
-from infrastructure.models import ScheduledTime
+from infrastructure.models import CustomField, ScheduledTime, Server
+from orders.models import CustomFieldValue
+from resourcehandlers.aws.models import AWSHandler
 from utilities.logger import _get_thread_logger
+from utilities.models import GlobalPreferences
 
 parent_thread_logger = _get_thread_logger(__name__)
 
+# Schedules can be spread over the first SPREAD_MINUTES minutes of their hour, so
+# that they do not all fire at the top of the hour. This is off by default, as it
+# moves most schedules to a later minute than the one they were set for. To turn
+# it on, set it to e.g. 15 and schedule the recurring job to run every minute.
+SPREAD_MINUTES = 0
+
+# Number of minutes to look back for schedules that were missed because the job
+# ran late or did not run
+CATCH_UP_MINUTES = 60
+
+# Custom field holding the last minute slot this job has run the schedules up to,
+# as a UTC TICK_FORMAT string in the str_value of its only value
+LAST_TICK_FIELD = "auto_power_control_servers_last_tick"
+LAST_TICK_LABEL = "Auto-power control servers last tick"
+TICK_FORMAT = "%Y%m%d%H%M"
+
+# Custom field holding the queue of failed power operations to retry. Each server
+# on the queue has its own value of it, with the server ID in str_value and its
+# retry entry as JSON in txt_value.
+RETRY_QUEUE_FIELD = "auto_power_control_servers_retry_queue"
+RETRY_QUEUE_LABEL = "Auto-power control servers retry queue"
+
+# Seconds to wait before the first retry of a failed power operation. The wait
+# doubles with each attempt, and retries are given up once RETRY_MAX_ATTEMPTS is
+# reached or the next attempt would be more than RETRY_WINDOW seconds after the
+# first failure.
+RETRY_BASE_DELAY = 60
+RETRY_MAX_ATTEMPTS = 5
+RETRY_WINDOW = 60 * 60
+
+# File the metrics for each run are appended to, as one JSON object per line for
+# each resource handler and one for the totals
+METRICS_FILE = "/var/opt/cloudbolt/proserv/auto_power_metrics.jsonl"
+
+# Number of hours in each of the rate time units, used to convert server rates
+# to hourly rates
+HOURS_PER_RATE_TIME_UNIT = {
+    "HOUR": 1,
+    "DAY": 24,
+    "WEEK": 168,
+    "MONTH": 720,  # assumes 30-day month
+    "YEAR": 8760,  # assumes 365-day year
+}
+
+# Number of minutes to spread each resource handler's power operations over in a
+# run, when it has more than WAVE_THRESHOLD of them. The operations for handlers
+# with fewer are all started at once. Set this to 0 to always start them at once.
+WAVE_WINDOW_MINUTES = 10
+WAVE_THRESHOLD = 20
+
+# Rough number of seconds a single power operation takes, used to estimate when
+# a run will complete
+EXPECTED_OPERATION_SECONDS = 120
+
+# Maximum number of instances to pass in a single StartInstances/StopInstances
+# call
+BATCH_SIZE = 50
+
+# Maximum number of instance IDs in a DescribeInstances instance-id filter
+DESCRIBE_BATCH_SIZE = 200
+
+# EC2 instance states that already satisfy a power on or off
+EC2_TARGET_STATES = {"on": ("pending", "running"), "off": ("stopping", "stopped")}
+
+# EC2 instance state a batch power on or off waits for, with the EC2 waiter used,
+# and the number of seconds to wait for it
+EC2_FINAL_STATES = {"on": "running", "off": "stopped"}
+EC2_WAITERS = {"on": "instance_running", "off": "instance_stopped"}
+BATCH_WAIT_TIMEOUT = 10 * 60
+
+# Number of times a throttled StartInstances/StopInstances call is retried, and
+# the seconds to wait before the first retry (doubled for each one), before
+# falling back to powering the servers one at a time
+BATCH_THROTTLE_RETRIES = 3
+BATCH_THROTTLE_DELAY = 5
+
+# Cache key and timeout of the last known power state ("on" or "off") of a
+# server. This is shared with the Auto-power control resources job. The state is
+# kept for as long as a failed power operation can be retried for, plus the time
+# a run can take to power a server, so that it is still there for the retries.
+POWER_STATE_CACHE_KEY = "auto_power_control:power_state:{server_id}"
+POWER_STATE_CACHE_TIMEOUT = RETRY_WINDOW + WAVE_WINDOW_MINUTES * 60 + BATCH_WAIT_TIMEOUT
+
+# Maximum number of power operations to run at once against a single resource
+# handler, by resource technology name. Technologies not listed here use
+# DEFAULT_MAX_CONCURRENCY. Both can be overridden with the
+# AUTO_POWER_MAX_CONCURRENCY setting (see get_max_concurrency).
+MAX_CONCURRENCY = {
+    "Amazon Web Services": 20,
+    "Azure": 10,
+    "Google Cloud Platform": 10,
+    "VMware vCenter": 10,
+}
+DEFAULT_MAX_CONCURRENCY = 10
+
+# Substrings (lowercase) of error messages that indicate the provider is
+# throttling requests
+THROTTLING_ERROR_MARKERS = (
+    "throttl",
+    "rate exceeded",
+    "requestlimitexceeded",
+    "too many requests",
+    "toomanyrequests",
+)
+
 
 def run(job=None, logger=None, **kwargs):
     now = datetime.now()
+    tick = datetime.now(pytz.utc).replace(second=0, microsecond=0)
 
-    schedules = ScheduledTime.objects.all()
-    schedules_to_run = []
-    for schedule in schedules:
-        sched_tz = pytz.timezone(schedule.timezone)
-        localized_time = datetime.now().astimezone(sched_tz)
-        if (
-            localized_time.hour == schedule.hour
-            and localized_time.weekday() == schedule.day_of_week
-        ):
-            schedules_to_run.append(schedule)
+    schedules_to_run = get_schedules_to_run(get_last_tick(), tick)
+    retry_queue = load_retry_queue()
+    retry_time = time.time()
+    due_retries = {
+        server_id: entry
+        for server_id, entry in retry_queue.items()
+        if entry["next_attempt"] <= retry_time
+    }
 
-    if not schedules_to_run:
+    if not schedules_to_run and not due_retries:
+        set_last_tick(tick)
         status, errors = "SUCCESS", ""
         output = "No power schedules found at this time."
         return status, output, errors
@@ -66,22 +219,86 @@ def run(job=None, logger=None, **kwargs):
         "be powered on or off at this time.".format(now.hour, now.strftime("%A"))
     )
 
-    power_off_servers = []
-    power_on_servers = []
-
+    # The schedules are in the order they came due, so when a run catches up on
+    # an earlier slot and finds a server scheduled to power both off and on, only
+    # the latest power change is kept
+    scheduled_power = {}
     for schedule in schedules_to_run:
 
         # get the queryset of ACTIVE servers that are scheduled to be powered off
         # Note: we specifically only want active servers here - we do not want to power off servers
         # that are currently provisioning, decommissioning, or being modified.
-        off_servers = schedule.servers_to_power_off.filter(status="ACTIVE")
-        power_off_servers.extend(off_servers)
+        off_servers = schedule.servers_to_power_off.filter(
+            status="ACTIVE"
+        ).select_related("resource_handler", "ec2serverinfo")
+        for server in off_servers:
+            scheduled_power[server.id] = (server, "off")
 
         # get the ACTIVE servers that are scheduled to be powered on
         # Note: we specifically only want active servers here - we do not want to power on servers
         # that are currently provisioning, decommissioning, or being modified.
-        on_servers = schedule.servers_to_power_on.filter(status="ACTIVE")
-        power_on_servers.extend(on_servers)
+        on_servers = schedule.servers_to_power_on.filter(
+            status="ACTIVE"
+        ).select_related("resource_handler", "ec2serverinfo")
+        for server in on_servers:
+            scheduled_power[server.id] = (server, "on")
+
+    power_off_servers = [
+        server for server, on_off in scheduled_power.values() if on_off == "off"
+    ]
+    power_on_servers = [
+        server for server, on_off in scheduled_power.values() if on_off == "on"
+    ]
+
+    # A scheduled power change replaces any retry of the server's last one
+    scheduled_ids = {server.id for server in power_on_servers + power_off_servers}
+    retry_ids = [
+        server_id for server_id in due_retries if server_id not in scheduled_ids
+    ]
+    retry_servers = Server.objects.filter(
+        id__in=retry_ids, status="ACTIVE"
+    ).select_related("resource_handler", "ec2serverinfo")
+    for server in retry_servers:
+        if due_retries[server.id]["on_off"] == "on":
+            power_on_servers.append(server)
+        else:
+            power_off_servers.append(server)
+        set_progress(
+            "Retrying power {} of server '{}', attempt {} of {}.".format(
+                due_retries[server.id]["on_off"],
+                server,
+                due_retries[server.id]["attempts"] + 1,
+                RETRY_MAX_ATTEMPTS + 1,
+            )
+        )
+    retried_ids = {server.id for server in retry_servers}
+    for server_id in due_retries:
+        if server_id not in retried_ids:
+            retry_queue.pop(server_id)
+
+    # The servers are grouped for batching once, and the groups are used both to
+    # check the current instance states and to power the servers
+    plans = {}
+    for on_off, servers in [("on", power_on_servers), ("off", power_off_servers)]:
+        batches, unbatched_servers = group_servers_for_batching(servers)
+        plans[on_off] = skip_servers_in_power_state(batches, unbatched_servers, on_off)
+    power_on_batches, power_on_unbatched, skipped_on_servers = plans["on"]
+    power_off_batches, power_off_unbatched, skipped_off_servers = plans["off"]
+    power_on_servers = get_planned_servers(power_on_batches, power_on_unbatched)
+    power_off_servers = get_planned_servers(power_off_batches, power_off_unbatched)
+    for on_off, skipped_servers in [
+        ("on", skipped_on_servers),
+        ("off", skipped_off_servers),
+    ]:
+        if skipped_servers:
+            set_progress(
+                "Skipping {} server{} already powered {}: {}".format(
+                    len(skipped_servers),
+                    pluralize(len(skipped_servers)),
+                    on_off,
+                    ", ".join([svr.hostname for svr in skipped_servers]),
+                )
+            )
 
     power_on_servers_str = ", ".join([svr.hostname for svr in power_on_servers])
     power_off_servers_str = ", ".join([svr.hostname for svr in power_off_servers])
@@ -101,43 +318,113 @@ def run(job=None, logger=None, **kwargs):
         )
     )
 
-    # Run power off and power on tasks in parallel using ThreadPoolExecutor.
-    # Use a with statement to ensure threads are cleaned up.
-    with ThreadPoolExecutor(max_workers=100) as pool:
+    # Run power off and power on tasks in parallel, with a pool of workers per
+    # resource handler. Use a with statement to ensure threads are cleaned up.
+    with HandlerPools() as pools:
+        waves = WavePlanner()
+        for on_off, (batches, unbatched_servers, _) in plans.items():
+            for (rh, region), batch in batches.items():
+                for i in range(0, len(batch), BATCH_SIZE):
+                    chunk = batch[i : i + BATCH_SIZE]
+                    waves.add(
+                        rh,
+                        (on_off, chunk, True),
+                        threaded_batch_power,
+                        rh,
+                        region,
+                        chunk,
+                        on_off,
+                        job,
+                    )
+            power_method = threaded_power_on if on_off == "on" else threaded_power_off
+            for server in unbatched_servers:
+                waves.add(
+                    server.resource_handler,
+                    (on_off, [server], False),
+                    power_method,
+                    server,
+                    job,
+                )
+        for message in waves.plan():
+            set_progress(message)
+
         # Accessing the result of the future object generated by submit()
         # causes the job to block until the power on/off task completes, so
         # store all the future objects without looking at the results until all
         # the tasks have been kicked off.
-        future_map = {}
-        for server in power_on_servers:
-            future = pool.submit(threaded_power_on, server, job)
-            future_map[future] = ("on", server)
-        for server in power_off_servers:
-            future = pool.submit(threaded_power_off, server, job)
-            future_map[future] = ("off", server)
+        future_map = waves.submit(pools.submit)
 
         failures = {"on": 0, "off": 0}
+        failed_server_ids = set()
         # Use as_completed to process the result of each task as it completes
         for future in as_completed(future_map):
-            on_off, server = future_map[future]
+            on_off, servers, batched = future_map[future]
             try:
-                success = future.result()
+                result = future.result()
             except Exception as exc:
                 logger.info(
-                    "Exception during power %s of server %s: %s",
+                    "Exception during power %s of server%s %s: %s",
                     on_off,
-                    server,
+                    pluralize(len(servers)),
+                    ", ".join(str(server) for server in servers),
                     exc,
                     exc_info=True,
                 )
-                success = False
-            if not success:
+                failed_servers = servers
+            else:
+                if batched:
+                    failed_servers = result
+                else:
+                    failed_servers = [] if result else servers
+            for server in failed_servers:
                 set_progress(
                     "Failed to power {on_off} server '{server}'.".format(
                         on_off=on_off, server=server
                     )
                 )
                 failures[on_off] += 1
+                failed_server_ids.add(server.id)
+
+    # The servers for this run's schedules have now been powered
+    set_last_tick(tick)
+
+    for line in pools.report():
+        set_progress(line)
+
+    for on_off, servers in [("on", power_on_servers), ("off", power_off_servers)]:
+        for server in servers:
+            if server.id not in failed_server_ids:
+                retry_queue.pop(server.id, None)
+            elif not schedule_retry(retry_queue, server.id, on_off, retry_time):
+                set_progress(
+                    "Giving up on powering {} server '{}'.".format(on_off, server)
+                )
+    for server in skipped_on_servers + skipped_off_servers:
+        retry_queue.pop(server.id, None)
+    save_retry_queue(
+        retry_queue,
+        set(due_retries)
+        | {
+            server.id
+            for server in power_on_servers
+            + power_off_servers
+            + skipped_on_servers
+            + skipped_off_servers
+        },
+    )
+
+    outcomes = []
+    for on_off, servers, skipped_servers in [
+        ("on", power_on_servers, skipped_on_servers),
+        ("off", power_off_servers, skipped_off_servers),
+    ]:
+        outcomes.extend((server, on_off, "skipped") for server in skipped_servers)
+        for server in servers:
+            if server.id in failed_server_ids:
+                outcomes.append((server, on_off, "failed"))
+            else:
+                outcomes.append((server, on_off, "succeeded"))
+    write_run_metrics("Auto-power control servers", outcomes, pools)
 
     if failures["on"] or failures["off"]:
         total_attempts = len(power_on_servers) + len(power_off_servers)
@@ -152,23 +439,798 @@ def run(job=None, logger=None, **kwargs):
     output = "{} servers powered on.\n{} servers powered off.".format(
         final_powered_on, final_powered_off
     )
+    skipped = len(skipped_on_servers) + len(skipped_off_servers)
+    if skipped:
+        output += "\n{} server{} already in the scheduled power state.".format(
+            skipped, pluralize(skipped)
+        )
 
     status, errors = "SUCCESS", ""
     return status, output, errors
 
 
+def group_servers_for_batching(servers):
+    """
+    Group the AWS servers by resource handler and region so they can be powered
+    with one API call per batch. Returns a dict of (handler, region) -> servers,
+    and a list of the servers that need to be powered individually.
+    """
+    handlers = {}
+    batches = {}
+    unbatched_servers = []
+    for server in servers:
+        rh_id = server.resource_handler_id
+        if rh_id not in handlers:
+            handlers[rh_id] = server.resource_handler.cast() if rh_id else None
+        rh = handlers[rh_id]
+        ec2_info = getattr(server, "ec2serverinfo", None)
+        if (
+            isinstance(rh, AWSHandler)
+            and ec2_info
+            and ec2_info.ec2_region
+            and server.resource_handler_svr_id
+        ):
+            batches.setdefault((rh, ec2_info.ec2_region), []).append(server)
+        else:
+            unbatched_servers.append(server)
+    return batches, unbatched_servers
+
+
+def skip_servers_in_power_state(batches, unbatched_servers, on_off):
+    """
+    Split off the servers that are already powered on_off. The current state of
+    the AWS servers is checked with one DescribeInstances call per handler and
+    region, and the servers on other technologies are checked against their
+    cached last known power state. The recorded power_status of the skipped
+    servers is updated to match. batches and unbatched_servers are as returned by
+    group_servers_for_batching. Returns the batches and unbatched servers that
+    still need to be powered, and the servers that were skipped.
+
+    Servers on other technologies without a cached power state are always
+    powered, as their recorded power_status can be out of date.
+    """
+    power_states = cache.get_many(
+        [
+            POWER_STATE_CACHE_KEY.format(server_id=server.id)
+            for server in unbatched_servers
+        ]
+    )
+    skipped_servers = []
+    servers_to_power = []
+    for server in unbatched_servers:
+        key = POWER_STATE_CACHE_KEY.format(server_id=server.id)
+        if power_states.get(key) == on_off:
+            skipped_servers.append(server)
+        else:
+            servers_to_power.append(server)
+
+    batches_to_power = {}
+    for (rh, region), batch in batches.items():
+        try:
+            states = get_instance_states(rh, region, batch)
+        except ClientError as exc:
+            parent_thread_logger.info(
+                "Unable to check instance states in {}, powering all servers: "
+                "{}".format(region, exc)
+            )
+            batches_to_power[(rh, region)] = batch
+            continue
+        checked_servers = []
+        for server in batch:
+            if states.get(server.resource_handler_svr_id) in EC2_TARGET_STATES[on_off]:
+                skipped_servers.append(server)
+                checked_servers.append(server)
+            else:
+                batches_to_power.setdefault((rh, region), []).append(server)
+        cache_power_states(checked_servers, on_off)
+
+    Server.objects.filter(id__in=[server.id for server in skipped_servers]).update(
+        power_status="POWERON" if on_off == "on" else "POWEROFF"
+    )
+    return batches_to_power, servers_to_power, skipped_servers
+
+
+def get_planned_servers(batches, unbatched_servers):
+    # Returns all of the servers in the batches and unbatched servers
+    return [server for batch in batches.values() for server in batch] + list(
+        unbatched_servers
+    )
+
+
+def get_instance_states(rh, region, servers):
+    """
+    Return a dict of instance ID -> EC2 state name for the servers in one region.
+    An instance-id filter is used rather than InstanceIds so that instances that
+    no longer exist are left out instead of failing the call.
+    """
+    client = rh.get_boto3_client(region_name=region, service_name="ec2")
+    paginator = client.get_paginator("describe_instances")
+    instance_ids = [server.resource_handler_svr_id for server in servers]
+    states = {}
+    for i in range(0, len(instance_ids), DESCRIBE_BATCH_SIZE):
+        filters = [
+            {
+                "Name": "instance-id",
+                "Values": instance_ids[i : i + DESCRIBE_BATCH_SIZE],
+            }
+        ]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    states[instance["InstanceId"]] = instance["State"]["Name"]
+    return states
+
+
+def threaded_batch_power(rh, region, servers, on_off, job):
+    thread = threading.current_thread()
+    thread.job = job
+    thread.logger = parent_thread_logger
+    return batch_power(rh, region, servers, on_off)
+
+
+def batch_power(rh, region, servers, on_off):
+    """
+    Power on or off a batch of AWS servers in the same region with a single
+    API call, and wait for the instances to reach the target state. The servers
+    that reached it are then powered through CloudBolt one at a time, as in
+    power_server, to record their power status and history. Returns the list of
+    servers that failed to change power state.
+    """
+    servers_by_instance = {server.resource_handler_svr_id: server for server in servers}
+    instance_ids = list(servers_by_instance)
+    client = rh.get_boto3_client(region_name=region, service_name="ec2")
+    attempt = 0
+    while True:
+        try:
+            if on_off == "on":
+                response = client.start_instances(InstanceIds=instance_ids)
+                changes = response["StartingInstances"]
+            else:
+                response = client.stop_instances(InstanceIds=instance_ids)
+                changes = response["StoppingInstances"]
+            break
+        except ClientError as exc:
+            if is_throttling_error(exc) and attempt < BATCH_THROTTLE_RETRIES:
+                # Let the handler's concurrency limit back off, and try again
+                limit = get_current_limit()
+                if limit:
+                    limit.throttle()
+                time.sleep(BATCH_THROTTLE_DELAY * 2 ** attempt)
+                attempt += 1
+                continue
+            # A single bad instance fails the whole call, fall back to powering
+            # each server individually
+            parent_thread_logger.info(
+                "Batch power {} in {} failed, powering servers individually: "
+                "{}".format(on_off, region, exc)
+            )
+            return [server for server in servers if not power_server(server, on_off)]
+
+    changed_servers = [
+        servers_by_instance[change["InstanceId"]]
+        for change in changes
+        if change["InstanceId"] in servers_by_instance
+    ]
+    powered_servers = wait_for_instance_states(
+        rh, region, client, changed_servers, on_off
+    )
+    powered_ids = {
+        server.id for server in powered_servers if power_server(server, on_off)
+    }
+    return [server for server in servers if server.id not in powered_ids]
+
+
+def wait_for_instance_states(rh, region, client, servers, on_off):
+    """
+    Wait up to BATCH_WAIT_TIMEOUT seconds for the instances of the servers to
+    reach the final state for on_off, and return the servers that reached it.
+    """
+    if not servers:
+        return []
+    try:
+        client.get_waiter(EC2_WAITERS[on_off]).wait(
+            InstanceIds=[server.resource_handler_svr_id for server in servers],
+            WaiterConfig={"Delay": 15, "MaxAttempts": BATCH_WAIT_TIMEOUT // 15},
+        )
+    except WaiterError as exc:
+        # Some instances did not get there, find out which
+        parent_thread_logger.info(
+            "Timed out waiting for instances in {} to power {}: {}".format(
+                region, on_off, exc
+            )
+        )
+    states = get_instance_states(rh, region, servers)
+    return [
+        server
+        for server in servers
+        if states.get(server.resource_handler_svr_id) == EC2_FINAL_STATES[on_off]
+    ]
+
+
+# Everything below this line is shared, byte for byte, by the Auto-power control
+# servers and Auto-power control resources jobs. Recurring job scripts run
+# standalone and can't import each other, so change both copies together.
+
+
+def get_schedules_to_run(last_tick, tick):
+    """
+    Return the ScheduledTimes due in the minute slots after last_tick, up to and
+    including tick, in the order they came due. Slots more than CATCH_UP_MINUTES
+    before tick are not caught up on.
+
+    Each run of the job is one tick of a PowerTimeWheel. The last tick is only
+    moved on once the run has powered its servers, so the schedules are run at
+    least once: a run that fails part way is repeated on the next tick, and the
+    servers it already powered are skipped as they are in the target state. With
+    no last tick, as on the first run after upgrading from the hourly version of
+    the job, the slots from the top of the current hour are run, so that the
+    schedules spread over the hour (see SPREAD_MINUTES) that came due before the
+    first run are not missed.
+    """
+    start = tick.replace(minute=0)
+    if last_tick:
+        start = max(
+            last_tick + timedelta(minutes=1),
+            tick - timedelta(minutes=CATCH_UP_MINUTES),
+        )
+    if start > tick:
+        return []
+    wheel = PowerTimeWheel.load(start, tick)
+    due_slots = sorted(wheel.due_slots(start, tick), key=lambda due: due[0])
+    return [schedule for _, schedule in due_slots]
+
+
+def get_last_tick():
+    """
+    Return the UTC minute slot the job last ran the schedules up to, or None if
+    it has not run yet. This is kept in the database rather than the cache, so it
+    does not depend on the cache being shared between the CloudBolt servers.
+    """
+    cfv = (
+        CustomFieldValue.objects.filter(field__name=LAST_TICK_FIELD)
+        .only("str_value")
+        .first()
+    )
+    if not (cfv and cfv.str_value):
+        return None
+    return pytz.utc.localize(datetime.strptime(cfv.str_value, TICK_FORMAT))
+
+
+def set_last_tick(tick):
+    cf, _ = CustomField.objects.get_or_create(
+        name=LAST_TICK_FIELD,
+        defaults={
+            "label": LAST_TICK_LABEL,
+            "type": "STR",
+            "description": "The last minute slot, in UTC, the job has run the "
+            "power schedules up to",
+        },
+    )
+    CustomFieldValue.objects.update_or_create(
+        field=cf, defaults={"str_value": tick.strftime(TICK_FORMAT)}
+    )
+
+
+def get_slot_minute(schedule):
+    """
+    Return the minute of the hour the schedule runs at. This is zero unless
+    SPREAD_MINUTES is set, in which case it is derived from the schedule's ID so
+    that it stays the same from one run to the next.
+    """
+    if SPREAD_MINUTES <= 1:
+        return 0
+    return schedule.id % SPREAD_MINUTES
+
+
+class PowerTimeWheel(object):
+    """
+    A hierarchical time wheel of ScheduledTimes with minute granularity. The
+    schedules are bucketed by timezone, and then by day of the week, hour and
+    minute in that timezone, so that hours with nothing scheduled can be skipped
+    without looking at each of their minutes.
+    """
+
+    def __init__(self, schedules):
+        self.wheel = {}
+        for schedule in schedules:
+            days = self.wheel.setdefault(schedule.timezone, {})
+            hours = days.setdefault(schedule.day_of_week, {})
+            minutes = hours.setdefault(schedule.hour, {})
+            minutes.setdefault(get_slot_minute(schedule), []).append(schedule)
+
+    @classmethod
+    def load(cls, start, end):
+        """
+        Load the schedules for the hours between the UTC datetimes start and end,
+        with a single query on (timezone, day_of_week, hour). Localizing the UTC
+        times with pytz takes care of DST for each timezone.
+        """
+        timezones = (
+            ScheduledTime.objects.order_by()
+            .values_list("timezone", flat=True)
+            .distinct()
+        )
+        query = Q()
+        for timezone in timezones:
+            tz = pytz.timezone(timezone)
+            hours = set()
+            utc_time = start
+            while utc_time < end + timedelta(hours=1):
+                localized_time = min(utc_time, end).astimezone(tz)
+                hours.add((localized_time.weekday(), localized_time.hour))
+                utc_time += timedelta(hours=1)
+            for day_of_week, hour in hours:
+                query |= Q(timezone=timezone, day_of_week=day_of_week, hour=hour)
+        if not query:
+            return cls([])
+        return cls(ScheduledTime.objects.filter(query))
+
+    def due_slots(self, start, end):
+        """
+        Yield (slot, schedule) for each schedule due in a minute slot between the
+        UTC datetimes start and end, inclusive. slot is the UTC start of the minute.
+        """
+        for timezone, days in self.wheel.items():
+            tz = pytz.timezone(timezone)
+            slot = start
+            while slot <= end:
+                localized_time = slot.astimezone(tz)
+                minutes = days.get(localized_time.weekday(), {}).get(
+                    localized_time.hour
+                )
+                if not minutes:
+                    # Nothing scheduled this hour, skip to the next one
+                    slot += timedelta(minutes=60 - localized_time.minute)
+                    continue
+                for schedule in minutes.get(localized_time.minute, []):
+                    yield slot, schedule
+                slot += timedelta(minutes=1)
+
+
+def schedule_retry(retry_queue, item_id, on_off, now):
+    """
+    Add or update the retry queue entry for a failed power operation, doubling
+    the wait before the next attempt each time. Returns False, and drops the
+    entry, if the operation has run out of retries.
+    """
+    entry = retry_queue.get(item_id)
+    if not entry or entry["on_off"] != on_off:
+        entry = {"on_off": on_off, "attempts": 0, "first_failure": now}
+    entry["attempts"] += 1
+    entry["next_attempt"] = now + RETRY_BASE_DELAY * 2 ** (entry["attempts"] - 1)
+    if (
+        entry["attempts"] > RETRY_MAX_ATTEMPTS
+        or entry["next_attempt"] > entry["first_failure"] + RETRY_WINDOW
+    ):
+        retry_queue.pop(item_id, None)
+        return False
+    retry_queue[item_id] = entry
+    return True
+
+
+def load_retry_queue():
+    """
+    Return the retry queue as a dict of item ID -> retry entry. The queue is kept
+    in the database, with a value of RETRY_QUEUE_FIELD for each item on it, so
+    that each item's entry is saved on its own rather than the whole queue being
+    read and written back as one value.
+    """
+    entries = CustomFieldValue.objects.filter(
+        field__name=RETRY_QUEUE_FIELD
+    ).values_list("str_value", "txt_value")
+    return {int(item_id): json.loads(entry) for item_id, entry in entries}
+
+
+def save_retry_queue(retry_queue, item_ids):
+    """
+    Save the retry queue entries of the items with the IDs given, and delete
+    those of the items no longer on the queue.
+    """
+    if not item_ids:
+        return
+    cf, _ = CustomField.objects.get_or_create(
+        name=RETRY_QUEUE_FIELD,
+        defaults={
+            "label": RETRY_QUEUE_LABEL,
+            "type": "CODE",
+            "description": "Failed power operations to retry, keyed by ID",
+        },
+    )
+    CustomFieldValue.objects.filter(
+        field=cf,
+        str_value__in=[
+            str(item_id) for item_id in item_ids if item_id not in retry_queue
+        ],
+    ).delete()
+    for item_id in item_ids:
+        if item_id in retry_queue:
+            CustomFieldValue.objects.update_or_create(
+                field=cf,
+                str_value=str(item_id),
+                defaults={"txt_value": json.dumps(retry_queue[item_id])},
+            )
+
+
+def cache_power_states(servers, on_off):
+    cache.set_many(
+        {
+            POWER_STATE_CACHE_KEY.format(server_id=server.id): on_off
+            for server in servers
+        },
+        timeout=POWER_STATE_CACHE_TIMEOUT,
+    )
+
+
+class WavePlanner(object):
+    """
+    Spreads the power operations for each resource handler with more than
+    threshold of them evenly over WAVE_WINDOW_MINUTES, rather than sending them
+    all at once. Each operation is given an equal share of its handler's window
+    and starts at the beginning of that share. An operation made up of several
+    sequential steps, such as the tiers of a resource, is planned as a single
+    unit so its order is kept.
+    """
+
+    def __init__(self, window=WAVE_WINDOW_MINUTES * 60, threshold=WAVE_THRESHOLD):
+        self.window = window
+        self.threshold = threshold
+        self.operations = {}
+        self.waves = []
+
+    def add(self, rh, context, func, *args, steps=1):
+        key = rh.id if rh else None
+        self.operations.setdefault(key, []).append((rh, steps, context, func, args))
+
+    def plan(self):
+        """
+        Plan the start time of each operation, and return a progress message for
+        each resource handler with its expected completion time.
+        """
+        now = datetime.now()
+        messages = []
+        self.waves = []
+        for operations in self.operations.values():
+            window = self.window if len(operations) > self.threshold else 0
+            share = float(window) / len(operations)
+            completion = 0
+            for i, (rh, steps, context, func, args) in enumerate(operations):
+                offset = i * share
+                self.waves.append((offset, rh, context, func, args))
+                completion = max(
+                    completion, offset + steps * EXPECTED_OPERATION_SECONDS
+                )
+            if window:
+                spread = "over {} minute{}".format(
+                    window // 60, pluralize(window // 60)
+                )
+            else:
+                spread = "at once"
+            messages.append(
+                "Will start {} power operation{} on handler '{}' {}, expected to "
+                "complete by {}.".format(
+                    len(operations),
+                    pluralize(len(operations)),
+                    operations[0][0],
+                    spread,
+                    (now + timedelta(seconds=completion)).strftime("%H:%M"),
+                )
+            )
+        self.waves.sort(key=lambda wave: wave[0])
+        return messages
+
+    def submit(self, submit):
+        """
+        Call submit(rh, func, *args) for each operation at its planned start
+        time, and return a dict of futures -> the operation's context. This does
+        not block: the operations planned for later are submitted from timers,
+        and their futures complete with the result of the future that submit
+        returns for them.
+        """
+        future_map = {}
+        for offset, rh, context, func, args in self.waves:
+            if offset <= 0:
+                future_map[submit(rh, func, *args)] = context
+                continue
+            future = Future()
+            timer = threading.Timer(
+                offset, self.submit_later, (future, submit, rh, func, args)
+            )
+            timer.daemon = True
+            timer.start()
+            future_map[future] = context
+        return future_map
+
+    @staticmethod
+    def submit_later(future, submit, rh, func, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            submitted = submit(rh, func, *args)
+        except Exception as exc:
+            future.set_exception(exc)
+            return
+
+        def copy_result(submitted):
+            exc = submitted.exception()
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(submitted.result())
+
+        submitted.add_done_callback(copy_result)
+
+
+def write_run_metrics(job_name, outcomes, pools):
+    """
+    Append the metrics for this run to METRICS_FILE, and report the estimated
+    hourly savings. outcomes is a list of (server, on_off, outcome) for each
+    server the run targeted, where outcome is "succeeded", "failed", "skipped"
+    or "timed_out". The savings are the hourly rates of the servers powered off.
+    """
+    hours = HOURS_PER_RATE_TIME_UNIT.get(GlobalPreferences.objects.get().rate_time_unit)
+    timestamp = datetime.now(pytz.utc).isoformat()
+    handler_names = {}
+    counts = {}
+    for server, on_off, outcome in outcomes:
+        handler_names[server.resource_handler_id] = str(server.resource_handler)
+        for key in [server.resource_handler_id, "total"]:
+            metrics = counts.setdefault(
+                key,
+                {
+                    "targeted": 0,
+                    "succeeded": 0,
+                    "failed": 0,
+                    "skipped": 0,
+                    "timed_out": 0,
+                    "hourly_savings": 0.0,
+                },
+            )
+            metrics["targeted"] += 1
+            metrics[outcome] += 1
+            if on_off == "off" and outcome == "succeeded" and hours and server.rate:
+                metrics["hourly_savings"] += float(server.rate) / hours
+
+    records = []
+    all_latencies = []
+    for key, metrics in counts.items():
+        if key == "total":
+            continue
+        limit = pools.limits.get(key)
+        latencies = limit.latencies if limit else []
+        all_latencies.extend(latencies)
+        records.append(
+            dict(
+                metrics,
+                handler=handler_names[key],
+                latency_p50=get_percentile(latencies, 0.5),
+                latency_p95=get_percentile(latencies, 0.95),
+            )
+        )
+    if "total" in counts:
+        records.append(
+            dict(
+                counts["total"],
+                handler="total",
+                latency_p50=get_percentile(all_latencies, 0.5),
+                latency_p95=get_percentile(all_latencies, 0.95),
+            )
+        )
+        set_progress(
+            "Estimated hourly savings from the servers powered off: {:.2f}".format(
+                counts["total"]["hourly_savings"]
+            )
+        )
+
+    try:
+        with open(METRICS_FILE, "a") as metrics_file:
+            for record in records:
+                record.update(timestamp=timestamp, job=job_name)
+                metrics_file.write(json.dumps(record, sort_keys=True) + "\n")
+    except (IOError, OSError) as exc:
+        parent_thread_logger.warning(
+            "Unable to write power metrics to {}: {}".format(METRICS_FILE, exc)
+        )
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int((len(values) - 1) * percentile)]
+
+
+def is_throttling_error(exc):
+    message = str(exc).lower()
+    return any(marker in message for marker in THROTTLING_ERROR_MARKERS)
+
+
+def get_max_concurrency(rh):
+    """
+    Return the maximum number of power operations to run at once against the
+    resource handler. The AUTO_POWER_MAX_CONCURRENCY setting, a dict of
+    technology name -> limit with the default limit under "default", overrides
+    MAX_CONCURRENCY and DEFAULT_MAX_CONCURRENCY.
+    """
+    limits = dict(MAX_CONCURRENCY, default=DEFAULT_MAX_CONCURRENCY)
+    limits.update(getattr(settings, "AUTO_POWER_MAX_CONCURRENCY", None) or {})
+    technology = getattr(rh.resource_technology, "name", None) if rh else None
+    return limits.get(technology, limits["default"])
+
+
+class AdaptiveLimit(object):
+    """
+    An AIMD concurrency limit for the power operations against one resource
+    handler. The limit is halved each time an operation is throttled, and
+    increased by one after a full limit's worth of operations succeed, up to
+    max_limit.
+
+    An operation is throttled if it raises a throttling error, or calls
+    throttle() on the limit of its thread (see get_current_limit). power_on
+    and power_off report failures by returning False without the reason, so
+    an operation returning False is counted as failed, but does not change the
+    limit.
+    """
+
+    def __init__(self, name, max_limit):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.successes = 0
+        self.throttled = 0
+        self.failed = 0
+        self.latencies = []
+        self.condition = threading.Condition()
+
+    def enqueue(self):
+        with self.condition:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.queued -= 1
+            self.active += 1
+
+    def release(self, latency, throttled, failed=False):
+        with self.condition:
+            self.active -= 1
+            self.latencies.append(latency)
+            if throttled:
+                self.throttle()
+            elif failed:
+                self.failed += 1
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.successes = 0
+                    self.limit += 1
+            self.condition.notify_all()
+
+    def throttle(self):
+        with self.condition:
+            self.throttled += 1
+            self.successes = 0
+            self.limit = max(1, self.limit // 2)
+
+    def run(self, func, *args, dispatched=None):
+        """
+        Run func(*args) once the limit allows it. The time it started running
+        is set under "time" in the dispatched dict, if one is passed.
+        """
+        self.acquire()
+        if dispatched is not None:
+            dispatched["time"] = time.time()
+        thread = threading.current_thread()
+        thread.power_limit = self
+        start = time.time()
+        throttled = failed = False
+        try:
+            result = func(*args)
+            failed = result is False
+            return result
+        except Exception as exc:
+            throttled = is_throttling_error(exc)
+            failed = not throttled
+            raise
+        finally:
+            thread.power_limit = None
+            self.release(time.time() - start, throttled, failed)
+
+    def report(self):
+        latencies = self.latencies
+        if not latencies:
+            return "Handler '{}': no power operations.".format(self.name)
+        p50 = get_percentile(latencies, 0.5)
+        p95 = get_percentile(latencies, 0.95)
+        return (
+            "Handler '{}': {} power operation{}, {} throttled, {} failed, peak "
+            "queue depth {}, latency p50 {:.1f}s p95 {:.1f}s, concurrency limit "
+            "{}/{}.".format(
+                self.name,
+                len(latencies),
+                pluralize(len(latencies)),
+                self.throttled,
+                self.failed,
+                self.max_queued,
+                p50,
+                p95,
+                self.limit,
+                self.max_limit,
+            )
+        )
+
+
+class HandlerPools(object):
+    """
+    Runs power operations on a thread pool per resource handler, each gated by
+    an AdaptiveLimit.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.pools = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+
+    def submit(self, rh, func, *args):
+        key = rh.id if rh else None
+        if key not in self.limits:
+            max_limit = get_max_concurrency(rh)
+            self.limits[key] = AdaptiveLimit(str(rh), max_limit)
+            self.pools[key] = ThreadPoolExecutor(max_workers=max_limit)
+        limit = self.limits[key]
+        limit.enqueue()
+        dispatched = {}
+        future = self.pools[key].submit(limit.run, func, *args, dispatched=dispatched)
+        # Holds the time the operation started running, once it has
+        future.dispatched = dispatched
+        return future
+
+    def report(self):
+        return [limit.report() for limit in self.limits.values()]
+
+
+def get_current_limit():
+    """
+    Return the AdaptiveLimit of the power operation running on this thread, or
+    None
+    """
+    return getattr(threading.current_thread(), "power_limit", None)
+
+
+def power_server(server, on_off):
+    """
+    Power on or off a single server, caching its power state if it succeeds.
+    Returns True if it succeeded, and False otherwise.
+    """
+    result = server.power_on() if on_off == "on" else server.power_off()
+    if result:
+        cache_power_states([server], on_off)
+    return bool(result)
+
+
 def threaded_power_on(server, job):
     thread = threading.current_thread()
     thread.job = job
     thread.logger = parent_thread_logger
-    return server.power_on()
+    return power_server(server, "on")
 
 
 def threaded_power_off(server, job):
     thread = threading.current_thread()
     thread.job = job
     thread.logger = parent_thread_logger
-    return server.power_off()
+    return power_server(server, "off")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+The module for the 'Discover CloudFormation Stacks' recurring job.
+
+Enumerates the CloudFormation stacks in every region used by an AWS
+Environment, for every AWS Resource Handler, and matches them to the resources
+deployed by the CloudFormation XUI using the 'cft_stack_id' parameter. It
+reports:
+- stacks that CloudFormation detected as drifted from their template
+- orphaned stacks, that exist in AWS but are not tied to a CloudBolt resource
+- resources whose stack no longer exists in AWS
+
+Drift detection is started on every stack managed by CloudBolt, so that the
+drift status reported is current. The regions are scanned in parallel, each
+in its own thread.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+if __name__ == "__main__":
+    import django
+
+    django.setup()
+
+from django.template.defaultfilters import pluralize
+
+from django.db.models import Prefetch
+
+from common.methods import set_progress
+from infrastructure.models import Environment
+from orders.models import CustomFieldValue
+from resourcehandlers.aws.models import AWSHandler
+from resources.models import Resource
+
+# All statuses except DELETE_COMPLETE
+STACK_STATUS_FILTER = [
+    "CREATE_IN_PROGRESS",
+    "CREATE_FAILED",
+    "CREATE_COMPLETE",
+    "ROLLBACK_IN_PROGRESS",
+    "ROLLBACK_FAILED",
+    "ROLLBACK_COMPLETE",
+    "DELETE_IN_PROGRESS",
+    "DELETE_FAILED",
+    "UPDATE_IN_PROGRESS",
+    "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_COMPLETE",
+    "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_IN_PROGRESS",
+    "UPDATE_ROLLBACK_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "REVIEW_IN_PROGRESS",
+    "IMPORT_IN_PROGRESS",
+    "IMPORT_COMPLETE",
+    "IMPORT_ROLLBACK_IN_PROGRESS",
+    "IMPORT_ROLLBACK_FAILED",
+    "IMPORT_ROLLBACK_COMPLETE",
+]
+# Drift detection can only be run on stacks in these statuses
+DRIFT_DETECTION_STATUSES = [
+    "CREATE_COMPLETE",
+    "UPDATE_COMPLETE",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "UPDATE_ROLLBACK_FAILED",
+]
+# Seconds to wait on the drift detections of a region
+DRIFT_DETECTION_TIMEOUT = 60 * 10
+
+
+def run(job=None, logger=None, **kwargs):
+    clients = get_regional_clients()
+    if not clients:
+        return "SUCCESS", "No AWS Environments found to scan.", ""
+    set_progress(
+        "Scanning {} region{} for CloudFormation stacks.".format(
+            len(clients), pluralize(len(clients))
+        )
+    )
+
+    stacks = {}
+    stack_regions = {}
+    failed_regions = []
+    with ThreadPoolExecutor(max_workers=min(len(clients), 32)) as pool:
+        future_map = {
+            pool.submit(list_region_stacks, client): (rh, region)
+            for (rh, region), client in clients.items()
+        }
+        for future in as_completed(future_map):
+            rh, region = future_map[future]
+            try:
+                region_stacks = future.result()
+            except Exception as exc:
+                if logger:
+                    logger.info(
+                        "Exception listing stacks in {} for {}: {}".format(
+                            region, rh, exc
+                        ),
+                        exc_info=True,
+                    )
+                set_progress(
+                    "Failed to list stacks in '{}' for '{}': {}".format(
+                        region, rh, exc
+                    )
+                )
+                failed_regions.append((rh, region))
+                continue
+            for stack in region_stacks:
+                stacks[stack["StackId"]] = stack
+                stack_regions[stack["StackId"]] = (rh, region)
+
+        resources, handler_ids = get_cft_resources()
+        managed_by_region = {}
+        for stack_id, stack in stacks.items():
+            if (
+                stack_id in resources
+                and stack["StackStatus"] in DRIFT_DETECTION_STATUSES
+            ):
+                managed_by_region.setdefault(stack_regions[stack_id], []).append(
+                    stack_id
+                )
+        drift_statuses = {}
+        future_map = {
+            pool.submit(detect_region_drift, clients[key], stack_ids): key
+            for key, stack_ids in managed_by_region.items()
+        }
+        for future in as_completed(future_map):
+            rh, region = future_map[future]
+            try:
+                drift_statuses.update(future.result())
+            except Exception as exc:
+                set_progress(
+                    "Failed to detect drift in '{}' for '{}': {}".format(
+                        region, rh, exc
+                    )
+                )
+
+    managed, drifted, orphans, missing = compare_inventory(
+        stacks, resources, handler_ids, drift_statuses, failed_regions
+    )
+
+    for stack in drifted:
+        set_progress(
+            "Stack '{}' ({}) has drifted from its template.".format(
+                stack["StackName"], resources[stack["StackId"]]
+            )
+        )
+    for stack in orphans:
+        set_progress(
+            "Stack '{}' in status {} is not managed by CloudBolt: {}".format(
+                stack["StackName"], stack["StackStatus"], stack["StackId"]
+            )
+        )
+    for stack_id in missing:
+        set_progress(
+            "Stack for resource '{}' was not found: {}".format(
+                resources[stack_id], stack_id
+            )
+        )
+
+    output = (
+        "Found {} stack{}, {} managed by CloudBolt. {} drifted, {} orphaned, "
+        "{} resource{} missing a stack.".format(
+            len(stacks),
+            pluralize(len(stacks)),
+            len(managed),
+            len(drifted),
+            len(orphans),
+            len(missing),
+            pluralize(len(missing)),
+        )
+    )
+    if failed_regions:
+        return "WARNING", output, "Failed to scan {} region{}.".format(
+            len(failed_regions), pluralize(len(failed_regions))
+        )
+    return "SUCCESS", output, ""
+
+
+def get_regional_clients():
+    """
+    Return a dict of (resource handler, region) -> CloudFormation client, for
+    every region with an AWS Environment. Clients are created here rather
+    than in the threads since boto3 sessions are not thread safe.
+    """
+    clients = {}
+    for rh in AWSHandler.objects.all():
+        regions = set()
+        for env in Environment.objects.filter(resource_handler=rh):
+            if env.aws_region:
+                regions.add(env.aws_region)
+        for region in regions:
+            clients[(rh, region)] = rh.get_boto3_client(
+                region_name=region, service_name="cloudformation"
+            )
+    return clients
+
+
+def list_region_stacks(client):
+    paginator = client.get_paginator("list_stacks")
+    stacks = []
+    for page in paginator.paginate(StackStatusFilter=STACK_STATUS_FILTER):
+        stacks.extend(page["StackSummaries"])
+    return stacks
+
+
+def detect_region_drift(client, stack_ids):
+    """
+    Start drift detection on the stacks passed, and wait for it to finish.
+    Returns a dict of stack ID -> stack drift status, stacks whose detection
+    could not be completed are UNKNOWN.
+    """
+    detections = {}
+    drift_statuses = {}
+    for stack_id in stack_ids:
+        try:
+            response = client.detect_stack_drift(StackName=stack_id)
+        except Exception:
+            drift_statuses[stack_id] = "UNKNOWN"
+            continue
+        detections[response["StackDriftDetectionId"]] = stack_id
+
+    deadline = time.time() + DRIFT_DETECTION_TIMEOUT
+    while detections and time.time() < deadline:
+        time.sleep(5)
+        for detection_id, stack_id in list(detections.items()):
+            status = client.describe_stack_drift_detection_status(
+                StackDriftDetectionId=detection_id
+            )
+            if status["DetectionStatus"] == "DETECTION_IN_PROGRESS":
+                continue
+            del detections[detection_id]
+            drift_statuses[stack_id] = status.get("StackDriftStatus", "UNKNOWN")
+    for stack_id in detections.values():
+        drift_statuses[stack_id] = "UNKNOWN"
+    return drift_statuses
+
+
+def get_cft_resources():
+    """
+    Return a dict of stack ID -> resource for the active resources that were
+    deployed by the CloudFormation XUI, and a dict of stack ID -> ID of the
+    Resource Handler the stack was deployed with
+    """
+    resources = (
+        Resource.objects.filter(
+            lifecycle="ACTIVE", blueprint__tags__name="CloudFormation"
+        )
+        .distinct()
+        .prefetch_related(
+            Prefetch(
+                "attributes",
+                queryset=CustomFieldValue.objects.filter(
+                    field__name__in=["cft_stack_id", "cft_env_id"]
+                ).select_related("field"),
+                to_attr="cft_cfvs",
+            )
+        )
+    )
+    stack_ids = {}
+    env_ids = {}
+    for resource in resources:
+        cfvs = {cfv.field.name: cfv.value for cfv in resource.cft_cfvs}
+        stack_id = cfvs.get("cft_stack_id")
+        if stack_id:
+            stack_ids[stack_id] = resource
+            if str(cfvs.get("cft_env_id") or "").isdigit():
+                env_ids[stack_id] = int(cfvs["cft_env_id"])
+
+    handler_ids_by_env = dict(
+        Environment.objects.filter(id__in=set(env_ids.values())).values_list(
+            "id", "resource_handler_id"
+        )
+    )
+    handler_ids = {
+        stack_id: handler_ids_by_env.get(env_id)
+        for stack_id, env_id in env_ids.items()
+    }
+    return stack_ids, handler_ids
+
+
+def compare_inventory(stacks, resources, handler_ids, drift_statuses,
+                      failed_regions):
+    """
+    Return the stacks managed by CloudBolt, the drifted ones among them, the
+    orphaned stacks and the IDs of resource stacks that were not found
+    """
+    managed = []
+    drifted = []
+    orphans = []
+    for stack_id, stack in stacks.items():
+        if stack_id not in resources:
+            if not stack.get("ParentId"):
+                # Nested stacks belong to their root stack
+                orphans.append(stack)
+            continue
+        managed.append(stack)
+        if drift_statuses.get(stack_id) == "DRIFTED":
+            drifted.append(stack)
+
+    # Don't report missing stacks for the Resource Handler and region pairs
+    # that could not be scanned. Stacks whose Resource Handler is not known
+    # are skipped if their region failed for any Resource Handler
+    skipped = {(rh.id, region) for rh, region in failed_regions}
+    skipped_regions = {region for _, region in skipped}
+    missing = []
+    for stack_id in resources:
+        if stack_id in stacks:
+            continue
+        handler_id = handler_ids.get(stack_id)
+        region = get_stack_region(stack_id)
+        if (handler_id, region) in skipped or (
+            handler_id is None and region in skipped_regions
+        ):
+            continue
+        missing.append(stack_id)
+    return managed, drifted, orphans, missing
+
+
+def get_stack_region(stack_id):
+    # Stack IDs are ARNs: arn:aws:cloudformation:<region>:<account>:stack/...
+    arn = stack_id.split(":")
+    return arn[3] if len(arn) > 3 else None
+
+
+if __name__ == "__main__":
+    run()
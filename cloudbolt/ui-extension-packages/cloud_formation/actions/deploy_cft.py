@@ -29,7 +29,9 @@ from infrastructure.models import Environment
 from utilities.logger import ThreadLogger
 from xui.cloud_formation.shared import get_high_level_parameters, \
     save_cft_to_resource, fetch_parameters_for_cft_deployment, \
-    submit_template_request, update_cb_resource, render_parameters
+    submit_template_request, update_cb_resource, render_parameters, \
+    redact_parameters, get_template_s3_client, get_deployable_template, \
+    get_nested_cfts
 
 logger = ThreadLogger(__name__)
 
@@ -37,7 +39,7 @@ logger = ThreadLogger(__name__)
 def run(job, **kwargs):
     resource = kwargs.get("resource")
     if not resource:
-        msg = f"CloudBolt Resource object not found."
+        msg = "CloudBolt Resource object not found."
         set_progress(msg)
         return "FAILURE", msg, ""
     set_progress(
@@ -47,14 +49,21 @@ def run(job, **kwargs):
     rh = env.resource_handler.cast()
     resource = render_parameters(resource, env, job)
     cft, stack_name = get_high_level_parameters(resource)
-    save_cft_to_resource(resource, cft)
     cft_prefix = f"cft_{resource.blueprint_id}_"
-    parameters = fetch_parameters_for_cft_deployment(resource, cft_prefix)
+    parameters, redacted = fetch_parameters_for_cft_deployment(resource,
+                                                               cft_prefix)
+    set_progress(f"Stack parameters: "
+                 f"{redact_parameters(parameters, redacted)}")
     client = rh.get_boto3_client(
         region_name=env.aws_region, service_name="cloudformation"
     )
+    s3_client = get_template_s3_client(rh, env.aws_region)
     try:
-        stack = submit_template_request(stack_name, cft, parameters, resource, client)
+        nested_cfts = get_nested_cfts(resource, cft)
+        save_cft_to_resource(resource, cft, nested_cfts)
+        cft = get_deployable_template(resource, cft, nested_cfts, s3_client)
+        stack = submit_template_request(stack_name, cft, parameters, resource,
+                                        client, s3_client)
         update_cb_resource(resource, stack, env, job, client, cft_prefix)
         return "SUCCESS", "CloudFormation Template deployment complete", ""
     except Exception as err:
@@ -3,15 +3,25 @@ Handles generating options for AWS Specific Parameters in a CloudFormation templ
 https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/parameters-section-structure.html#aws-specific-parameter-types
 
 Most of the data from these lookups are available in the AWS Resource Handler
+
+Generated options are cached per Environment and Blueprint for a short time so
+that refreshing the order form does not repeat every lookup. The cache is
+invalidated when Environments, Networks or their Groups are saved.
 """
+from django.core.cache import cache
+
 from accounts.models import Group
 from common.methods import set_progress
 from infrastructure.models import Environment
+from resourcehandlers.aws.models import AWSVPCSubnet
 from servicecatalog.models import ServiceBlueprint
 from utilities.logger import ThreadLogger
+from xui.cloud_formation.shared import get_aws_param_options_cache_key
 
 logger = ThreadLogger("GenerateOptionsCFT")
 
+OPTIONS_CACHE_TIMEOUT = 60
+
 
 def get_az_options(environment, allowed_values):
     try:
@@ -51,9 +61,18 @@ def get_image_options(environment, allowed_values):
 
 def get_subnet_options(environment, group, allowed_values):
     try:
-        networks = environment.networks().keys()
+        networks = list(environment.networks().keys())
+        # Look up the subnets, with their Availability Zones, in one query
+        subnets = AWSVPCSubnet.objects.filter(
+            id__in=[network.id for network in networks])
+        subnets = {subnet.id: subnet for subnet in subnets}
         options = []
         for network in networks:
+            subnet = subnets.get(network.id)
+            if subnet is None:
+                logger.warn(f'Network: {network.name} is not an AWS VPC '
+                            f'Subnet, skipping')
+                continue
             net_groups = network.get_groups()
             if net_groups:
                 if group not in net_groups:
@@ -65,9 +84,9 @@ def get_subnet_options(environment, group, allowed_values):
                     # We cannot submit a value that isn't also present in the CFT
                     # as an allowed value, the execution would fail
                     continue
+            net_az = subnet.availability_zone
             # Add the Subnet in to the Label for easy identification if it
             # isn't already included
-            net_az = network.awsvpcsubnet.availability_zone
             label = network.name
             if label.find(net_az) == -1:
                 label = f'{label}-{net_az}'
@@ -133,41 +152,62 @@ def get_bp_from_kwargs(kwargs):
     return bp
 
 
-def get_allowed_values(field, bp):
-    cfvs = bp.get_cfvs_for_custom_field(field.name)
-    logger.debug(f'allowed cfvs: {cfvs}')
-    allowed_values = []
+def get_allowed_values_by_field(bp):
+    # Fetch the allowed values for all of the Blueprint's CFT parameters at
+    # once, rather than one query per parameter
+    cfvs = bp.custom_field_options.filter(
+        field__name__startswith=f"cft_{bp.id}_"
+    ).select_related("field")
+    allowed_values = {}
     for cfv in cfvs:
-        allowed_values.append(cfv.value)
+        allowed_values.setdefault(cfv.field.name, []).append(cfv.value)
     logger.debug(f'allowed values: {allowed_values}')
     return allowed_values
 
 
 def get_options_list(field, control_value=None, **kwargs):
     if not control_value:
-        options = [("", "--- First, Select an Environment ---")]
-    else:
-        options = []
-        field_data = field.name.split("_")
-        aws_param_service = field_data[-3]
-        aws_param_ns = field_data[-2]
-        aws_param_name = field_data[-1]
-        environment = Environment.objects.get(id=control_value)
-        bp = get_bp_from_kwargs(kwargs)
-        allowed_values = get_allowed_values(field, bp)
-        if aws_param_service == "EC2":
-            if aws_param_ns == "AvailabilityZone":
-                options = get_az_options(environment, allowed_values)
-            if aws_param_ns == "Image":
-                options = get_image_options(environment, allowed_values)
-            if aws_param_ns == "Subnet":
-                group = get_group_from_kwargs(kwargs)
-                options = get_subnet_options(environment, group,
-                                             allowed_values)
-            if aws_param_ns == "KeyPair":
-                options = get_keypair_options(environment, allowed_values)
-            if aws_param_ns == "InstanceType":
-                options = get_instance_type_options(environment,
-                                                    allowed_values)
+        return [("", "--- First, Select an Environment ---")]
+    field_data = field.name.split("_")
+    aws_param_service = field_data[-3]
+    aws_param_ns = field_data[-2]
+    aws_param_name = field_data[-1]
+    bp = get_bp_from_kwargs(kwargs)
+    group = None
+    options_key = field.name
+    if aws_param_service == "EC2" and aws_param_ns == "Subnet":
+        # Subnet options are filtered by group permissions
+        group = get_group_from_kwargs(kwargs)
+        options_key = f"{field.name}:{group.id}"
+
+    cache_key = get_aws_param_options_cache_key(control_value, bp.id)
+    cached = cache.get(cache_key) or {}
+    if options_key in cached:
+        logger.debug(f'Using cached options for {options_key}')
+        return cached[options_key]
+
+    options = []
+    environment = Environment.objects.get(id=control_value)
+    if "allowed_values" not in cached:
+        cached["allowed_values"] = get_allowed_values_by_field(bp)
+    allowed_values = cached["allowed_values"].get(field.name, [])
+    if aws_param_service == "EC2":
+        if aws_param_ns == "AvailabilityZone":
+            options = get_az_options(environment, allowed_values)
+        if aws_param_ns == "Image":
+            options = get_image_options(environment, allowed_values)
+        if aws_param_ns == "Subnet":
+            options = get_subnet_options(environment, group,
+                                         allowed_values)
+        if aws_param_ns == "KeyPair":
+            options = get_keypair_options(environment, allowed_values)
+        if aws_param_ns == "InstanceType":
+            options = get_instance_type_options(environment,
+                                                allowed_values)
     # TODO add handling for other AWS Param types
+
+    if not (options and options[0][1].startswith("--- Error")):
+        # Don't hold on to errors, the next refresh should try again
+        cached[options_key] = options
+    cache.set(cache_key, cached, OPTIONS_CACHE_TIMEOUT)
     return options
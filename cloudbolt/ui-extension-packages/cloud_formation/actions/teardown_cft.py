@@ -7,7 +7,16 @@ Do not edit this script directly as all resources provisioned by the
 CloudFormation Library use this script. If you need to make one-off
 modifications, copy this script and create a new action leveraged by the
 blueprint that needs the modifications.
+
+When the job includes several resources (ex: decommissioning an environment),
+all of their stacks are deleted concurrently. Stacks that import exports from
+another stack in the job are deleted before the exporting stack, and all
+in-progress deletions are tracked by a single waiter.
 """
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
 from resourcehandlers.aws.models import AWSHandler
 from common.methods import set_progress
 from utilities.logger import ThreadLogger
@@ -38,75 +47,203 @@ def get_ids(resource):
 
 
 def run(job, *args, **kwargs):
-    resource = job.resource_set.first()
-    if resource:
+    resources = list(job.resource_set.all())
+    if not resources:
+        set_progress("Resource was not found")
+        return "SUCCESS", "Resource was not found", ""
+
+    # Stack ID -> dict of the resource, and the CloudFormation client for the
+    # resource's environment
+    stacks = {}
+    clients = {}
+    for resource in resources:
         set_progress(f"Teardown CFT plugin running for resource: {resource}")
         try:
             cft_env_id, cft_stack_id = get_ids(resource)
         except Exception as err:
-            msg = f"Environment or Stack ID could not be found, assuming " \
-                  f"stack creation never completed. Exiting. Error: {err}"
-            return "WARNING", msg, ""
-        env = Environment.objects.get(id=cft_env_id)
-
-        # Delete Resources
-        try:
-            delete_cft_stack(cft_stack_id, env)
-        except Exception as err:
-            set_progress("CloudFormation Stack deletion failed.")
-            return "FAILURE", "", err
-
+            set_progress(
+                f"Environment or Stack ID could not be found for {resource}, "
+                f"assuming stack creation never completed. Error: {err}"
+            )
+            continue
+        if cft_env_id not in clients:
+            env = Environment.objects.get(id=cft_env_id)
+            clients[cft_env_id] = get_cloudformation_client(env)
+        stacks[cft_stack_id] = {
+            "resource": resource,
+            "client": clients[cft_env_id],
+        }
+
+    if not stacks:
+        msg = "Environment or Stack ID could not be found, assuming stack " \
+              "creation never completed. Exiting."
+        return "WARNING", msg, ""
+
+    # Delete Resources
+    try:
+        failed = delete_cft_stacks(stacks)
+    except Exception as err:
+        set_progress("CloudFormation Stack deletion failed.")
+        return "FAILURE", "", err
+
+    for stack_id, stack in stacks.items():
+        if stack_id in failed:
+            continue
         # Set CB Server Records to HISTORICAL. This action has already deleted
         # the Virtual Machines themselves
-        for server in resource.server_set.all():
-            set_progress(f"Deleting CB Server record for: {server.hostname}")
-            server.status = 'HISTORICAL'
-            server.save()
-        return "SUCCESS", "All resources successfully deleted", ""
+        servers = stack["resource"].server_set.all()
+        for hostname in servers.values_list("hostname", flat=True):
+            set_progress(f"Deleting CB Server record for: {hostname}")
+        servers.update(status="HISTORICAL")
 
-    else:
-        set_progress("Resource was not found")
-        return "SUCCESS", "Resource was not found", ""
+    if failed:
+        set_progress("CloudFormation Stack deletion failed.")
+        errors = " ".join(f"{stack_id}: {error}"
+                          for stack_id, error in failed.items())
+        return "FAILURE", "", errors
+    return "SUCCESS", "All resources successfully deleted", ""
 
 
-def delete_cft_stack(cft_stack_id, env):
+def get_cloudformation_client(env):
     # Instantiate AWS Resource Client
     rh: AWSHandler = env.resource_handler.cast()
     wrapper = rh.get_api_wrapper()
     region = env.aws_region
-
-    set_progress(
-        f"Deleting AWS CloudFormation Stack with ID: " f"{cft_stack_id}"
-    )
-    client = wrapper.get_boto3_client(
+    return wrapper.get_boto3_client(
         "cloudformation", rh.serviceaccount, rh.servicepasswd, region
     )
-    client.delete_stack(StackName=cft_stack_id)
-    wait_for_stack_deletion(client, cft_stack_id)
-
-
-def wait_for_stack_deletion(client, stack_id):
-    response = client.describe_stacks(StackName=stack_id)
-    stack = response["Stacks"][0]
-    # wait for stack to be created. Check status every minutes
-    while stack["StackStatus"] == "DELETE_IN_PROGRESS":
-        set_progress(f'status of {stack_id}: "{stack["StackStatus"]}"')
-        time.sleep(15)
-        response = client.describe_stacks(StackName=stack_id)
-        stack = response["Stacks"][0]
-
-    if stack["StackStatus"] == "DELETE_COMPLETE":
-        set_progress("Stack deletion was successful")
-        return stack
-    else:
-        events = client.describe_stack_events(StackName=stack_id)
-        logger.debug(events)
-        error_msg = ""
-        i = 1
-        for event in events["StackEvents"]:
-            if event["ResourceStatus"] == "DELETE_FAILED":
-                error_msg += f'Error {i}: {event["ResourceStatusReason"]} '
-                i += 1
-        set_progress(f'ERROR: {error_msg}')
-        raise Exception(error_msg)
 
+
+def delete_cft_stacks(stacks):
+    """
+    Delete the stacks passed in dependency order, concurrently where possible.
+    Returns a dict of stack ID -> error for the stacks that were not deleted.
+    """
+    dependents = get_stack_dependents(stacks)
+    remaining = set(stacks)
+    deleted = set()
+    failed = {}
+    with ThreadPoolExecutor(max_workers=20) as pool:
+        while remaining:
+            for stack_id in list(remaining):
+                if dependents[stack_id] & failed.keys():
+                    failed[stack_id] = "A stack importing its exports could " \
+                                       "not be deleted"
+                    remaining.remove(stack_id)
+            # A stack can be deleted once every stack importing its exports
+            # has been deleted
+            wave = [stack_id for stack_id in remaining
+                    if dependents[stack_id] <= deleted]
+            if not wave:
+                for stack_id in remaining:
+                    failed[stack_id] = "Circular export/import dependency " \
+                                       "between stacks"
+                break
+
+            futures = {}
+            for stack_id in wave:
+                set_progress(f"Deleting AWS CloudFormation Stack with ID: "
+                             f"{stack_id}")
+                futures[stack_id] = pool.submit(
+                    stacks[stack_id]["client"].delete_stack,
+                    StackName=stack_id)
+            started = []
+            for stack_id, future in futures.items():
+                try:
+                    future.result()
+                    started.append(stack_id)
+                except Exception as err:
+                    set_progress(f"ERROR: {stack_id}: {err}")
+                    failed[stack_id] = str(err)
+                    remaining.remove(stack_id)
+            for stack_id, error in wait_for_stacks_deletion(stacks,
+                                                            started).items():
+                remaining.remove(stack_id)
+                if error is None:
+                    deleted.add(stack_id)
+                else:
+                    failed[stack_id] = error
+    return failed
+
+
+def get_stack_dependents(stacks):
+    """
+    Return a dict of stack ID -> set of the IDs of stacks (from those passed)
+    that import one of its exports, and so need to be deleted first
+    """
+    dependents = {stack_id: set() for stack_id in stacks}
+    # Exports can only be imported within the same account and region, stack
+    # IDs are ARNs: arn:aws:cloudformation:<region>:<account>:stack/<name>/..
+    stack_ids_by_name = {}
+    exports = {}
+    for stack_id, stack in stacks.items():
+        client = stack["client"]
+        description = client.describe_stacks(StackName=stack_id)["Stacks"][0]
+        key = (get_stack_location(stack_id), description["StackName"])
+        stack_ids_by_name[key] = stack_id
+        exports[stack_id] = [output["ExportName"] for output in
+                             description.get("Outputs", [])
+                             if output.get("ExportName")]
+
+    for stack_id, export_names in exports.items():
+        client = stacks[stack_id]["client"]
+        for export_name in export_names:
+            paginator = client.get_paginator("list_imports")
+            try:
+                for page in paginator.paginate(ExportName=export_name):
+                    for name in page["Imports"]:
+                        key = (get_stack_location(stack_id), name)
+                        importer = stack_ids_by_name.get(key)
+                        if importer:
+                            dependents[stack_id].add(importer)
+            except ClientError as err:
+                # Raised when the export is not imported by any stack
+                if "is not imported by any stack" not in str(err):
+                    raise
+                continue
+    return dependents
+
+
+def get_stack_location(stack_id):
+    # Returns the (region, account) portion of a stack ARN
+    return tuple(stack_id.split(":")[3:5])
+
+
+def wait_for_stacks_deletion(stacks, stack_ids):
+    """
+    Wait for the deletion of all of the stack IDs passed. Returns a dict of
+    stack ID -> error, where error is None for the deleted stacks
+    """
+    pending = set(stack_ids)
+    results = {}
+    while pending:
+        for stack_id in list(pending):
+            client = stacks[stack_id]["client"]
+            response = client.describe_stacks(StackName=stack_id)
+            status = response["Stacks"][0]["StackStatus"]
+            if status == "DELETE_IN_PROGRESS":
+                continue
+            pending.remove(stack_id)
+            if status == "DELETE_COMPLETE":
+                set_progress(f"Stack deletion was successful: {stack_id}")
+                results[stack_id] = None
+            else:
+                error_msg = get_stack_deletion_errors(client, stack_id)
+                set_progress(f'ERROR: {stack_id}: {error_msg}')
+                results[stack_id] = error_msg
+        if pending:
+            set_progress(f"Waiting on deletion of {len(pending)} stacks")
+            time.sleep(15)
+    return results
+
+
+def get_stack_deletion_errors(client, stack_id):
+    events = client.describe_stack_events(StackName=stack_id)
+    logger.debug(events)
+    error_msg = ""
+    i = 1
+    for event in events["StackEvents"]:
+        if event["ResourceStatus"] == "DELETE_FAILED":
+            error_msg += f'Error {i}: {event["ResourceStatusReason"]} '
+            i += 1
+    return error_msg
@@ -0,0 +1,78 @@
+"""
+Resource action for applying changes to a deployed AWS CloudFormation(CF)
+stack in place, using a CloudFormation change set.
+
+This action was created by the AWS CloudFormation UI Extension.
+
+The change set is built from the current parameters on the resource and the
+latest version of the template in source control (falling back to the template
+saved on the resource). The changes are written to the job progress before the
+change set is executed, only the affected stack resources are touched.
+
+Set the "Execute Change Set" action input to False to only review the changes.
+The change set is then left on the stack so that it can be executed from the
+AWS console.
+"""
+from common.methods import set_progress
+from infrastructure.models import Environment
+from utilities.logger import ThreadLogger
+from xui.cloud_formation.shared import get_high_level_parameters, \
+    save_cft_to_resource, fetch_parameters_for_cft_deployment, \
+    create_stack_change_set, get_change_set_diff, execute_stack_change_set, \
+    update_cb_resource, render_parameters, get_template_s3_client, \
+    get_deployable_template, redact_parameters, get_nested_cfts
+
+logger = ThreadLogger(__name__)
+
+
+def run(job, *args, **kwargs):
+    resource = kwargs.get("resource") or job.resource_set.first()
+    if not resource:
+        msg = "CloudBolt Resource object not found."
+        set_progress(msg)
+        return "FAILURE", msg, ""
+    stack_id = resource.cft_stack_id
+    if not stack_id:
+        return "FAILURE", "", "No CloudFormation Stack ID set on the resource"
+    execute = kwargs.get("execute_change_set", "{{ execute_change_set }}")
+    execute = str(execute).lower() not in ["false", "no", "0"]
+
+    set_progress(f"Starting update of CloudFormation stack for resource: "
+                 f"{resource}")
+    env = Environment.objects.get(id=resource.cft_env_id)
+    rh = env.resource_handler.cast()
+    resource = render_parameters(resource, env, job)
+    cft, _ = get_high_level_parameters(resource)
+    cft_prefix = f"cft_{resource.blueprint_id}_"
+    parameters, redacted = fetch_parameters_for_cft_deployment(resource,
+                                                               cft_prefix)
+    set_progress(f"Stack parameters: "
+                 f"{redact_parameters(parameters, redacted)}")
+    client = rh.get_boto3_client(
+        region_name=env.aws_region, service_name="cloudformation"
+    )
+    s3_client = get_template_s3_client(rh, env.aws_region)
+    try:
+        nested_cfts = get_nested_cfts(resource, cft)
+        deployable_cft = get_deployable_template(resource, cft, nested_cfts,
+                                                 s3_client)
+        change_set = create_stack_change_set(stack_id, deployable_cft,
+                                             parameters, resource, client,
+                                             s3_client)
+        if not change_set:
+            return "SUCCESS", "CloudFormation stack is already up to date", ""
+        diff = get_change_set_diff(change_set)
+        set_progress(f"Change set contains {len(diff)} resource changes:")
+        for line in diff:
+            set_progress(f"  {line}")
+        if not execute:
+            msg = f'Change set "{change_set["ChangeSetName"]}" created and ' \
+                  f'not executed'
+            return "SUCCESS", msg, ""
+        stack = execute_stack_change_set(client, change_set)
+        save_cft_to_resource(resource, cft, nested_cfts)
+        update_cb_resource(resource, stack, env, job, client, cft_prefix)
+        return "SUCCESS", "CloudFormation stack update complete", ""
+    except Exception as err:
+        msg = f'CloudFormation stack update failed: {err}'
+        return "FAILURE", "", msg
@@ -16,7 +16,7 @@ from xui.cloud_formation.shared import (
     generate_options_for_allowed_environments,
     create_resource_type,
     create_generated_options_action,
-    get_cft_from_source,
+    get_cfts_from_source,
     add_blueprint_label,
     create_blueprint_level_params,
     add_bp_items,
@@ -102,7 +102,8 @@ class NewBlueprintForm(C2Form):
         allowed_envs = self.cleaned_data.get("allowed_environments")
         rt_id = self.cleaned_data.get("resource_type")
 
-        template_json = get_cft_from_source(ci_id, cft_url)
+        nested_cfts = get_cfts_from_source(ci_id, cft_url)
+        template_json = nested_cfts.pop(cft_url)
         if id:
             blueprint = ServiceBlueprint.objects.get(id=id)
             blueprint.resource_type = ResourceType.objects.get(id=int(rt_id))
@@ -128,7 +129,8 @@ class NewBlueprintForm(C2Form):
             "generate_options_for_aws_specific_params.py",
         )
 
-        create_params(blueprint, template_json, aws_params_hook)
+        create_params(blueprint, template_json, aws_params_hook, cft_url,
+                      nested_cfts)
 
         return blueprint
 
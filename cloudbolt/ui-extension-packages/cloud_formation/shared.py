@@ -2,26 +2,42 @@
 Methods for the CloudFormation XUI that need to be used in different actions
 are stored in this module.
 """
+import copy
+import hashlib
 import json
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from functools import lru_cache
 
 import base64
 
 import html
 import requests
 import urllib.parse
+from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.template import Context, Template
 
+from accounts.models import Group
 from behavior_mapping.models import SequencedItem, CustomFieldMapping
-from cbhooks.models import CloudBoltHook, HookPoint, HookPointAction, \
-    OrchestrationHook
+from cbhooks.models import CloudBoltHook, HookInput, HookPoint, \
+    HookPointAction, OrchestrationHook, ResourceAction
 from common.methods import set_progress
 from infrastructure.models import Environment, CustomField, FieldDependency, \
     Namespace, Server
 from orders.models import CustomFieldValue
+from resourcehandlers.models import ResourceNetwork
 from resources.models import ResourceType
 from servicecatalog.models import RunCloudBoltHookServiceItem, \
     TearDownServiceItem
@@ -30,10 +46,56 @@ from utilities.events import add_server_event
 from utilities.exceptions import CloudBoltException, NotFoundException
 from utilities.logger import ThreadLogger
 from utilities.models import ConnectionInfo
-from utilities.run_command import execute_command
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 logger = ThreadLogger(__name__)
 
+# Pooled HTTP sessions, one per source control host
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+# CustomFieldValue column holding the value for each Parameter type
+CFV_VALUE_FIELDS = {
+    "STR": "str_value",
+    "INT": "int_value",
+    "BOOL": "boolean_value",
+    "CODE": "txt_value",
+}
+# Parsed template metadata only changes when the template body changes, so it
+# is cached against the hash of the template contents
+TEMPLATE_CACHE_TIMEOUT = 60 * 60 * 24
+INTRINSIC_FUNCTIONS = ["Ref", "Fn::Sub", "Fn::GetAtt"]
+# CloudFormation rejects inline TemplateBody values larger than this. Larger
+# templates must be staged in S3, configure the bucket with the
+# CFT_TEMPLATE_S3_BUCKET setting (and CFT_TEMPLATE_S3_ENDPOINT_URL to use an
+# S3 compatible service)
+TEMPLATE_BODY_MAX_BYTES = 51200
+# Templates found in the S3 bucket are remembered for this long before being
+# checked again with a HEAD request. Keep it below any lifecycle expiration on
+# the bucket, or set CFT_TEMPLATE_S3_CACHE_TIMEOUT to override it
+TEMPLATE_S3_CACHE_TIMEOUT = 60 * 60
+# Seconds the pre-signed TemplateURL passed to CloudFormation is valid for
+TEMPLATE_URL_EXPIRES = 60 * 60
+# Template bodies are stored once per version, as values of this field keyed
+# by the template hash. Resources reference their template by hash
+TEMPLATE_STORE_FIELD = "cft_template_store"
+# JSON dict of nested template URL -> template hash, on Blueprints and
+# resources, used to read nested templates back from the store
+NESTED_TEMPLATES_FIELD = "cft_nested_template_hashes"
+# (connect, read) timeouts for requests to source control
+SOURCE_CONTROL_TIMEOUT = (10, 60)
+SOURCE_CONTROL_MAX_WORKERS = 8
+SUB_VARIABLE_PATTERN = re.compile(r"\$\{([^!}][^}]*)\}")
+AWS_PARAM_OPTIONS_VERSION_KEY = "cft_aws_param_options_version"
+# Seconds to wait on a change set to be created, and on a stack update to
+# complete, before failing the job
+CHANGE_SET_TIMEOUT = 60 * 10
+STACK_UPDATE_TIMEOUT = 60 * 60
+
 
 def get_supported_conn_info_labels():
     # Returns a tuple of conn_info_types, label_queries, conn_info_queries
@@ -51,8 +113,11 @@ def get_supported_conn_info_labels():
 
 
 def get_conn_info_type(conn_info):
-    _, queries, _ = get_supported_conn_info_labels()
-    labels = conn_info.labels.filter(eval(queries))
+    # Filters in memory so that labels prefetched with the connection info
+    # (ex: for the library view) don't cost another query
+    conn_info_types, _, _ = get_supported_conn_info_labels()
+    labels = [label for label in conn_info.labels.all()
+              if label.name in conn_info_types]
     if len(labels) > 1:
         raise CloudBoltException(
             f"More than one valid label found on {conn_info} Connection."
@@ -61,7 +126,7 @@ def get_conn_info_type(conn_info):
         raise CloudBoltException(
             f"No valid source control labels found on conn info: {conn_info}."
         )
-    conn_info_type = labels.first().name
+    conn_info_type = labels[0].name
     logger.debug(
         f"Connection info: {conn_info.name} determined to be type of "
         f"{conn_info_type}"
@@ -115,64 +180,121 @@ def generate_options_for_allowed_environments(server=None, **kwargs):
     return options
 
 
-def create_param_name(param_prefix, bp_id):
-    return f"{param_prefix}_{bp_id}"
+def get_aws_param_options_cache_key(env_id, bp_id):
+    """
+    Cache key for the generated AWS specific parameter options of an
+    Environment and Blueprint. The key includes a version that is changed
+    whenever an Environment or Network (including its Groups) is saved,
+    invalidating all entries.
+
+    The signal receivers are only connected in processes that have imported
+    this module, so changes made elsewhere are picked up once the options
+    expire (see OPTIONS_CACHE_TIMEOUT in the options action).
+    """
+    version = cache.get_or_set(AWS_PARAM_OPTIONS_VERSION_KEY, time.time(),
+                               None)
+    return f"cft_aws_param_options:{version}:{env_id}:{bp_id}"
+
 
+def invalidate_aws_param_options(**kwargs):
+    cache.set(AWS_PARAM_OPTIONS_VERSION_KEY, time.time(), None)
 
-def create_custom_field_option(blueprint, value, field, cf_type):
+
+def get_network_groups_field():
     """
-    Create a CustomFieldValue for a Custom Field, then add that value to the
-    Blueprint level Parameter. This will check first to see if the value
-    already exists for that parameter on the blueprint, and if so, not re-add
-    to the Blueprint
+    Return the many to many relation between ResourceNetworks and Groups,
+    from whichever model defines it. This is only used to invalidate the
+    cached options when it changes, the options themselves are filtered with
+    network.get_groups(), which may not be based on this relation alone.
     """
-    logger.debug(
-        f"Creating Parameter: {field.name} option, type: {cf_type}," f" Value: {value}"
-    )
-    if cf_type == "STR":
-        cfv = CustomFieldValue.objects.get_or_create(str_value=value,
-                                                     field=field)[0]
-    elif cf_type == "INT":
-        cfv = CustomFieldValue.objects.get_or_create(int_value=value,
-                                                     field=field)[0]
-    elif cf_type == "BOOL":
-        cfv = CustomFieldValue.objects.get_or_create(boolean_value=value,
-                                                     field=field)[0]
-    elif cf_type == "CODE":
-        cfv = CustomFieldValue.objects.get_or_create(txt_value=value,
-                                                     field=field)[0]
+    for field in ResourceNetwork._meta.get_fields():
+        if field.many_to_many and field.related_model is Group:
+            return field
+    return None
+
+
+# Signals are sent with the concrete class as the sender, ex: AWSVPCSubnet,
+# so connect the receivers for every network model
+network_models = [model for model in apps.get_models()
+                  if issubclass(model, ResourceNetwork)]
+for model in [Environment] + network_models:
+    post_save.connect(invalidate_aws_param_options, sender=model,
+                      dispatch_uid=f"cft_aws_param_options_{model.__name__}")
+    post_delete.connect(invalidate_aws_param_options, sender=model,
+                        dispatch_uid=f"cft_aws_param_options_{model.__name__}")
+network_groups_field = get_network_groups_field()
+if network_groups_field is not None:
+    if network_groups_field.concrete:
+        network_groups_through = network_groups_field.remote_field.through
     else:
-        logger.warn(
-            f"Unknown Parameter type: {cf_type}, passed in, not "
-            f"creating custom field option for field: {field}"
-        )
-        return None
-    cfvs = blueprint.get_cfvs_for_custom_field(field.name)
-    if cfv not in cfvs:
-        # Don't want to re-add a value if it already exists on the BP
-        blueprint.custom_field_options.add(cfv.id)
-    return cfv
+        network_groups_through = network_groups_field.through
+    m2m_changed.connect(invalidate_aws_param_options,
+                        sender=network_groups_through,
+                        dispatch_uid="cft_aws_param_options_network_groups")
+
+
+def create_param_name(param_prefix, bp_id):
+    return f"{param_prefix}_{bp_id}"
 
 
 def add_cfvs_for_field(blueprint, cf, cf_type, new_values: list):
     """
     Add new values to the blueprint for a field, remove CFVs that are not in
-    new_values
+    new_values. Existing CFVs are fetched once, missing CFVs are bulk created
+    and the blueprint options are updated with a single add and remove.
     """
-    existing_cfvs = blueprint.custom_field_options.filter(field__id=cf.id)
-    new_cfvs = []
-    for value in new_values:
-        cfv = create_custom_field_option(blueprint, value, cf, cf_type)
-        if cfv:
-            new_cfvs.append(cfv)
-    remove_old_cfvs(blueprint, existing_cfvs, new_cfvs)
-
-
-def remove_old_cfvs(blueprint, existing_cfvs, new_cfvs):
-    for cfv in existing_cfvs:
-        if cfv not in new_cfvs:
-            logger.debug(f'Removing CustomFieldValue: {cfv} from options')
-            blueprint.custom_field_options.remove(cfv)
+    value_field = CFV_VALUE_FIELDS.get(cf_type)
+    if not value_field:
+        logger.warn(
+            f"Unknown Parameter type: {cf_type}, passed in, not "
+            f"creating custom field options for field: {cf}"
+        )
+        new_values = []
+    else:
+        model_field = CustomFieldValue._meta.get_field(value_field)
+        new_values = list(dict.fromkeys(
+            model_field.to_python(value) for value in new_values
+        ))
+
+    with transaction.atomic():
+        cfvs_by_value = {}
+        if new_values:
+            cfvs_by_value = get_cfvs_by_value(cf, value_field, new_values)
+            missing = [v for v in new_values if v not in cfvs_by_value]
+            if missing:
+                logger.debug(f"Creating {len(missing)} options for Parameter: "
+                             f"{cf.name}, type: {cf_type}")
+                CustomFieldValue.objects.bulk_create([
+                    CustomFieldValue(field=cf, **{value_field: value})
+                    for value in missing
+                ])
+                # bulk_create does not return primary keys on all databases,
+                # so read the new rows back
+                cfvs_by_value.update(get_cfvs_by_value(cf, value_field,
+                                                       missing))
+
+        new_ids = set(cfvs_by_value.values())
+        existing_ids = set(blueprint.custom_field_options.filter(
+            field__id=cf.id).values_list("id", flat=True))
+        to_add = new_ids - existing_ids
+        to_remove = existing_ids - new_ids
+        if to_add:
+            blueprint.custom_field_options.add(*to_add)
+        if to_remove:
+            logger.debug(f"Removing CustomFieldValues: {to_remove} from "
+                         f"options")
+            blueprint.custom_field_options.remove(*to_remove)
+
+
+def get_cfvs_by_value(cf, value_field, values):
+    # Returns a dict of value -> CustomFieldValue ID for the values passed
+    cfvs = CustomFieldValue.objects.filter(
+        field=cf, **{f"{value_field}__in": values}
+    ).order_by("id").values_list(value_field, "id")
+    cfvs_by_value = {}
+    for value, cfv_id in cfvs:
+        cfvs_by_value.setdefault(value, cfv_id)
+    return cfvs_by_value
 
 
 def create_cf(
@@ -184,7 +306,10 @@ def create_cf(
         required=True,
         **kwargs,
 ):
-    namespace, _ = Namespace.objects.get_or_create(name="aws_cloudformation")
+    # Callers creating many fields can pass in the namespace to reuse it
+    namespace = kwargs.pop("namespace", None)
+    if namespace is None:
+        namespace = get_cft_namespace()
 
     # You can pass in show_on_servers, show_as_attribute as kwargs
     defaults = {
@@ -203,6 +328,11 @@ def create_cf(
     return cf
 
 
+def get_cft_namespace():
+    namespace, _ = Namespace.objects.get_or_create(name="aws_cloudformation")
+    return namespace
+
+
 def create_cloudbolt_hook(new_action_name, source_file):
     root_dir = "/var/opt/cloudbolt/proserv/xui/cloud_formation/actions/"
     hook, hook_created = CloudBoltHook.objects.get_or_create(
@@ -259,19 +389,174 @@ def camel_case_split(string):
 
 
 def get_cft_from_source(connection_info_id, url):
+    conn_info, fetcher = get_template_fetcher(connection_info_id)
+    cft = fetcher(conn_info, url)
+    if not cft:
+        raise Exception(
+            f"CFT could not be found for conn_info: {conn_info}, and "
+            f"URL: {url}")
+    return cft
+
+
+def get_template_fetcher(connection_info_id):
+    # Returns the connection info and the function used to fetch templates
+    # with it
     if int(connection_info_id) != 0:
         conn_info = ConnectionInfo.objects.get(id=connection_info_id)
         conn_info_type = get_conn_info_type(conn_info)
     else:
         conn_info = None
         conn_info_type = 'public'
-    function_call = f'get_template_from_{conn_info_type}(conn_info, url)'
-    cft = eval(function_call)
-    if not cft:
-        raise Exception(
-            f"CFT could not be found for conn_info: {conn_info}, and "
-            f"URL: {url}")
-    return cft
+    try:
+        return conn_info, TEMPLATE_FETCHERS[conn_info_type]
+    except KeyError:
+        raise CloudBoltException(
+            f"Unsupported source control type: {conn_info_type}")
+
+
+def get_cfts_from_source(connection_info_id, url, cft=None):
+    """
+    Fetch the template at url and every nested stack template it references
+    (recursively). Each level of nested templates is fetched concurrently.
+    The root template can be passed as cft if it was already fetched.
+    Returns a dict of URL -> template, starting with the root template.
+    """
+    conn_info, fetcher = get_template_fetcher(connection_info_id)
+    cfts = {}
+    urls = [url]
+    if cft:
+        cfts[url] = cft
+    with ThreadPoolExecutor(max_workers=SOURCE_CONTROL_MAX_WORKERS) as pool:
+        while urls:
+            to_fetch = [u for u in urls if u not in cfts]
+            for template_url, cft in zip(to_fetch, pool.map(
+                    lambda u: fetcher(conn_info, u), to_fetch)):
+                if not cft:
+                    raise Exception(
+                        f"CFT could not be found for conn_info: {conn_info}, "
+                        f"and URL: {template_url}")
+                cfts[template_url] = cft
+            nested_urls = []
+            for template_url in urls:
+                template_content = get_template_content(cfts[template_url])
+                for nested_url in get_nested_template_urls(template_content):
+                    nested_url = urllib.parse.urljoin(template_url,
+                                                      nested_url)
+                    if nested_url not in cfts and nested_url not in nested_urls:
+                        nested_urls.append(nested_url)
+            urls = nested_urls
+    return cfts
+
+
+def get_nested_template_urls(template_content):
+    # Returns the TemplateURLs of the nested stacks in a template that need
+    # to be fetched from source control. URLs built with intrinsic functions
+    # can't be resolved before deployment, and templates already in S3 can be
+    # used as is, skip them
+    urls = []
+    resources = template_content.get("Resources") or {}
+    for resource in resources.values():
+        if resource.get("Type") != "AWS::CloudFormation::Stack":
+            continue
+        template_url = (resource.get("Properties") or {}).get("TemplateURL")
+        if isinstance(template_url, str) and not is_s3_url(template_url):
+            urls.append(template_url)
+    return urls
+
+
+def is_s3_url(url):
+    host = urllib.parse.urlparse(url).netloc
+    return host.endswith(".amazonaws.com") and (
+        host.startswith("s3") or ".s3" in host)
+
+
+def get_nested_cfts(resource, cft):
+    """
+    Return a dict of URL -> template for the nested stack templates of cft.
+    They are fetched from source control, falling back to the versions stored
+    for the resource (or its Blueprint) when source control can't be reached.
+    """
+    if not get_nested_template_urls(get_template_content(cft)):
+        return {}
+    cft_url = resource.cft_url
+    try:
+        cfts = get_cfts_from_source(resource.cft_conn_info_id, cft_url,
+                                    cft=cft)
+    except Exception as err:
+        logger.warn(f"Unable to get nested templates from source control, "
+                    f"using the stored versions. Error: {err}")
+        cfts = get_stored_nested_cfts(resource)
+    cfts.pop(cft_url, None)
+    return cfts
+
+
+def get_deployable_template(resource, cft, nested_cfts, s3_client=None):
+    """
+    Return the template to submit to CloudFormation. The nested stack
+    templates (see get_nested_cfts) are staged in S3 and their TemplateURLs
+    rewritten to the staged copies, as CloudFormation requires.
+    """
+    if not nested_cfts:
+        return cft
+    if s3_client is None:
+        raise CloudBoltException(
+            "Nested stack templates must be staged in S3, set "
+            "CFT_TEMPLATE_S3_BUCKET to deploy this template."
+        )
+    cft_url = resource.cft_url
+    cfts = {cft_url: cft}
+    cfts.update(nested_cfts)
+    return package_nested_templates(cfts, cft_url, s3_client)
+
+
+def package_nested_templates(cfts, url, s3_client):
+    # Stage the nested templates of the template at url (deepest first), and
+    # return the template with its TemplateURLs pointing at the staged copies
+    template_content = get_template_content(cfts[url])
+    if not get_nested_template_urls(template_content):
+        return cfts[url]
+    template_content = copy.deepcopy(template_content)
+    for resource in template_content["Resources"].values():
+        if resource.get("Type") != "AWS::CloudFormation::Stack":
+            continue
+        properties = resource.get("Properties") or {}
+        template_url = properties.get("TemplateURL")
+        if not isinstance(template_url, str) or is_s3_url(template_url):
+            continue
+        nested_url = urllib.parse.urljoin(url, template_url)
+        if nested_url not in cfts:
+            raise CloudBoltException(
+                f"Nested stack template not found in source control or in "
+                f"the template store: {nested_url}")
+        nested_cft = package_nested_templates(cfts, nested_url, s3_client)
+        properties["TemplateURL"] = get_template_args(
+            nested_cft, s3_client)["TemplateURL"]
+    return json.dumps(template_content)
+
+
+def get_http_session(url):
+    """
+    Return the pooled requests Session for the host of the url. Sessions
+    retry connection errors and throttling/server errors with a backoff.
+    """
+    host = urllib.parse.urlparse(url).netloc
+    with _http_sessions_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            retry = Retry(total=3, backoff_factor=0.5,
+                          status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_maxsize=SOURCE_CONTROL_MAX_WORKERS,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[host] = session
+    return session
+
+
+def http_get(url, **kwargs):
+    kwargs.setdefault("timeout", SOURCE_CONTROL_TIMEOUT)
+    return get_http_session(url).get(url, **kwargs)
 
 
 def get_template_from_azure_devops(conn_info, url):
@@ -288,7 +573,7 @@ def get_template_from_azure_devops(conn_info, url):
     user_pass = f'{username}:{token}'
     b64 = base64.b64encode(user_pass.encode()).decode()
     headers = {"Authorization": f"Basic {b64}"}
-    response = requests.get(raw_url, headers=headers)
+    response = http_get(raw_url, headers=headers)
     response.raise_for_status()
     r_json = response.json()
     arm_template = json.dumps(r_json)
@@ -340,7 +625,7 @@ def get_template_from_public(conn_info, url):
         raise CloudBoltException(f'URL entered was not in raw format, please '
                                  f're-submit request using a raw formatted '
                                  f'URL')
-    response = requests.get(url)
+    response = http_get(url)
     response.raise_for_status()
     return response.content.decode("utf-8")
 
@@ -363,7 +648,7 @@ def get_template_from_gitlab(conn_info, url):
         "Content-Type": "application/json",
     }
     request_url = f"{base_url}{path}"
-    r = requests.get(request_url, auth=None, headers=headers)
+    r = http_get(request_url, auth=None, headers=headers)
     r.raise_for_status()
     r_json = r.json()
     raw_file_json = json.dumps(r_json)
@@ -393,7 +678,7 @@ def get_template_from_github(conn_info, cft_url):
         f"https://api.github.com/repos/{username}/{repo}/contents/"
         f"{file_path}?ref={branch}"
     )
-    response = requests.get(git_url, headers=headers)
+    response = http_get(git_url, headers=headers)
     response.raise_for_status()
     data = response.json()
     content = data["content"]
@@ -403,6 +688,14 @@ def get_template_from_github(conn_info, cft_url):
     return content
 
 
+TEMPLATE_FETCHERS = {
+    "public": get_template_from_public,
+    "github": get_template_from_github,
+    "gitlab": get_template_from_gitlab,
+    "azure_devops": get_template_from_azure_devops,
+}
+
+
 def add_blueprint_label(blueprint):
     # Create Label if it doesn't exist
     label = CloudBoltTag.objects.get_or_create(
@@ -441,14 +734,7 @@ def create_blueprint_level_params(
         blueprint, template_json, cft_url, allowed_environments, conn_info_id
 ):
     # Save Cloud Formation Template
-    create_cf_bp_options(
-        "cloud_formation_template",
-        "CloudFormation Template",
-        "CloudFormation Template Contents",
-        blueprint,
-        [template_json],
-        cf_type="CODE",
-    )
+    save_cft_to_blueprint(blueprint, template_json)
 
     # Save Allowed Environments
     env_ids = ",".join(allowed_environments)
@@ -565,6 +851,9 @@ def add_bp_items(blueprint):
         run_on_scale_up=False,
     )
 
+    # Add the Update action, to apply changes to deployed stacks in place
+    add_update_action(blueprint)
+
     # Add Teardown Item
     hook = create_cloudbolt_hook("Cloud Formation Teardown", "teardown_cft.py")
     oh, _ = OrchestrationHook.objects.get_or_create(
@@ -576,43 +865,118 @@ def add_bp_items(blueprint):
     )
 
 
-def create_params(blueprint, template_json, aws_params_hook=None):
-    # import cfn_tools. If it's not installed, install it and import it.
+def add_update_action(blueprint):
+    """
+    Attach the Cloud Formation Update action to the blueprint as a Resource
+    Action, with the "Execute Change Set" action input
+    """
+    hook = create_cloudbolt_hook("Cloud Formation Update", "update_cft.py")
+    execute_input, _ = HookInput.objects.get_or_create(
+        name="execute_change_set",
+        defaults={
+            "label": "Execute Change Set",
+            "type": "BOOL",
+            "description": "Uncheck to only create the change set for review, "
+                           "without applying it to the stack",
+            "required": False,
+        },
+    )
+    hook.input_fields.add(execute_input)
+    # One action per resource type, as blueprints can build different types
+    action, _ = ResourceAction.objects.get_or_create(
+        name="Cloud Formation Update", hook=hook,
+        resource_type=blueprint.resource_type,
+    )
+    blueprint.management_actions.add(action)
+    return action
+
+
+def create_params(blueprint, template_json, aws_params_hook=None,
+                  cft_url=None, nested_cfts=None):
+    """
+    Create the Blueprint parameters for the template's Parameters.
+    nested_cfts is an optional dict of URL -> template for the nested stack
+    templates (see get_cfts_from_source). Parameters that are passed down to
+    nested stacks get the AWS specific options of the nested parameter.
+    """
     bp_id = blueprint.id
     template_content = get_template_content(template_json)
     template_params = template_content.get("Parameters", None)
+    cfts = {cft_url: template_json}
+    if nested_cfts:
+        cfts.update(nested_cfts)
+    cf = create_nested_templates_cf()
+    add_cfvs_for_field(blueprint, cf, "CODE",
+                       [store_nested_cfts(nested_cfts or {})])
+    param_graph = build_parameter_graph(cfts)
     if template_params:
         param_prefix = f"cft_{bp_id}_"
         for key in template_params.keys():
-            is_aws_param, param_type = check_aws_param(key, template_content,
-                                           template_params)
+            is_aws_param, param_type = resolve_param_type(cfts, cft_url, key,
+                                                          param_graph)
             set_progress(f'is_aws_param: {is_aws_param}, key: {key}')
             create_param(key, template_params, param_prefix, blueprint,
                          param_type, aws_params_hook, is_aws_param)
 
 
 def get_template_content(template_json):
+    """
+    Parse a JSON or YAML CloudFormation template into plain dicts. Parsed
+    templates are cached against the hash of the template contents.
+    """
+    cache_key = f"cft_template_content:{get_template_hash(template_json)}"
+    template_content = cache.get(cache_key)
+    if template_content is not None:
+        return template_content
     try:
         template_content = json.loads(template_json)
     except json.decoder.JSONDecodeError:
+        if yaml is None:
+            raise CloudBoltException(
+                "PyYAML is required to parse YAML CloudFormation templates."
+            )
         try:
-            import cfn_tools
-        except ImportError or ModuleNotFoundError:
-            set_progress("Installing CFN Tools")
-            execute_command("pip install cfn_flip")
-            import cfn_tools
-        try:
-            temp_data = cfn_tools.load_yaml(template_json)
-            template_content = json.loads(
-                json.dumps(temp_data)
-            )  # converts the OrderedDict output by cfn-tools into a standard dict
-        except:
+            template_content = yaml.load(template_json, Loader=CFNYamlLoader)
+        except yaml.YAMLError:
             set_progress(
                 "Could not Parse template, verify it is valid Yaml or JSON.")
             raise
+    cache.set(cache_key, template_content, TEMPLATE_CACHE_TIMEOUT)
     return template_content
 
 
+if yaml is not None:
+    class CFNYamlLoader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+        """
+        Safe YAML loader (libyaml backed when available) that understands the
+        CloudFormation short form intrinsic function tags, ex: !Ref, !GetAtt,
+        !Sub, and converts them to their long form JSON equivalents.
+        """
+        pass
+
+    def construct_cfn_tag(loader, tag_suffix, node):
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        if tag_suffix in ["Ref", "Condition"]:
+            return {tag_suffix: value}
+        if tag_suffix == "GetAtt" and isinstance(value, str):
+            value = value.split(".", 1)
+        return {f"Fn::{tag_suffix}": value}
+
+    def construct_yaml_str(loader, node):
+        # Keep values like AWSTemplateFormatVersion: 2010-09-09 as strings,
+        # matching the JSON form of the template
+        return loader.construct_scalar(node)
+
+    CFNYamlLoader.add_multi_constructor("!", construct_cfn_tag)
+    CFNYamlLoader.add_constructor("tag:yaml.org,2002:timestamp",
+                                  construct_yaml_str)
+
+
 def create_param(key, template_params, param_prefix, blueprint,
                  param_type, aws_params_hook=None, is_aws_param=False):
     param = template_params[key]
@@ -692,7 +1056,7 @@ def create_param(key, template_params, param_prefix, blueprint,
         SequencedItem.objects.get_or_create(custom_field=cf)
 
 
-def check_aws_param(param_key, template_content, template_params):
+def check_aws_param(param_key, template_params, analysis):
     # Will look for params matching values in the list and add gen options
     valid_aws_params = [
         "AWS::EC2::Subnet::Id",
@@ -706,19 +1070,172 @@ def check_aws_param(param_key, template_content, template_params):
     valid_non_aws_params = [
         "InstanceType",
     ]
-    resources = template_content["Resources"]
-    for key in resources.keys():
-        resource = resources[key]
-        if resource["Type"] == "AWS::EC2::Instance":
-            for value in valid_non_aws_params:
-                resource_instance_type = resource["Properties"].get(value)
-                if resource_instance_type:
-                    ref = resource_instance_type.get("Ref")
-                    if ref == param_key:
-                        return True, value
+    for ref in analysis["param_refs"].get(param_key, []):
+        if (
+            ref["function"] == "Ref"
+            and ref["resource_type"] == "AWS::EC2::Instance"
+            and ref["property"] in valid_non_aws_params
+        ):
+            return True, ref["property"]
     return False, param_type
 
 
+def build_parameter_graph(cfts):
+    """
+    Build the graph of parameters passed from parent templates to their
+    nested stacks. Takes a dict of URL -> template and returns a dict of
+    (template URL, parameter) -> list of (nested template URL, parameter)
+    """
+    graph = {}
+    for url, cft in cfts.items():
+        template_content = get_template_content(cft)
+        params = template_content.get("Parameters") or {}
+        resources = template_content.get("Resources") or {}
+        for resource in resources.values():
+            if resource.get("Type") != "AWS::CloudFormation::Stack":
+                continue
+            properties = resource.get("Properties") or {}
+            template_url = properties.get("TemplateURL")
+            if not isinstance(template_url, str):
+                continue
+            nested_url = urllib.parse.urljoin(url or "", template_url)
+            nested_params = properties.get("Parameters") or {}
+            for nested_key, value in nested_params.items():
+                if not isinstance(value, dict):
+                    continue
+                for function, args in value.items():
+                    for name in get_referenced_names(function, args):
+                        if name in params:
+                            graph.setdefault((url, name), []).append(
+                                (nested_url, nested_key))
+    return graph
+
+
+def resolve_param_type(cfts, url, param_key, param_graph, seen=None):
+    """
+    Returns check_aws_param for the parameter. If the parameter is not AWS
+    specific in its own template, follow it down to the nested stack
+    parameters it is passed to.
+    """
+    template_json = cfts[url]
+    template_content = get_template_content(template_json)
+    template_params = template_content["Parameters"]
+    analysis = get_template_analysis(template_json, template_content)
+    is_aws_param, param_type = check_aws_param(param_key, template_params,
+                                               analysis)
+    if is_aws_param:
+        return is_aws_param, param_type
+    seen = seen or set()
+    seen.add((url, param_key))
+    for nested in param_graph.get((url, param_key), []):
+        if nested in seen or nested[0] not in cfts:
+            continue
+        nested_content = get_template_content(cfts[nested[0]])
+        if nested[1] not in (nested_content.get("Parameters") or {}):
+            continue
+        nested_is_aws, nested_type = resolve_param_type(
+            cfts, nested[0], nested[1], param_graph, seen)
+        if nested_is_aws:
+            return nested_is_aws, nested_type
+    return is_aws_param, param_type
+
+
+def get_template_hash(template_json):
+    return hashlib.sha256(template_json.encode("utf-8")).hexdigest()
+
+
+def get_template_analysis(template_json, template_content=None):
+    """
+    Return the analysis of a template (see analyze_template), cached against
+    the hash of the template contents so that re-syncing an unchanged template
+    does not walk it again.
+    """
+    cache_key = f"cft_template_analysis:{get_template_hash(template_json)}"
+    analysis = cache.get(cache_key)
+    if analysis is None:
+        if template_content is None:
+            template_content = get_template_content(template_json)
+        analysis = analyze_template(template_content)
+        cache.set(cache_key, analysis, TEMPLATE_CACHE_TIMEOUT)
+    return analysis
+
+
+def analyze_template(template_content):
+    """
+    Walk the Resources of a parsed template once and build indexes:
+    - param_refs: parameter name -> list of references to that parameter
+    - resource_types: resource type -> list of resource logical IDs
+    - intrinsics: intrinsic function name -> list of usages
+    Each reference/usage is a dict with the resource logical ID, the resource
+    type, the property path within the resource Properties (dot separated)
+    and the intrinsic function used.
+    """
+    params = template_content.get("Parameters") or {}
+    analysis = {
+        "param_refs": {},
+        "resource_types": {},
+        "intrinsics": {function: [] for function in INTRINSIC_FUNCTIONS},
+    }
+    resources = template_content.get("Resources") or {}
+    for logical_id, resource in resources.items():
+        resource_type = resource.get("Type")
+        analysis["resource_types"].setdefault(resource_type, []).append(
+            logical_id)
+        properties = resource.get("Properties") or {}
+        for key, value in properties.items():
+            index_template_value(analysis, params, logical_id, resource_type,
+                                 key, value)
+    return analysis
+
+
+def index_template_value(analysis, params, logical_id, resource_type, path,
+                         value):
+    if isinstance(value, list):
+        for i, item in enumerate(value):
+            index_template_value(analysis, params, logical_id, resource_type,
+                                 f"{path}.{i}", item)
+        return
+    if not isinstance(value, dict):
+        return
+    for key, item in value.items():
+        if key in INTRINSIC_FUNCTIONS:
+            usage = {
+                "resource": logical_id,
+                "resource_type": resource_type,
+                "property": path,
+                "function": key,
+            }
+            analysis["intrinsics"][key].append(usage)
+            for name in get_referenced_names(key, item):
+                if name in params:
+                    analysis["param_refs"].setdefault(name, []).append(usage)
+        index_template_value(analysis, params, logical_id, resource_type,
+                             path if key in INTRINSIC_FUNCTIONS
+                             else f"{path}.{key}", item)
+
+
+def get_referenced_names(function, value):
+    # Returns the logical names referenced by an intrinsic function call
+    if function == "Ref":
+        return [value] if isinstance(value, str) else []
+    if function == "Fn::Sub":
+        sub_string = value[0] if isinstance(value, list) and value else value
+        if not isinstance(sub_string, str):
+            return []
+        names = SUB_VARIABLE_PATTERN.findall(sub_string)
+        if isinstance(value, list) and len(value) > 1 and \
+                isinstance(value[1], dict):
+            # Variables mapped in the Sub do not reference parameters
+            names = [name for name in names if name not in value[1]]
+        return [name for name in names if "." not in name]
+    if function == "Fn::GetAtt":
+        if isinstance(value, list) and value:
+            return [value[0]]
+        if isinstance(value, str):
+            return [value.split(".")[0]]
+    return []
+
+
 def add_param_values(blueprint, cf, cf_type, template_params, key,
                      cf_created: False):
     # Create Add value from parameters file as selection in dropdown
@@ -818,10 +1335,42 @@ def get_high_level_parameters(resource):
             f"Unable to connect to source control to get latest "
             f"version. Using original CFT."
         )
-        cft = resource.get_cfv_for_custom_field("cloud_formation_template").value
+        cft = get_resource_template(resource)
     return cft, stack_name
 
 
+def get_resource_template(resource):
+    """
+    Return the template last deployed for the resource: the stored template
+    referenced by the resource's template hash, falling back to a template
+    copied onto the resource by earlier versions of this XUI, then to the
+    latest template saved on the Blueprint.
+    """
+    cfv = resource.get_cfv_for_custom_field("cft_template_hash")
+    if cfv and cfv.value:
+        cft = get_stored_template(cfv.value)
+        if cft:
+            return cft
+    cfv = resource.get_cfv_for_custom_field("cloud_formation_template")
+    if cfv and cfv.value:
+        return cfv.value
+    blueprint = resource.blueprint
+    if blueprint:
+        cfv = blueprint.get_cfvs_for_custom_field("cft_template_hash").first()
+        if cfv and cfv.value:
+            cft = get_stored_template(cfv.value)
+            if cft:
+                return cft
+        # Blueprints saved by earlier versions hold the template itself
+        cfv = blueprint.get_cfvs_for_custom_field(
+            "cloud_formation_template").first()
+        if cfv and cfv.value:
+            return cfv.value
+    raise CloudBoltException(
+        f"No CloudFormation Template found for resource: {resource}"
+    )
+
+
 def fetch_parameters_for_cft_deployment(resource, cft_prefix):
     """
     Get & return the parameters to pass to the AWS job to deploy the CF
@@ -830,21 +1379,39 @@ def fetch_parameters_for_cft_deployment(resource, cft_prefix):
     inputs for the CF template deployment.
     Look for these parameters on the Resource object, where the deploy BP job
     in CB created them.
+    Returns the list of parameters, and a redaction mask: the set of
+    ParameterKeys whose values are passwords and must not be logged.
     """
     parameters = []
+    redacted = set()
     cfvs = resource.get_cf_values_as_dict()
+    cf_types = dict(CustomField.objects.filter(
+        name__startswith=cft_prefix).values_list("name", "type"))
     for key in cfvs.keys():
         if key.find(cft_prefix) == 0:
             param_key = key.replace(cft_prefix, "")
             param_key = replace_cft_types_in_key(param_key)
             value = cfvs[key]
             parameters.append({"ParameterKey": param_key, "ParameterValue": value})
-            cf = CustomField.objects.get(name=key)
-            if cf.type == "PWD":
+            if cf_types.get(key) == "PWD":
+                redacted.add(param_key)
                 logger.debug(f"Setting password: {param_key} to: ******")
             else:
                 logger.debug(f"Setting param: {param_key} to: {value}")
-    return parameters
+    return parameters, redacted
+
+
+def redact_parameters(parameters, redacted):
+    """
+    Return the parameters as a string safe to write to the job progress, the
+    values of the ParameterKeys in the redaction mask are replaced
+    """
+    values = []
+    for param in parameters:
+        key = param["ParameterKey"]
+        value = "******" if key in redacted else param["ParameterValue"]
+        values.append(f"{key}: {value}")
+    return ", ".join(values)
 
 
 def replace_cft_types_in_key(param_key):
@@ -854,7 +1421,8 @@ def replace_cft_types_in_key(param_key):
     return param_key
 
 
-def submit_template_request(stack_name, cft, parameters, resource, client):
+def submit_template_request(stack_name, cft, parameters, resource, client,
+                            s3_client=None):
     """
     return stack dict if successful; raises exception on failure
     """
@@ -875,11 +1443,11 @@ def submit_template_request(stack_name, cft, parameters, resource, client):
             capabilities = []
         response = client.create_stack(
             StackName=stack_name,
-            TemplateBody=cft,
             Parameters=parameters,
             TimeoutInMinutes=timeout,
             OnFailure=resource.cft_fail_behavior,
             Capabilities=capabilities,
+            **get_template_args(cft, s3_client),
         )
         stack_id = response["StackId"]
         set_progress(f'Created StackId: {stack_id}')
@@ -890,6 +1458,61 @@ def submit_template_request(stack_name, cft, parameters, resource, client):
         raise err
 
 
+def get_template_s3_client(rh, region):
+    """
+    Return an S3 client for staging templates, or None if no bucket is
+    configured
+    """
+    if not getattr(settings, "CFT_TEMPLATE_S3_BUCKET", None):
+        return None
+    kwargs = {}
+    endpoint_url = getattr(settings, "CFT_TEMPLATE_S3_ENDPOINT_URL", None)
+    if endpoint_url:
+        kwargs["endpoint_url"] = endpoint_url
+    return rh.get_boto3_client(region_name=region, service_name="s3", **kwargs)
+
+
+def get_template_args(cft, s3_client=None):
+    """
+    Return the kwargs used to pass the template to CloudFormation. When an S3
+    bucket is configured the template is uploaded once per version (keyed by
+    the hash of its contents) and passed as a pre-signed TemplateURL,
+    otherwise it is passed inline as the TemplateBody.
+    """
+    bucket = getattr(settings, "CFT_TEMPLATE_S3_BUCKET", None)
+    if not bucket or s3_client is None:
+        if len(cft.encode("utf-8")) > TEMPLATE_BODY_MAX_BYTES:
+            raise CloudBoltException(
+                f"The CloudFormation Template is larger than "
+                f"{TEMPLATE_BODY_MAX_BYTES} bytes, set CFT_TEMPLATE_S3_BUCKET "
+                f"to stage templates in S3."
+            )
+        return {"TemplateBody": cft}
+
+    key = f"cloudbolt/cloud_formation/{get_template_hash(cft)}.template"
+    cache_key = f"cft_template_s3:{bucket}:{key}"
+    if not cache.get(cache_key):
+        try:
+            s3_client.head_object(Bucket=bucket, Key=key)
+            logger.debug(f"Template already staged at s3://{bucket}/{key}")
+        except ClientError as err:
+            if err.response["Error"]["Code"] not in ["404", "NoSuchKey"]:
+                raise
+            set_progress(f"Uploading CloudFormation Template to "
+                         f"s3://{bucket}/{key}")
+            s3_client.put_object(Bucket=bucket, Key=key,
+                                 Body=cft.encode("utf-8"))
+        cache.set(cache_key, True, getattr(
+            settings, "CFT_TEMPLATE_S3_CACHE_TIMEOUT", TEMPLATE_S3_CACHE_TIMEOUT))
+    # The client builds the URL for the bucket's addressing style and region,
+    # and signing it lets CloudFormation read from a private bucket
+    template_url = s3_client.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=TEMPLATE_URL_EXPIRES,
+    )
+    return {"TemplateURL": template_url}
+
+
 def wait_for_stack_completion(client, stack_name):
     response = client.describe_stacks(StackName=stack_name)
     stack = response["Stacks"][0]
@@ -915,6 +1538,112 @@ def wait_for_stack_completion(client, stack_name):
         raise Exception(error_msg)
 
 
+def create_stack_change_set(stack_id, cft, parameters, resource, client,
+                            s3_client=None):
+    """
+    Create a change set to update an existing stack with the template and
+    parameters passed. Returns the change set description, or None if the
+    update would not change the stack.
+    """
+    change_set_name = f"cloudbolt-update-{int(time.time())}"
+    capabilities = resource.cft_capabilities
+    if not capabilities:
+        capabilities = []
+    set_progress(f'Creating change set "{change_set_name}" for stack: '
+                 f'{stack_id}')
+    response = client.create_change_set(
+        StackName=stack_id,
+        ChangeSetName=change_set_name,
+        ChangeSetType="UPDATE",
+        Parameters=parameters,
+        Capabilities=capabilities,
+        **get_template_args(cft, s3_client),
+    )
+    return wait_for_change_set(client, response["Id"])
+
+
+def wait_for_change_set(client, change_set_id):
+    deadline = time.time() + CHANGE_SET_TIMEOUT
+    change_set = client.describe_change_set(ChangeSetName=change_set_id)
+    while change_set["Status"] in ["CREATE_PENDING", "CREATE_IN_PROGRESS"]:
+        if time.time() > deadline:
+            raise Exception(f"Timed out after {CHANGE_SET_TIMEOUT} seconds "
+                            f"waiting on change set: {change_set_id}")
+        time.sleep(5)
+        change_set = client.describe_change_set(ChangeSetName=change_set_id)
+
+    if change_set["Status"] == "CREATE_COMPLETE":
+        return change_set
+    reason = change_set.get("StatusReason", "")
+    if "didn't contain changes" in reason or "No updates" in reason:
+        set_progress("The stack is already up to date, no changes to apply")
+        client.delete_change_set(ChangeSetName=change_set_id)
+        return None
+    raise Exception(f"Change set creation failed: {reason}")
+
+
+def get_change_set_diff(change_set):
+    """
+    Return a list of human readable lines describing the resource changes
+    in a change set
+    """
+    diff = []
+    for change in change_set.get("Changes", []):
+        resource_change = change["ResourceChange"]
+        line = (f'{resource_change["Action"]} '
+                f'{resource_change["LogicalResourceId"]} '
+                f'({resource_change["ResourceType"]})')
+        replacement = resource_change.get("Replacement")
+        if replacement in ["True", "Conditional"]:
+            line += f", Replacement: {replacement}"
+        details = [d["Target"].get("Name") or d["Target"]["Attribute"]
+                   for d in resource_change.get("Details", [])]
+        if details:
+            line += f', Changed: {", ".join(dict.fromkeys(details))}'
+        diff.append(line)
+    return diff
+
+
+def execute_stack_change_set(client, change_set):
+    """
+    return stack dict if successful; raises exception on failure
+    """
+    stack_id = change_set["StackId"]
+    set_progress(f'Executing change set "{change_set["ChangeSetName"]}"')
+    client.execute_change_set(ChangeSetName=change_set["ChangeSetId"])
+    return wait_for_stack_update(client, stack_id)
+
+
+def wait_for_stack_update(client, stack_id):
+    in_progress = ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"]
+    deadline = time.time() + STACK_UPDATE_TIMEOUT
+    response = client.describe_stacks(StackName=stack_id)
+    stack = response["Stacks"][0]
+    while stack["StackStatus"] in in_progress:
+        if time.time() > deadline:
+            raise Exception(f"Timed out after {STACK_UPDATE_TIMEOUT} seconds "
+                            f"waiting on the update of stack: {stack_id}")
+        set_progress(f'status of {stack_id}: "{stack["StackStatus"]}"')
+        time.sleep(15)
+        response = client.describe_stacks(StackName=stack_id)
+        stack = response["Stacks"][0]
+
+    if stack["StackStatus"] == "UPDATE_COMPLETE":
+        set_progress("Stack update was successful")
+        return stack
+    else:
+        events = client.describe_stack_events(StackName=stack_id)
+        logger.debug(events)
+        error_msg = ""
+        i = 1
+        for event in events["StackEvents"]:
+            if event["ResourceStatus"] == "UPDATE_FAILED":
+                error_msg += f'Error {i}: {event["ResourceStatusReason"]} '
+                i += 1
+        raise Exception(error_msg or f'Stack update ended in status: '
+                                     f'{stack["StackStatus"]}')
+
+
 def update_cb_resource(resource, stack, env, job, client, cft_prefix):
     """
     Sets metadata on the resource object in the CB DB, then create/update
@@ -939,34 +1668,91 @@ def write_stack_id_to_resource(resource, stack):
 
 def write_outputs_to_resource(resource, stack, cft_prefix):
     """
-    Write the outputs of the executed CFT back to the Resource as Parameters
+    Write the outputs of the executed CFT back to the Resource as Parameters.
+    Existing output fields and values are looked up in bulk, missing values are
+    bulk created and the resource attributes are updated with a single add and
+    remove.
     """
     try:
         outputs = stack["Outputs"]
     except KeyError:
         logger.debug("No outputs defined for CFT, skipping outputs.")
         return
-    for output in outputs:
-        try:
-            description = output["Description"]
-        except KeyError:
-            description = "Used by the CloudFormation Template blueprint"
-
-        label = output["OutputKey"]
-        field_name = f"{cft_prefix}output_{label}"
-        value = output["OutputValue"]
-        logger.debug(f"Writing output to Resource. Label: {label}, value: " f"{value}")
-        create_field_set_value(field_name, label, value, description, resource)
+    outputs_by_field = {
+        f"{cft_prefix}output_{output['OutputKey']}": output
+        for output in outputs
+    }
+    value_field = CFV_VALUE_FIELDS["STR"]
+    with transaction.atomic():
+        fields = {cf.name: cf for cf in CustomField.objects.filter(
+            name__in=outputs_by_field.keys())}
+        namespace = None
+        values_by_field = {}
+        for field_name, output in outputs_by_field.items():
+            label = output["OutputKey"]
+            value = output["OutputValue"]
+            logger.debug(f"Writing output to Resource. Label: {label}, value: "
+                         f"{value}")
+            if field_name not in fields:
+                try:
+                    description = output["Description"]
+                except KeyError:
+                    description = "Used by the CloudFormation Template " \
+                                  "blueprint"
+                if namespace is None:
+                    namespace = get_cft_namespace()
+                fields[field_name] = create_cf(
+                    field_name, label, description, show_on_servers=True,
+                    namespace=namespace)[0]
+            values_by_field[fields[field_name]] = value
+
+        cfv_ids = get_output_cfv_ids(values_by_field, value_field)
+        missing = [cf for cf in values_by_field if cf.id not in cfv_ids]
+        if missing:
+            CustomFieldValue.objects.bulk_create([
+                CustomFieldValue(field=cf,
+                                 **{value_field: values_by_field[cf]})
+                for cf in missing
+            ])
+            # bulk_create does not return primary keys on all databases, so
+            # read the new rows back
+            cfv_ids = get_output_cfv_ids(values_by_field, value_field)
+
+        new_ids = set(cfv_ids.values())
+        existing_ids = set(resource.attributes.filter(
+            field__in=values_by_field.keys()).values_list("id", flat=True))
+        to_add = new_ids - existing_ids
+        to_remove = existing_ids - new_ids
+        if to_remove:
+            resource.attributes.remove(*to_remove)
+        if to_add:
+            resource.attributes.add(*to_add)
+
+
+def get_output_cfv_ids(values_by_field, value_field):
+    # Returns a dict of CustomField ID -> ID of the CustomFieldValue holding
+    # the value passed for that field
+    values = {cf.id: value for cf, value in values_by_field.items()}
+    cfvs = CustomFieldValue.objects.filter(
+        field__in=list(values), **{f"{value_field}__in": list(values.values())}
+    ).order_by("id").values_list("field_id", value_field, "id")
+    cfv_ids = {}
+    for field_id, value, cfv_id in cfvs:
+        if values[field_id] == value:
+            cfv_ids.setdefault(field_id, cfv_id)
+    return cfv_ids
 
 
 def create_or_update_cb_servers(resource, env, job, client):
     cft_resources = client.describe_stack_resources(StackName=resource.cft_stack_name)
     group = resource.group
     rh = env.resource_handler.cast()
+    instance_ids = set()
     for cft_resource in cft_resources["StackResources"]:
         if cft_resource["ResourceType"] == "AWS::EC2::Instance":
             svr_id = cft_resource["PhysicalResourceId"]
             if svr_id:
+                instance_ids.add(svr_id)
                 ec2_client = rh.get_boto3_client(
                     region_name=env.aws_region, service_name="ec2"
                 )
@@ -978,12 +1764,12 @@ def create_or_update_cb_servers(resource, env, job, client):
                 vpc_id = ec2_data["VpcId"]
                 instance_type = ec2_data["InstanceType"]
                 try:
-                    server = Server.objects.get_or_create(
+                    server, created = Server.objects.get_or_create(
                         resource_handler_svr_id=svr_id,
                         group=group,
                         environment=env,
                         resource_handler=rh,
-                    )[0]
+                    )
                     server.resource = resource
                     server.owner = resource.owner
                     server.save()
@@ -1011,27 +1797,126 @@ def create_or_update_cb_servers(resource, env, job, client):
                     )
                     raise err
 
+                if not created:
+                    # Server already existed, ex: the stack was updated
+                    continue
                 # Add server to the job.server_set, and set creation event
                 job.server_set.add(server)
                 job.save()
                 msg = "Server created by CloudFormation Template job"
                 add_server_event("CREATION", server, msg, profile=job.owner, job=job)
 
+    # Instances replaced or removed by a stack update are no longer in the
+    # stack, set their CB Server records to HISTORICAL
+    removed = resource.server_set.exclude(status="HISTORICAL").exclude(
+        resource_handler_svr_id__in=instance_ids)
+    for hostname in removed.values_list("hostname", flat=True):
+        set_progress(f"Instance no longer in the stack, setting CB Server "
+                     f"record to HISTORICAL for: {hostname}")
+    removed.update(status="HISTORICAL")
+
+
+def save_cft_to_resource(resource, cft, nested_cfts=None):
+    # Only the hash of the template is saved on the resource, the template
+    # itself is stored once for all resources using it
+    template_hash = store_template(cft)
+    create_template_hash_cf()
+    resource.set_value_for_custom_field("cft_template_hash", template_hash)
+    # Most templates have no nested stacks, don't add the field to them
+    if nested_cfts:
+        create_nested_templates_cf()
+        resource.set_value_for_custom_field(NESTED_TEMPLATES_FIELD,
+                                            store_nested_cfts(nested_cfts))
+
+
+def save_cft_to_blueprint(blueprint, cft):
+    # As for resources, the Blueprint option is the hash of the template
+    template_hash = store_template(cft)
+    cf = create_template_hash_cf()
+    add_cfvs_for_field(blueprint, cf, "STR", [template_hash])
+    # Blueprints saved by earlier versions hold the template itself, as an
+    # option and as a parameter
+    legacy_cf = CustomField.objects.filter(
+        name="cloud_formation_template").first()
+    if legacy_cf:
+        blueprint.custom_fields_for_resource.remove(legacy_cf)
+        add_cfvs_for_field(blueprint, legacy_cf, "CODE", [])
+
+
+def create_template_hash_cf():
+    return create_cf(
+        "cft_template_hash",
+        "CloudFormation Template Hash",
+        "Hash of the CloudFormation Template deployed for the resource",
+        show_as_attribute=True,
+    )[0]
+
 
-def save_cft_to_resource(resource, cft):
+def store_template(cft):
+    """
+    Store the template body once per version, returns the hash used to
+    reference it. Each version is a value of the template store field, with
+    the hash in str_value and the template in txt_value. The store is checked
+    in the database rather than the cache, so that a version whose row was
+    deleted is stored again.
+    """
+    template_hash = get_template_hash(cft)
     cf = create_cf(
-        "cloud_formation_template",
-        "CloudFormation Template",
-        "CloudFormation Template Contents",
+        TEMPLATE_STORE_FIELD,
+        "CloudFormation Template Store",
+        "Versions of CloudFormation Templates, keyed by hash",
         cf_type="CODE",
+        required=False,
+    )[0]
+    CustomFieldValue.objects.get_or_create(
+        field=cf, str_value=template_hash, defaults={"txt_value": cft}
     )
-    resource.set_value_for_custom_field("cloud_formation_template", cft)
+    return template_hash
 
 
-def create_field_set_value(field_name, label, value, description, resource):
-    create_cf(field_name, label, description, show_on_servers=True)
-    resource.set_value_for_custom_field(field_name, value)
-    return resource
+def get_stored_template(template_hash):
+    cfv = CustomFieldValue.objects.filter(
+        field__name=TEMPLATE_STORE_FIELD, str_value=template_hash
+    ).only("txt_value").first()
+    return cfv.txt_value if cfv else None
+
+
+def create_nested_templates_cf():
+    return create_cf(
+        NESTED_TEMPLATES_FIELD,
+        "CloudFormation Nested Template Hashes",
+        "Hashes of the nested stack templates, keyed by URL",
+        cf_type="CODE",
+        required=False,
+    )[0]
+
+
+def store_nested_cfts(nested_cfts):
+    # Store each nested template, returns the JSON URL -> hash mapping to save
+    # on the Blueprint or resource
+    return json.dumps({url: store_template(nested_cft)
+                       for url, nested_cft in nested_cfts.items()},
+                      sort_keys=True)
+
+
+def get_stored_nested_cfts(resource):
+    """
+    Return a dict of URL -> template for the nested templates last deployed
+    for the resource, falling back to the ones saved on its Blueprint
+    """
+    cfv = resource.get_cfv_for_custom_field(NESTED_TEMPLATES_FIELD)
+    if not (cfv and cfv.value) and resource.blueprint:
+        cfv = resource.blueprint.get_cfvs_for_custom_field(
+            NESTED_TEMPLATES_FIELD).first()
+    if not (cfv and cfv.value):
+        return {}
+    hashes = json.loads(cfv.value)
+    templates = dict(CustomFieldValue.objects.filter(
+        field__name=TEMPLATE_STORE_FIELD, str_value__in=list(hashes.values())
+    ).values_list("str_value", "txt_value"))
+    return {url: templates[template_hash]
+            for url, template_hash in hashes.items()
+            if template_hash in templates}
 
 
 def render_parameters(resource, environment, job):
@@ -1045,16 +1930,28 @@ def render_parameters(resource, environment, job):
         "job": job,
     }
     context = Context(context)
+    rendered_values = {}
     for key in params.keys():
         value = params[key]
         if type(value) == str:
             if value.find('{{') > -1 or value.find('{%') > -1:
-                template = Template(value)
+                template = get_compiled_template(value)
                 # Hit some instances where strings were rendering with unicode hex
                 # html.unescape fixes this
                 rendered_value = html.unescape(template.render(context))
                 if rendered_value != value:
                     logger.info(f'Rendered value: {value} to '
                                 f'rendered_value: {rendered_value}')
-                    resource.set_value_for_custom_field(key, rendered_value)
+                    rendered_values[key] = rendered_value
+    # Write all of the rendered values in a single transaction
+    with transaction.atomic():
+        for key, rendered_value in rendered_values.items():
+            resource.set_value_for_custom_field(key, rendered_value)
     return resource
+
+
+@lru_cache(maxsize=256)
+def get_compiled_template(value):
+    # Blueprints commonly share the same templated values across orders, so
+    # keep the compiled Templates around rather than re-parsing them
+    return Template(value)
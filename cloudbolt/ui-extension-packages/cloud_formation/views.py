@@ -1,5 +1,6 @@
 from django.contrib import messages
-from django.db.models import ProtectedError, Q
+from django.core.paginator import Paginator
+from django.db.models import Count, Prefetch, ProtectedError, Q
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
@@ -12,17 +13,16 @@ from orders.models import CustomFieldValue
 from resources.models import Resource
 from servicecatalog.models import ServiceBlueprint
 from tabs.views import TabGroup
-from tags.models import CloudBoltTag
 from utilities.decorators import dialog_view
 from utilities.exceptions import CloudBoltException
 from utilities.models import ConnectionInfo
 from utilities.templatetags import helper_tags
 from xui.cloud_formation.shared import (
+    save_cft_to_blueprint,
     create_generated_options_action,
     create_params,
     get_conn_info_type,
-    get_cft_from_source,
-    add_cfvs_for_field,
+    get_cfts_from_source,
     get_supported_conn_info_labels,
 )
 from xui.cloud_formation.forms import NewBlueprintForm, CIForm
@@ -30,6 +30,9 @@ from utilities.logger import ThreadLogger
 
 logger = ThreadLogger(__name__)
 
+CFT_BLUEPRINTS_PER_PAGE = 25
+CFT_BLUEPRINT_FIELDS = ["cft_conn_info_id", "cft_url", "cft_allowed_env_ids"]
+
 
 @dialog_view
 def create_cft_blueprint(request):
@@ -221,50 +224,87 @@ def get_cft_connection_infos():
     return conn_infos
 
 
-def get_cft_blueprints():
-    tags = CloudBoltTag.objects.filter(
-        name="CloudFormation", model_name="serviceblueprint"
-    )
+def get_cft_blueprints(page=None):
+    """
+    Return the requested page of CloudFormation blueprints, and a list of
+    dicts with the details shown in the library for each blueprint on that
+    page. Resource counts, blueprint parameters, connection infos and
+    environments are each fetched with a single query.
+    """
+    bps = ServiceBlueprint.objects.filter(
+        tags__name="CloudFormation",
+        tags__model_name="serviceblueprint",
+        status="ACTIVE",
+    ).annotate(
+        active_resource_count=Count(
+            "resource", filter=Q(resource__lifecycle="ACTIVE"), distinct=True
+        )
+    ).select_related("resource_type").prefetch_related(
+        Prefetch(
+            "custom_field_options",
+            queryset=CustomFieldValue.objects.filter(
+                field__name__in=CFT_BLUEPRINT_FIELDS
+            ).select_related("field"),
+            to_attr="cft_cfvs",
+        )
+    ).distinct().order_by("name")
+    bp_page = Paginator(bps, CFT_BLUEPRINTS_PER_PAGE).get_page(page)
+
+    bp_params = {}
+    conn_info_ids = set()
+    env_ids = set()
+    for bp in bp_page:
+        params = {cfv.field.name: cfv.value for cfv in bp.cft_cfvs}
+        bp_params[bp.id] = params
+        conn_info_id = int(params.get("cft_conn_info_id") or 0)
+        if conn_info_id != 0:
+            conn_info_ids.add(conn_info_id)
+        allowed_env_ids = params.get("cft_allowed_env_ids") or ""
+        if allowed_env_ids.find('all_capable') == -1:
+            env_ids.update(env.strip() for env in allowed_env_ids.split(",")
+                           if env.strip())
+
+    conn_infos = ConnectionInfo.objects.filter(
+        id__in=conn_info_ids).prefetch_related("labels").in_bulk()
+    envs = Environment.objects.filter(id__in=env_ids).in_bulk()
+
     cfts = []
-    for tag in tags:
-        bps = ServiceBlueprint.objects.filter(tags=tag, status="ACTIVE")
-        for bp in bps:
-            bp_dict = {}
-            bp_dict["bp"] = bp
-            bp_dict["resource_count"] = bp.resource_set.filter(
-                lifecycle="ACTIVE").count()
-            conn_info_id = int(bp.cft_conn_info_id)
-            if conn_info_id == 0:
-                bp_dict["conn_info"] = 0
-                bp_dict["conn_info_type"] = 'public'
-            else:
-                try:
-                    conn_info = ConnectionInfo.objects.get(id=conn_info_id)
-                    bp_dict["conn_info"] = conn_info
-                    bp_dict["conn_info_type"] = get_conn_info_type(conn_info)
-                except ConnectionInfo.DoesNotExist:
-                    bp_dict['ci_error'] = helper_tags.warning_icon(
-                        _(
-                            "Blueprint ConnectionInfo has been removed and requires updating."
-                        )
-                    )
-            bp_dict["url"] = bp.cft_url
-            bp_dict["filename"] = bp.cft_url.split("/")[-1:][0].split('?')[0]
-            allowed_env_ids = bp.cft_allowed_env_ids
-            bp_dict["resource_type"] = bp.resource_type
-            if allowed_env_ids.find('all_capable') > -1:
-                bp_dict["allowed_envs"] = 'all_capable'
-            else:
-                allowed_envs = [env.strip() for env in bp.cft_allowed_env_ids.split(",")]
-                bp_dict["allowed_envs"] = []
-                for env in allowed_envs:
-                    try:
-                        env = Environment.objects.get(id=env)
-                        bp_dict["allowed_envs"].append(env)
-                    except Environment.DoesNotExist:
-                        logger.warning(f'Did not find Environment with ID: {env}')
-            cfts.append(bp_dict)
-    return cfts
+    for bp in bp_page:
+        params = bp_params[bp.id]
+        bp_dict = {}
+        bp_dict["bp"] = bp
+        bp_dict["resource_count"] = bp.active_resource_count
+        conn_info_id = int(params.get("cft_conn_info_id") or 0)
+        if conn_info_id == 0:
+            bp_dict["conn_info"] = 0
+            bp_dict["conn_info_type"] = 'public'
+        elif conn_info_id in conn_infos:
+            conn_info = conn_infos[conn_info_id]
+            bp_dict["conn_info"] = conn_info
+            bp_dict["conn_info_type"] = get_conn_info_type(conn_info)
+        else:
+            bp_dict['ci_error'] = helper_tags.warning_icon(
+                _(
+                    "Blueprint ConnectionInfo has been removed and requires updating."
+                )
+            )
+        cft_url = params.get("cft_url") or ""
+        bp_dict["url"] = cft_url
+        bp_dict["filename"] = cft_url.split("/")[-1:][0].split('?')[0]
+        allowed_env_ids = params.get("cft_allowed_env_ids") or ""
+        bp_dict["resource_type"] = bp.resource_type
+        if allowed_env_ids.find('all_capable') > -1:
+            bp_dict["allowed_envs"] = 'all_capable'
+        else:
+            allowed_envs = [env.strip() for env in allowed_env_ids.split(",")]
+            bp_dict["allowed_envs"] = []
+            for env in allowed_envs:
+                if env.isdigit() and int(env) in envs:
+                    bp_dict["allowed_envs"].append(envs[int(env)])
+                else:
+                    logger.warning(f'Did not find Environment with ID: {env}')
+        cfts.append(bp_dict)
+    return bp_page, cfts
 
 
 def get_params_from_resource(resource):
@@ -286,9 +326,15 @@ def get_cf_label(cf_name):
     title="CloudFormation Library", description="CloudFormation library for CloudBolt."
 )
 def library(request, **kwargs):
+    cft_page, cfts = get_cft_blueprints(request.GET.get("page"))
+    # Keep any other query params on the pagination links
+    page_query = request.GET.copy()
+    page_query.pop("page", None)
     context = {
         "connection_infos": get_cft_connection_infos(),
-        "cfts": get_cft_blueprints(),
+        "cfts": cfts,
+        "cft_page": cft_page,
+        "cft_page_query": page_query.urlencode(),
     }
 
     admin_context = {
@@ -325,18 +371,19 @@ def sync_cft_blueprint(request, blueprint_id):
         conn_info_id = blueprint.cft_conn_info_id
         cft_url = blueprint.cft_url
         try:
-            template_json = get_cft_from_source(conn_info_id, cft_url)
+            nested_cfts = get_cfts_from_source(conn_info_id, cft_url)
+            template_json = nested_cfts.pop(cft_url)
 
             # Add the new CFT value to the Blueprint
-            cf = CustomField.objects.get(name="cloud_formation_template")
-            add_cfvs_for_field(blueprint, cf, cf.type, [template_json])
+            save_cft_to_blueprint(blueprint, template_json)
 
             aws_params_hook = create_generated_options_action(
                 "Generate options for CF AWS Specific Params",
                 "generate_options_for_aws_specific_params.py",
             )
 
-            create_params(blueprint, template_json, aws_params_hook)
+            create_params(blueprint, template_json, aws_params_hook, cft_url,
+                          nested_cfts)
             messages.success(request, f'Updated parameters for {blueprint.name}')
         except ConnectionInfo.DoesNotExist:
             messages.error(request, 'Connection Info not found, please edit the Blueprint first.')
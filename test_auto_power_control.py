@@ -0,0 +1,898 @@
+"""
+Focused tests for the Auto-power control servers and Auto-power control
+resources recurring jobs. The CloudBolt, Django and boto3 modules the jobs
+import are replaced with stubs while they are loaded, so these run without a
+CloudBolt install.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import types
+from unittest import mock
+
+import pytest
+
+try:
+    import pytz
+except ImportError:
+    from zoneinfo import ZoneInfo
+
+    pytz = types.SimpleNamespace(timezone=ZoneInfo, utc=timezone.utc)
+
+JOBS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "cloudbolt", "recurring-jobs"
+)
+SERVERS_SCRIPT = os.path.join(
+    JOBS_DIR,
+    "auto_power_control_servers",
+    "Hook for Auto-power control servers",
+    "Sub File for Hook of Auto-power control servers Script.py",
+)
+RESOURCES_SCRIPT = os.path.join(
+    JOBS_DIR,
+    "auto_power_control_resources",
+    "Hook for Auto-power control resources",
+    "Sub File for Hook of Auto-power control resources Script.py",
+)
+SHARED_MARKER = "# Everything below this line is shared"
+
+UTC = pytz.utc
+
+
+class ClientError(Exception):
+    pass
+
+
+class WaiterError(Exception):
+    pass
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.values = {}
+
+    def get_many(self, keys):
+        return {key: self.values[key] for key in keys if key in self.values}
+
+    def set_many(self, values, timeout=None):
+        self.values.update(values)
+
+
+def stub_module(name, **attrs):
+    # Attributes not passed in are MagicMocks
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    module.__getattr__ = lambda attr: mock.MagicMock(name=f"{name}.{attr}")
+    return module
+
+
+def load_module(path, name, stubs):
+    """
+    Load the module at path with the stub modules in sys.modules, as a dict of
+    module name -> attributes. Parent packages are stubbed as well, and modules
+    stubbed as None can't be imported.
+    """
+    modules = {}
+    for module_name, attrs in stubs.items():
+        if attrs is None:
+            modules[module_name] = None
+            continue
+        parts = module_name.split(".")
+        for i in range(1, len(parts)):
+            parent = ".".join(parts[:i])
+            modules.setdefault(parent, stub_module(parent))
+        modules[module_name] = stub_module(module_name, **attrs)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.dict(sys.modules, modules):
+        spec.loader.exec_module(module)
+    return module
+
+
+def load_job(path, name):
+    return load_module(
+        path,
+        name,
+        {
+            "pytz": {"timezone": pytz.timezone, "utc": pytz.utc},
+            "eventlet": None,
+            "eventlet.green": None,
+            "botocore.exceptions": {
+                "ClientError": ClientError,
+                "WaiterError": WaiterError,
+            },
+            "django.conf": {"settings": types.SimpleNamespace()},
+            "django.core.cache": {"cache": FakeCache()},
+            "django.db.models": {},
+            "django.template.defaultfilters": {
+                "pluralize": lambda count: "" if count == 1 else "s"
+            },
+            "common.methods": {},
+            "infrastructure.models": {},
+            "orders.models": {},
+            "resourcehandlers.aws.models": {},
+            "resources.models": {},
+            "utilities.events": {},
+            "utilities.logger": {},
+            "utilities.models": {},
+        },
+    )
+
+
+@pytest.fixture
+def servers_job():
+    return load_job(SERVERS_SCRIPT, "auto_power_control_servers")
+
+
+@pytest.fixture
+def resources_job():
+    return load_job(RESOURCES_SCRIPT, "auto_power_control_resources")
+
+
+@pytest.fixture(params=["servers", "resources"])
+def job(request):
+    # The shared helpers are tested against both copies
+    return request.getfixturevalue(f"{request.param}_job")
+
+
+def make_server(server_id, powered=True):
+    return mock.Mock(
+        id=server_id,
+        hostname=f"server-{server_id}",
+        resource_handler_svr_id=f"i-{server_id}",
+        **{"power_on.return_value": powered, "power_off.return_value": powered},
+    )
+
+
+class FakeEC2Client(object):
+    """
+    EC2 client whose instances change to the states in final_states once they
+    are started or stopped
+    """
+
+    def __init__(self, states, final_states=None, errors=()):
+        self.states = states
+        self.final_states = final_states or {}
+        self.errors = list(errors)
+        self.calls = []
+        self.waiter = mock.Mock()
+
+    def power(self, action, changes_key, InstanceIds):
+        self.calls.append((action, InstanceIds))
+        if self.errors:
+            raise self.errors.pop(0)
+        for instance_id in InstanceIds:
+            self.states[instance_id] = self.final_states.get(instance_id, "pending")
+        return {changes_key: [{"InstanceId": i} for i in InstanceIds]}
+
+    def start_instances(self, InstanceIds):
+        return self.power("start", "StartingInstances", InstanceIds)
+
+    def stop_instances(self, InstanceIds):
+        return self.power("stop", "StoppingInstances", InstanceIds)
+
+    def get_waiter(self, name):
+        return self.waiter
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Filters):
+        instance_ids = Filters[0]["Values"]
+        instances = [
+            {"InstanceId": i, "State": {"Name": self.states[i]}}
+            for i in instance_ids
+            if i in self.states
+        ]
+        return [{"Reservations": [{"Instances": instances}]}]
+
+
+def test_shared_block_is_identical():
+    blocks = []
+    for path in [SERVERS_SCRIPT, RESOURCES_SCRIPT]:
+        with open(path) as script:
+            source = script.read()
+        assert SHARED_MARKER in source
+        blocks.append(source[source.index(SHARED_MARKER) :])
+    assert blocks[0] == blocks[1]
+
+
+class TestBatchPower:
+    @pytest.fixture
+    def servers(self):
+        return [make_server(1), make_server(2), make_server(3)]
+
+    def batch_power(self, servers_job, client, servers, on_off="on"):
+        rh = mock.Mock(**{"get_boto3_client.return_value": client})
+        return servers_job.batch_power(rh, "us-east-1", servers, on_off)
+
+    def test_one_call_per_batch(self, servers_job, servers):
+        client = FakeEC2Client(
+            {"i-1": "stopped", "i-2": "stopped", "i-3": "stopped"},
+            {"i-1": "running", "i-2": "running", "i-3": "running"},
+        )
+
+        assert self.batch_power(servers_job, client, servers) == []
+        assert client.calls == [("start", ["i-1", "i-2", "i-3"])]
+        client.waiter.wait.assert_called_once_with(
+            InstanceIds=["i-1", "i-2", "i-3"],
+            WaiterConfig={"Delay": 15, "MaxAttempts": 40},
+        )
+
+    def test_servers_powered_through_cloudbolt(self, servers_job, servers):
+        # Once the instances are stopped, each server is powered off through
+        # CloudBolt to record its power status and history
+        client = FakeEC2Client(
+            {"i-1": "running", "i-2": "running", "i-3": "running"},
+            {"i-1": "stopped", "i-2": "stopped", "i-3": "stopped"},
+        )
+
+        self.batch_power(servers_job, client, servers, "off")
+
+        for server in servers:
+            server.power_off.assert_called_once_with()
+            server.power_on.assert_not_called()
+            server.save.assert_not_called()
+        assert servers_job.cache.values == {
+            f"auto_power_control:power_state:{server.id}": "off" for server in servers
+        }
+
+    def test_servers_failing_to_record_power_fail(self, servers_job, servers):
+        servers[1].power_on.return_value = False
+        client = FakeEC2Client(
+            {"i-1": "stopped", "i-2": "stopped", "i-3": "stopped"},
+            {"i-1": "running", "i-2": "running", "i-3": "running"},
+        )
+
+        assert self.batch_power(servers_job, client, servers) == [servers[1]]
+
+    def test_servers_not_reaching_state_fail(self, servers_job, servers):
+        client = FakeEC2Client(
+            {"i-1": "stopped", "i-2": "stopped", "i-3": "stopped"},
+            {"i-1": "running", "i-2": "pending", "i-3": "running"},
+        )
+        client.waiter.wait.side_effect = WaiterError("Max attempts exceeded")
+
+        assert self.batch_power(servers_job, client, servers) == [servers[1]]
+        servers[1].power_on.assert_not_called()
+
+    def test_servers_not_changed_fail(self, servers_job, servers):
+        # An instance left out of StartingInstances is not waited for
+        client = FakeEC2Client({"i-1": "stopped", "i-2": "stopped"}, {})
+        client.start_instances = lambda InstanceIds: {
+            "StartingInstances": [{"InstanceId": "i-1"}, {"InstanceId": "i-2"}]
+        }
+        client.states.update({"i-1": "running", "i-2": "running"})
+
+        assert self.batch_power(servers_job, client, servers) == [servers[2]]
+        servers[2].power_on.assert_not_called()
+
+    def test_throttled_call_retried(self, servers_job, servers):
+        servers_job.time = mock.Mock()
+        client = FakeEC2Client(
+            {"i-1": "stopped", "i-2": "stopped", "i-3": "stopped"},
+            {"i-1": "running", "i-2": "running", "i-3": "running"},
+            [ClientError("RequestLimitExceeded"), ClientError("Rate exceeded")],
+        )
+
+        assert self.batch_power(servers_job, client, servers) == []
+        assert len(client.calls) == 3
+        assert servers_job.time.sleep.call_args_list == [mock.call(5), mock.call(10)]
+
+    def test_failed_call_falls_back_to_each_server(self, servers_job, servers):
+        servers[2].power_on.return_value = False
+        client = FakeEC2Client(
+            {"i-1": "stopped", "i-2": "stopped", "i-3": "stopped"},
+            errors=[ClientError("InvalidInstanceID.NotFound")],
+        )
+
+        assert self.batch_power(servers_job, client, servers) == [servers[2]]
+        assert len(client.calls) == 1
+        for server in servers:
+            server.power_on.assert_called_once_with()
+
+
+class TestWaitForInstanceStates:
+    def test_no_servers(self, servers_job):
+        client = FakeEC2Client({})
+
+        assert servers_job.wait_for_instance_states(None, "r", client, [], "on") == []
+        client.waiter.wait.assert_not_called()
+
+    def test_servers_in_final_state(self, servers_job):
+        servers = [make_server(1), make_server(2), make_server(3)]
+        # i-3 no longer exists
+        client = FakeEC2Client({"i-1": "stopped", "i-2": "stopping"})
+        client.waiter.wait.side_effect = WaiterError("Max attempts exceeded")
+        rh = mock.Mock(**{"get_boto3_client.return_value": client})
+
+        assert servers_job.wait_for_instance_states(
+            rh, "us-east-1", client, servers, "off"
+        ) == [servers[0]]
+
+
+class TestAdaptiveLimit:
+    def run(self, limit, result):
+        limit.enqueue()
+        return limit.run(lambda: result)
+
+    def test_throttling_halves_limit(self, job):
+        limit = job.AdaptiveLimit("handler", 8)
+        limit.throttle()
+        assert limit.limit == 4
+        limit.throttle()
+        limit.throttle()
+        limit.throttle()
+        assert limit.limit == 1
+        assert limit.throttled == 4
+
+    def test_limit_grows_back_by_one(self, job):
+        limit = job.AdaptiveLimit("handler", 8)
+        limit.throttle()
+        for _ in range(3):
+            self.run(limit, True)
+        assert limit.limit == 4
+        self.run(limit, True)
+        assert limit.limit == 5
+
+    def test_limit_stays_under_max(self, job):
+        limit = job.AdaptiveLimit("handler", 2)
+        for _ in range(10):
+            self.run(limit, True)
+        assert limit.limit == 2
+
+    def test_failure_does_not_throttle(self, job):
+        limit = job.AdaptiveLimit("handler", 4)
+        limit.throttle()
+        self.run(limit, False)
+        self.run(limit, True)
+        assert limit.limit == 2
+        assert (limit.throttled, limit.failed) == (1, 1)
+        self.run(limit, True)
+        assert limit.limit == 3
+
+    def test_throttling_error(self, job):
+        limit = job.AdaptiveLimit("handler", 4)
+        limit.enqueue()
+
+        def throttled():
+            raise ClientError("Rate exceeded")
+
+        with pytest.raises(ClientError):
+            limit.run(throttled)
+        assert limit.limit == 2
+        assert (limit.throttled, limit.failed) == (1, 0)
+        assert limit.active == 0
+
+    def test_other_error_does_not_throttle(self, job):
+        limit = job.AdaptiveLimit("handler", 4)
+        limit.enqueue()
+        with pytest.raises(ValueError):
+            limit.run(mock.Mock(side_effect=ValueError("bad")))
+        assert limit.limit == 4
+        assert (limit.throttled, limit.failed) == (0, 1)
+
+    def test_dispatch_time_recorded(self, job):
+        limit = job.AdaptiveLimit("handler", 4)
+        limit.enqueue()
+        dispatched = {}
+        before = time.time()
+        limit.run(lambda: True, dispatched=dispatched)
+        assert dispatched["time"] >= before
+
+    def test_throttle_from_operation(self, job):
+        limit = job.AdaptiveLimit("handler", 4)
+        limit.enqueue()
+        limit.run(lambda: job.get_current_limit().throttle() or True)
+        assert limit.limit == 2
+        assert job.get_current_limit() is None
+
+    def test_report(self, job):
+        limit = job.AdaptiveLimit("handler", 4)
+        limit.throttle()
+        self.run(limit, True)
+        self.run(limit, False)
+
+        assert limit.report().startswith(
+            "Handler 'handler': 2 power operations, 1 throttled, 1 failed, peak "
+            "queue depth 1,"
+        )
+
+
+class TestSkipServersInPowerState:
+    @pytest.fixture(autouse=True)
+    def server_model(self, servers_job):
+        servers_job.Server = mock.Mock()
+
+    def skip(self, servers_job, client, servers, unbatched_servers=(), on_off="on"):
+        rh = mock.Mock(**{"get_boto3_client.return_value": client})
+        batches = {(rh, "us-east-1"): servers}
+        return rh, servers_job.skip_servers_in_power_state(
+            batches, list(unbatched_servers), on_off
+        )
+
+    def test_servers_in_target_state_skipped(self, servers_job):
+        servers = [make_server(i) for i in range(1, 5)]
+        # i-4 no longer exists, so it is left to fail when it is powered
+        client = FakeEC2Client({"i-1": "running", "i-2": "stopped", "i-3": "pending"})
+
+        rh, (batches, unbatched, skipped) = self.skip(servers_job, client, servers)
+
+        assert batches == {(rh, "us-east-1"): [servers[1], servers[3]]}
+        assert unbatched == []
+        assert skipped == [servers[0], servers[2]]
+        servers_job.Server.objects.filter.assert_called_once_with(id__in=[1, 3])
+        servers_job.Server.objects.filter.return_value.update.assert_called_once_with(
+            power_status="POWERON"
+        )
+        assert servers_job.cache.values == {
+            "auto_power_control:power_state:1": "on",
+            "auto_power_control:power_state:3": "on",
+        }
+
+    def test_batch_with_all_servers_skipped_dropped(self, servers_job):
+        servers = [make_server(1), make_server(2)]
+        client = FakeEC2Client({"i-1": "stopping", "i-2": "stopped"})
+
+        _, (batches, _, skipped) = self.skip(servers_job, client, servers, on_off="off")
+
+        assert batches == {}
+        assert skipped == servers
+
+    def test_unchecked_servers_powered(self, servers_job):
+        # The state of the servers on other technologies is not looked up
+        servers = [make_server(1)]
+        unbatched_servers = [make_server(2)]
+        client = FakeEC2Client({"i-1": "stopped", "i-2": "running"})
+
+        rh, result = self.skip(servers_job, client, servers, unbatched_servers)
+
+        assert result == ({(rh, "us-east-1"): servers}, unbatched_servers, [])
+
+    def test_states_not_checked_powers_batch(self, servers_job):
+        servers = [make_server(1), make_server(2)]
+        client = mock.Mock(
+            **{"get_paginator.side_effect": ClientError("UnauthorizedOperation")}
+        )
+
+        rh, (batches, _, skipped) = self.skip(servers_job, client, servers)
+
+        assert batches == {(rh, "us-east-1"): servers}
+        assert skipped == []
+
+    def test_cache_not_used_for_batched_servers(self, servers_job):
+        # The instance was started outside of CloudBolt since it was last
+        # powered off, so its cached state is out of date
+        servers = [make_server(1)]
+        servers_job.cache.set_many({"auto_power_control:power_state:1": "off"})
+        client = FakeEC2Client({"i-1": "running"})
+
+        rh, result = self.skip(servers_job, client, servers, on_off="off")
+
+        assert result == ({(rh, "us-east-1"): servers}, [], [])
+
+    def test_cache_used_for_unbatched_servers(self, servers_job):
+        unbatched_servers = [make_server(1), make_server(2)]
+        servers_job.cache.set_many(
+            {
+                "auto_power_control:power_state:1": "on",
+                "auto_power_control:power_state:2": "off",
+            }
+        )
+
+        _, result = self.skip(servers_job, FakeEC2Client({}), [], unbatched_servers)
+
+        assert result == ({}, [unbatched_servers[1]], [unbatched_servers[0]])
+
+
+class FakePools(object):
+    # Runs the power operations on a single pool, recording when each starts
+    # running as HandlerPools does
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=10)
+
+    def submit(self, rh, func, *args):
+        dispatched = {}
+
+        def run():
+            dispatched["time"] = time.time()
+            return func(*args)
+
+        future = self.pool.submit(run)
+        future.dispatched = dispatched
+        return future
+
+
+class TestPowerResourceServers:
+    @pytest.fixture
+    def pools(self):
+        pools = FakePools()
+        yield pools
+        pools.pool.shutdown(wait=True)
+
+    def power(self, resources_job, tiers, pools, on_off="on"):
+        return resources_job.threaded_power_resource(
+            "resource", tiers, on_off, pools, None
+        )
+
+    def test_tiers_powered_in_order(self, resources_job, pools):
+        events = []
+
+        def make_tier_server(server_id, seconds):
+            def power_on():
+                events.append(("start", server_id))
+                time.sleep(seconds)
+                events.append(("end", server_id))
+                return server_id != 3
+
+            server = make_server(server_id)
+            server.power_on.side_effect = power_on
+            return server
+
+        first_tier = [make_tier_server(1, 0.1), make_tier_server(2, 0.05)]
+        second_tier = [make_tier_server(3, 0), make_tier_server(4, 0)]
+
+        result = self.power(
+            resources_job, [(1, first_tier), (2, second_tier)], pools
+        )
+
+        # The second tier is only started once the first has finished
+        first_ends = [events.index(("end", 1)), events.index(("end", 2))]
+        second_starts = [events.index(("start", 3)), events.index(("start", 4))]
+        assert max(first_ends) < min(second_starts)
+        successes, failures, skipped, timed_out = result
+        assert sorted(server.id for server in successes) == [1, 2, 4]
+        assert failures == [second_tier[0]]
+        assert skipped == timed_out == []
+
+    def test_cached_servers_skipped(self, resources_job, pools):
+        servers = [make_server(1), make_server(2)]
+        resources_job.cache.set_many({"auto_power_control:power_state:1": "off"})
+
+        result = self.power(resources_job, [(None, servers)], pools, "off")
+
+        assert result == ([servers[1]], [], [servers[0]], [])
+        servers[0].power_off.assert_not_called()
+
+    def test_timed_out_servers_not_failed(self, resources_job, pools):
+        resources_job.TIER_TIMEOUT = 0.2
+        resources_job.TIER_POLL_SECONDS = 0.05
+        released = threading.Event()
+        slow_server = make_server(1)
+        slow_server.power_on.side_effect = released.wait
+        servers = [slow_server, make_server(2), make_server(3)]
+
+        try:
+            result = self.power(
+                resources_job, [(1, servers[:2]), (2, servers[2:])], pools
+            )
+        finally:
+            released.set()
+
+        # The next tier is started without waiting for the slow server
+        assert result == ([servers[1], servers[2]], [], [], [slow_server])
+
+    def test_timed_out_resources_not_retried(self, resources_job):
+        resources_job.TIER_TIMEOUT = 0.2
+        resources_job.TIER_POLL_SECONDS = 0.05
+        released = threading.Event()
+        slow_server = make_server(1)
+        slow_server.power_on.side_effect = released.wait
+        slow_server.service_item = None
+        resource = mock.Mock(id=7)
+        schedule = mock.Mock(
+            **{
+                "resources_to_power_off.filter.return_value": [],
+                "resources_to_power_on.filter.return_value": [resource],
+            }
+        )
+        resources_job.get_last_tick = mock.Mock(return_value=None)
+        resources_job.set_last_tick = mock.Mock()
+        resources_job.get_schedules_to_run = mock.Mock(return_value=[schedule])
+        resources_job.load_retry_queue = mock.Mock(return_value={})
+        resources_job.save_retry_queue = mock.Mock()
+        resources_job.write_run_metrics = mock.Mock()
+        resources_job.get_servers_by_resource = mock.Mock(
+            return_value={7: [slow_server]}
+        )
+
+        # The job waits for the timed out operation before it ends
+        timer = threading.Timer(0.5, released.set)
+        timer.start()
+        status, output, _ = resources_job.run(logger=mock.Mock())
+        timer.join()
+
+        assert status == "WARNING"
+        assert "Timed out waiting for 1 server to power on" in output
+        resources_job.save_retry_queue.assert_called_once_with({}, {7})
+        outcomes = resources_job.write_run_metrics.call_args[0][1]
+        assert outcomes == [(slow_server, "on", "timed_out")]
+
+
+def make_schedule(schedule_id, timezone, day_of_week, hour):
+    return types.SimpleNamespace(
+        id=schedule_id, timezone=timezone, day_of_week=day_of_week, hour=hour
+    )
+
+
+
+class TestPowerTimeWheel:
+    def test_due_slots_in_schedule_timezone(self, job):
+        # 2026-06-01 is a Monday, when New York is on UTC-4
+        schedule = make_schedule(1, "America/New_York", 0, 9)
+        wheel = job.PowerTimeWheel([schedule])
+        start = datetime(2026, 6, 1, 12, 0, tzinfo=UTC)
+        end = datetime(2026, 6, 1, 14, 0, tzinfo=UTC)
+
+        assert list(wheel.due_slots(start, end)) == [
+            (datetime(2026, 6, 1, 13, 0, tzinfo=UTC), schedule)
+        ]
+
+    def test_due_slots_follow_dst(self, job):
+        # New York is on UTC-5 on Monday 2026-01-05
+        schedule = make_schedule(1, "America/New_York", 0, 9)
+        wheel = job.PowerTimeWheel([schedule])
+        start = datetime(2026, 1, 5, 12, 0, tzinfo=UTC)
+        end = datetime(2026, 1, 5, 15, 0, tzinfo=UTC)
+
+        assert [slot for slot, _ in wheel.due_slots(start, end)] == [
+            datetime(2026, 1, 5, 14, 0, tzinfo=UTC)
+        ]
+
+    def test_slots_outside_range_are_not_due(self, job):
+        wheel = job.PowerTimeWheel([make_schedule(1, "UTC", 0, 9)])
+        start = datetime(2026, 6, 1, 9, 1, tzinfo=UTC)
+        end = datetime(2026, 6, 1, 10, 0, tzinfo=UTC)
+
+        assert list(wheel.due_slots(start, end)) == []
+
+    def test_spread_minutes_is_opt_in(self, job):
+        schedule = make_schedule(17, "UTC", 0, 9)
+        assert job.get_slot_minute(schedule) == 0
+
+        job.SPREAD_MINUTES = 15
+        wheel = job.PowerTimeWheel([schedule])
+        start = datetime(2026, 6, 1, 9, 0, tzinfo=UTC)
+        end = datetime(2026, 6, 1, 9, 59, tzinfo=UTC)
+
+        assert list(wheel.due_slots(start, end)) == [
+            (datetime(2026, 6, 1, 9, 2, tzinfo=UTC), schedule)
+        ]
+
+
+class TestGetSchedulesToRun:
+    @pytest.fixture
+    def schedules(self, job):
+        schedules = [
+            make_schedule(1, "UTC", 0, 10),
+            make_schedule(2, "UTC", 0, 9),
+            make_schedule(3, "UTC", 0, 8),
+        ]
+        wheel = job.PowerTimeWheel(schedules)
+        job.PowerTimeWheel.load = classmethod(lambda cls, start, end: wheel)
+        return schedules
+
+    def test_first_run_starts_at_top_of_hour(self, job, schedules):
+        tick = datetime(2026, 6, 1, 10, 0, tzinfo=UTC)
+        assert job.get_schedules_to_run(None, tick) == [schedules[0]]
+
+    def test_first_run_catches_up_on_spread_slots(self, job):
+        # Schedule 17 is spread to 10:02, before the first run at 10:07
+        job.SPREAD_MINUTES = 15
+        schedules = [make_schedule(17, "UTC", 0, 10), make_schedule(2, "UTC", 0, 9)]
+        wheel = job.PowerTimeWheel(schedules)
+        job.PowerTimeWheel.load = classmethod(lambda cls, start, end: wheel)
+        tick = datetime(2026, 6, 1, 10, 7, tzinfo=UTC)
+
+        assert job.get_schedules_to_run(None, tick) == [schedules[0]]
+
+    def test_catches_up_in_the_order_schedules_came_due(self, job, schedules):
+        # London is on UTC+1 in June, so its 10:00 schedule came due first
+        london_schedule = make_schedule(4, "Europe/London", 0, 10)
+        wheel = job.PowerTimeWheel([schedules[0], london_schedule])
+        job.PowerTimeWheel.load = classmethod(lambda cls, start, end: wheel)
+        last_tick = datetime(2026, 6, 1, 8, 30, tzinfo=UTC)
+        tick = datetime(2026, 6, 1, 10, 0, tzinfo=UTC)
+        assert job.get_schedules_to_run(last_tick, tick) == [
+            london_schedule,
+            schedules[0],
+        ]
+
+    def test_catch_up_is_limited(self, job, schedules):
+        last_tick = datetime(2026, 6, 1, 7, 0, tzinfo=UTC)
+        tick = datetime(2026, 6, 1, 10, 0, tzinfo=UTC)
+        assert job.get_schedules_to_run(last_tick, tick) == [
+            schedules[1],
+            schedules[0],
+        ]
+
+    def test_slot_already_run(self, job, schedules):
+        tick = datetime(2026, 6, 1, 10, 0, tzinfo=UTC)
+        assert job.get_schedules_to_run(tick, tick) == []
+
+
+class TestWavePlanner:
+    def plan(self, job, count, window, threshold):
+        waves = job.WavePlanner(window=window, threshold=threshold)
+        rh = types.SimpleNamespace(id=1)
+        for i in range(count):
+            waves.add(rh, i, lambda i: i, i)
+        waves.plan()
+        return waves
+
+    def test_operations_spread_evenly(self, job):
+        waves = self.plan(job, 4, window=60, threshold=2)
+        assert [wave[0] for wave in waves.waves] == [0, 15, 30, 45]
+
+    def test_operations_under_threshold_start_at_once(self, job):
+        waves = self.plan(job, 2, window=60, threshold=2)
+        assert [wave[0] for wave in waves.waves] == [0, 0]
+
+    def test_submit_does_not_wait_for_later_operations(self, job):
+        waves = self.plan(job, 3, window=0.6, threshold=1)
+        submitted = []
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+
+            def submit(rh, func, *args):
+                submitted.append(args[0])
+                return pool.submit(func, *args)
+
+            start = time.time()
+            future_map = waves.submit(submit)
+            assert time.time() - start < 0.2
+            assert submitted == [0]
+
+            results = {
+                future_map[future]: future.result(timeout=5) for future in future_map
+            }
+
+        assert results == {0: 0, 1: 1, 2: 2}
+        assert submitted == [0, 1, 2]
+
+    def test_delayed_operation_exception(self, job):
+        waves = job.WavePlanner(window=0.2, threshold=0)
+        rh = types.SimpleNamespace(id=1)
+        waves.add(rh, "first", lambda: None)
+        waves.add(rh, "second", lambda: 1 / 0)
+        waves.plan()
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            future_map = waves.submit(lambda rh, func, *args: pool.submit(func))
+            futures = {context: future for future, context in future_map.items()}
+            with pytest.raises(ZeroDivisionError):
+                futures["second"].result(timeout=5)
+
+
+class TestScheduleRetry:
+    def test_backoff_doubles(self, job):
+        retry_queue = {}
+        assert job.schedule_retry(retry_queue, 1, "on", 1000)
+        assert retry_queue[1]["next_attempt"] == 1000 + job.RETRY_BASE_DELAY
+        assert job.schedule_retry(retry_queue, 1, "on", 1100)
+        assert retry_queue[1]["next_attempt"] == 1100 + 2 * job.RETRY_BASE_DELAY
+        assert retry_queue[1]["attempts"] == 2
+        assert retry_queue[1]["first_failure"] == 1000
+
+    def test_gives_up_after_retry_window(self, job):
+        retry_queue = {}
+        now = 0
+        while job.schedule_retry(retry_queue, 1, "off", now):
+            now = retry_queue[1]["next_attempt"]
+        assert 1 not in retry_queue
+        assert now <= job.RETRY_WINDOW
+
+    def test_new_power_change_resets_entry(self, job):
+        retry_queue = {}
+        job.schedule_retry(retry_queue, 1, "on", 0)
+        job.schedule_retry(retry_queue, 1, "on", 60)
+        job.schedule_retry(retry_queue, 1, "off", 200)
+        assert retry_queue[1] == {
+            "on_off": "off",
+            "attempts": 1,
+            "first_failure": 200,
+            "next_attempt": 200 + job.RETRY_BASE_DELAY,
+        }
+
+
+class TestWriteRunMetrics:
+    @pytest.fixture
+    def metrics_file(self, job, tmp_path):
+        job.METRICS_FILE = str(tmp_path / "metrics.jsonl")
+        job.GlobalPreferences = mock.Mock(
+            **{"objects.get.return_value.rate_time_unit": "DAY"}
+        )
+        return tmp_path / "metrics.jsonl"
+
+    def make_server(self, rh_id, rate):
+        return types.SimpleNamespace(
+            resource_handler_id=rh_id, resource_handler=f"handler {rh_id}", rate=rate
+        )
+
+    def test_metrics_per_handler(self, job, metrics_file):
+        limit = job.AdaptiveLimit("handler 1", 4)
+        limit.latencies = [1.0, 3.0, 2.0]
+        pools = types.SimpleNamespace(limits={1: limit})
+        outcomes = [
+            (self.make_server(1, "48"), "off", "succeeded"),
+            (self.make_server(1, "24"), "on", "succeeded"),
+            (self.make_server(1, "24"), "off", "failed"),
+            (self.make_server(2, "12"), "off", "succeeded"),
+            (self.make_server(2, None), "off", "skipped"),
+        ]
+
+        job.write_run_metrics("Auto-power control servers", outcomes, pools)
+
+        records = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+        assert [record["handler"] for record in records] == [
+            "handler 1",
+            "handler 2",
+            "total",
+        ]
+        assert {record["job"] for record in records} == {"Auto-power control servers"}
+        assert len({record["timestamp"] for record in records}) == 1
+        first, second, total = [
+            {
+                key: value
+                for key, value in record.items()
+                if key not in ["handler", "job", "timestamp"]
+            }
+            for record in records
+        ]
+        assert first == {
+            "targeted": 3,
+            "succeeded": 2,
+            "failed": 1,
+            "skipped": 0,
+            "timed_out": 0,
+            "hourly_savings": 2.0,
+            "latency_p50": 2.0,
+            "latency_p95": 2.0,
+        }
+        assert second == {
+            "targeted": 2,
+            "succeeded": 1,
+            "failed": 0,
+            "skipped": 1,
+            "timed_out": 0,
+            "hourly_savings": 0.5,
+            "latency_p50": None,
+            "latency_p95": None,
+        }
+        assert total == {
+            "targeted": 5,
+            "succeeded": 3,
+            "failed": 1,
+            "skipped": 1,
+            "timed_out": 0,
+            "hourly_savings": 2.5,
+            "latency_p50": 2.0,
+            "latency_p95": 2.0,
+        }
+        job.set_progress.assert_called_with(
+            "Estimated hourly savings from the servers powered off: 2.50"
+        )
+
+    def test_metrics_appended(self, job, metrics_file):
+        pools = types.SimpleNamespace(limits={})
+        outcomes = [(self.make_server(1, None), "on", "succeeded")]
+
+        job.write_run_metrics("Auto-power control resources", outcomes, pools)
+        job.write_run_metrics("Auto-power control resources", outcomes, pools)
+
+        assert len(metrics_file.read_text().splitlines()) == 4
+
+    def test_unwritable_metrics_file(self, job, tmp_path):
+        job.METRICS_FILE = str(tmp_path / "missing" / "metrics.jsonl")
+        job.parent_thread_logger = mock.Mock()
+        pools = types.SimpleNamespace(limits={})
+
+        job.write_run_metrics("Auto-power control servers", [], pools)
+
+        job.parent_thread_logger.warning.assert_called_once()
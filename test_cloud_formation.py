@@ -0,0 +1,1162 @@
+"""
+Focused tests for the CloudFormation XUI helpers. The CloudBolt, Django and
+boto3 modules the XUI imports are replaced with stubs while it is loaded, so
+these run without a CloudBolt install.
+"""
+import importlib.util
+import json
+import os
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+XUI_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "cloudbolt",
+    "ui-extension-packages",
+    "cloud_formation",
+)
+
+
+class ClientError(Exception):
+    pass
+
+
+class CloudBoltException(Exception):
+    pass
+
+
+class Environment(object):
+    pass
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self.values[key] = value
+
+
+def stub_module(name, **attrs):
+    # Attributes not passed in are MagicMocks
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    module.__getattr__ = lambda attr: mock.MagicMock(name=f"{name}.{attr}")
+    return module
+
+
+def load_module(path, name, stubs):
+    """
+    Load the module at path with the stub modules in sys.modules, as a dict of
+    module name -> attributes. Parent packages are stubbed as well.
+    """
+    modules = {}
+    for module_name, attrs in stubs.items():
+        parts = module_name.split(".")
+        for i in range(1, len(parts)):
+            parent = ".".join(parts[:i])
+            modules.setdefault(parent, stub_module(parent))
+        modules[module_name] = stub_module(module_name, **attrs)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.dict(sys.modules, modules):
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def shared():
+    return load_module(
+        os.path.join(XUI_DIR, "shared.py"),
+        "cft_shared",
+        {
+            "requests": {},
+            "requests.adapters": {},
+            "urllib3.util.retry": {},
+            "botocore.exceptions": {"ClientError": ClientError},
+            "django.apps": {},
+            "django.conf": {"settings": types.SimpleNamespace()},
+            "django.core.cache": {"cache": FakeCache()},
+            "django.core.exceptions": {},
+            "django.db": {},
+            "django.db.models": {},
+            "django.db.models.signals": {},
+            "django.template": {},
+            "accounts.models": {},
+            "behavior_mapping.models": {},
+            "cbhooks.models": {},
+            "common.methods": {},
+            "infrastructure.models": {"Environment": Environment},
+            "orders.models": {},
+            "resourcehandlers.models": {},
+            "resources.models": {},
+            "servicecatalog.models": {},
+            "tags.models": {},
+            "utilities.events": {},
+            "utilities.exceptions": {"CloudBoltException": CloudBoltException},
+            "utilities.logger": {},
+            "utilities.models": {},
+        },
+    )
+
+
+class TestAnalyzeTemplate:
+    def test_indexes_parameter_references(self, shared):
+        content = {
+            "Parameters": {
+                "Env": {"Type": "String"},
+                "Size": {"Type": "String"},
+                "Unused": {"Type": "String"},
+            },
+            "Resources": {
+                "Instance": {
+                    "Type": "AWS::EC2::Instance",
+                    "Properties": {
+                        "InstanceType": {"Ref": "Size"},
+                        "Tags": [{"Key": "Name", "Value": {"Fn::Sub": "${Env}-a"}}],
+                    },
+                },
+                "Bucket": {
+                    "Type": "AWS::S3::Bucket",
+                    "Properties": {
+                        "BucketName": {
+                            "Fn::Sub": ["${Env}-${Name}", {"Name": "logs"}]
+                        }
+                    },
+                },
+            },
+        }
+        analysis = shared.analyze_template(content)
+
+        assert analysis["resource_types"] == {
+            "AWS::EC2::Instance": ["Instance"],
+            "AWS::S3::Bucket": ["Bucket"],
+        }
+        assert analysis["param_refs"]["Size"] == [
+            {
+                "resource": "Instance",
+                "resource_type": "AWS::EC2::Instance",
+                "property": "InstanceType",
+                "function": "Ref",
+            }
+        ]
+        assert [ref["property"] for ref in analysis["param_refs"]["Env"]] == [
+            "Tags.0.Value",
+            "BucketName",
+        ]
+        assert "Unused" not in analysis["param_refs"]
+        assert "Name" not in analysis["param_refs"]
+        assert len(analysis["intrinsics"]["Fn::Sub"]) == 2
+
+    def test_template_without_resources(self, shared):
+        analysis = shared.analyze_template({"Parameters": {}})
+        assert analysis["param_refs"] == {}
+        assert analysis["resource_types"] == {}
+
+
+class TestCheckAwsParam:
+    def get_result(self, shared, template_params, properties):
+        content = {
+            "Parameters": template_params,
+            "Resources": {
+                "Instance": {"Type": "AWS::EC2::Instance", "Properties": properties}
+            },
+        }
+        analysis = shared.analyze_template(content)
+        return shared.check_aws_param("Param", template_params, analysis)
+
+    def test_aws_specific_type(self, shared):
+        result = self.get_result(
+            shared, {"Param": {"Type": "AWS::EC2::KeyPair::KeyName"}}, {}
+        )
+        assert result == (True, "AWS::EC2::KeyPair::KeyName")
+
+    def test_instance_type_referenced_by_an_instance(self, shared):
+        result = self.get_result(
+            shared,
+            {"Param": {"Type": "String"}},
+            {"InstanceType": {"Ref": "Param"}},
+        )
+        assert result == (True, "InstanceType")
+
+    def test_other_parameter(self, shared):
+        result = self.get_result(
+            shared,
+            {"Param": {"Type": "String"}},
+            {"ImageId": {"Ref": "Param"}},
+        )
+        assert result == (False, "String")
+
+
+YAML_TEMPLATE = """
+AWSTemplateFormatVersion: 2010-09-09
+Parameters:
+  Subnet:
+    Type: AWS::EC2::Subnet::Id
+Resources:
+  Instance:
+    Type: AWS::EC2::Instance
+    Properties:
+      SubnetId: !Ref Subnet
+      Tags:
+        - Key: Name
+          Value: !Sub "${AWS::StackName}-instance"
+      AvailabilityZone: !GetAtt Subnet.AvailabilityZone
+      UserData: !Base64
+        Fn::Join: ["", ["a", "b"]]
+"""
+
+
+@pytest.mark.skipif(yaml is None, reason="PyYAML is not installed")
+class TestTemplateParsing:
+    def test_yaml_short_form_tags_load_as_long_form(self, shared):
+        content = shared.get_template_content(YAML_TEMPLATE)
+        properties = content["Resources"]["Instance"]["Properties"]
+        assert content["AWSTemplateFormatVersion"] == "2010-09-09"
+        assert properties["SubnetId"] == {"Ref": "Subnet"}
+        assert properties["Tags"][0]["Value"] == {
+            "Fn::Sub": "${AWS::StackName}-instance"
+        }
+        assert properties["AvailabilityZone"] == {
+            "Fn::GetAtt": ["Subnet", "AvailabilityZone"]
+        }
+        assert properties["UserData"] == {
+            "Fn::Base64": {"Fn::Join": ["", ["a", "b"]]}
+        }
+
+    def test_json_template_is_parsed(self, shared):
+        content = shared.get_template_content('{"Resources": {}}')
+        assert content == {"Resources": {}}
+
+    def test_invalid_template_raises(self, shared):
+        with pytest.raises(yaml.YAMLError):
+            shared.get_template_content("Resources: [")
+
+    def test_parsed_template_is_cached(self, shared):
+        content = shared.get_template_content(YAML_TEMPLATE)
+        assert shared.get_template_content(YAML_TEMPLATE) is content
+
+
+class FakeQuerySet(list):
+    def filter(self, **kwargs):
+        return self
+
+
+class FakeNetwork(object):
+    def __init__(self, network_id, name, groups):
+        self.id = network_id
+        self.name = name
+        self.network = f"subnet-{network_id}"
+        self.groups = groups
+
+    def get_groups(self):
+        return self.groups
+
+
+class TestSubnetOptions:
+    @pytest.fixture
+    def options_action(self):
+        return load_module(
+            os.path.join(
+                XUI_DIR, "actions", "generate_options_for_aws_specific_params.py"
+            ),
+            "cft_aws_param_options",
+            {
+                "django.core.cache": {"cache": FakeCache()},
+                "accounts.models": {},
+                "common.methods": {},
+                "infrastructure.models": {},
+                "resourcehandlers.aws.models": {},
+                "servicecatalog.models": {},
+                "utilities.logger": {},
+                "xui.cloud_formation.shared": {},
+            },
+        )
+
+    def get_options(self, options_action, networks, group, allowed_values=()):
+        subnets = FakeQuerySet(
+            types.SimpleNamespace(id=network.id, availability_zone="us-east-1a")
+            for network in networks
+        )
+        options_action.AWSVPCSubnet = types.SimpleNamespace(
+            objects=types.SimpleNamespace(filter=lambda **kwargs: subnets)
+        )
+        environment = types.SimpleNamespace(
+            networks=lambda: {network: None for network in networks}
+        )
+        return options_action.get_subnet_options(
+            environment, group, list(allowed_values)
+        )
+
+    def test_networks_filtered_by_get_groups(self, options_action):
+        networks = [
+            FakeNetwork(1, "shared", []),
+            FakeNetwork(2, "ours-us-east-1a", ["ours"]),
+            FakeNetwork(3, "theirs", ["theirs"]),
+        ]
+        assert self.get_options(options_action, networks, "ours") == [
+            ("subnet-1", "shared-us-east-1a"),
+            ("subnet-2", "ours-us-east-1a"),
+        ]
+
+    def test_networks_filtered_by_allowed_values(self, options_action):
+        networks = [FakeNetwork(1, "one", []), FakeNetwork(2, "two", [])]
+        options = self.get_options(options_action, networks, "ours", ["subnet-2"])
+        assert options == [("subnet-2", "two-us-east-1a")]
+
+    def test_no_permitted_networks(self, options_action):
+        networks = [FakeNetwork(1, "theirs", ["theirs"])]
+        options = self.get_options(options_action, networks, "ours")
+        assert options == [("", "--- No valid options found on Environment ---")]
+
+
+class FakeManager(object):
+    def __init__(self):
+        self.created = []
+
+    def get_or_create(self, defaults=None, **kwargs):
+        for obj in self.created:
+            if all(getattr(obj, key) == value for key, value in kwargs.items()):
+                return obj, False
+        obj = types.SimpleNamespace(**kwargs, **(defaults or {}))
+        self.created.append(obj)
+        return obj, True
+
+
+class TestAddUpdateAction:
+    @pytest.fixture(autouse=True)
+    def models(self, shared):
+        shared.HookInput = types.SimpleNamespace(objects=FakeManager())
+        shared.ResourceAction = types.SimpleNamespace(objects=FakeManager())
+        self.hook = types.SimpleNamespace(input_fields=mock.Mock())
+        shared.create_cloudbolt_hook = lambda name, source_file: self.hook
+
+    def make_blueprint(self, resource_type):
+        return types.SimpleNamespace(
+            resource_type=resource_type, management_actions=mock.Mock()
+        )
+
+    def test_action_added_to_blueprint(self, shared):
+        blueprint = self.make_blueprint("stack")
+        action = shared.add_update_action(blueprint)
+        blueprint.management_actions.add.assert_called_once_with(action)
+        assert action.resource_type == "stack"
+        self.hook.input_fields.add.assert_called_once()
+
+    def test_action_per_resource_type(self, shared):
+        stack_action = shared.add_update_action(self.make_blueprint("stack"))
+        vpc_action = shared.add_update_action(self.make_blueprint("vpc"))
+        assert vpc_action is not stack_action
+        assert vpc_action.resource_type == "vpc"
+        assert shared.add_update_action(self.make_blueprint("stack")) is stack_action
+
+
+class FakeChangeSetClient(object):
+    def __init__(self, change_set_statuses, stack_statuses=("UPDATE_COMPLETE",)):
+        self.change_set_statuses = list(change_set_statuses)
+        self.stack_statuses = list(stack_statuses)
+        self.calls = []
+
+    def create_change_set(self, **kwargs):
+        self.calls.append(("create_change_set", kwargs))
+        return {"Id": "change-set-id"}
+
+    def describe_change_set(self, ChangeSetName):
+        status, reason = self.change_set_statuses.pop(0)
+        return {
+            "Status": status,
+            "StatusReason": reason,
+            "StackId": "stack-id",
+            "ChangeSetName": "cloudbolt-update",
+            "ChangeSetId": ChangeSetName,
+        }
+
+    def delete_change_set(self, ChangeSetName):
+        self.calls.append(("delete_change_set", ChangeSetName))
+
+    def execute_change_set(self, ChangeSetName):
+        self.calls.append(("execute_change_set", ChangeSetName))
+
+    def describe_stacks(self, StackName):
+        return {"Stacks": [{"StackStatus": self.stack_statuses.pop(0)}]}
+
+    def describe_stack_events(self, StackName):
+        return {
+            "StackEvents": [
+                {"ResourceStatus": "UPDATE_FAILED", "ResourceStatusReason": "Bad"}
+            ]
+        }
+
+
+class TestChangeSetUpdate:
+    @pytest.fixture(autouse=True)
+    def no_sleep(self, shared):
+        shared.time = mock.Mock(**{"time.return_value": 1000})
+
+    def create(self, shared, client):
+        resource = types.SimpleNamespace(cft_capabilities=None)
+        return shared.create_stack_change_set(
+            "stack-id", "{}", [{"ParameterKey": "Size"}], resource, client
+        )
+
+    def test_change_set_created_from_parameters(self, shared):
+        client = FakeChangeSetClient(
+            [("CREATE_IN_PROGRESS", ""), ("CREATE_COMPLETE", "")]
+        )
+        change_set = self.create(shared, client)
+        assert change_set["Status"] == "CREATE_COMPLETE"
+        assert client.calls == [
+            (
+                "create_change_set",
+                {
+                    "StackName": "stack-id",
+                    "ChangeSetName": "cloudbolt-update-1000",
+                    "ChangeSetType": "UPDATE",
+                    "Parameters": [{"ParameterKey": "Size"}],
+                    "Capabilities": [],
+                    "TemplateBody": "{}",
+                },
+            )
+        ]
+
+    def test_change_set_without_changes_is_deleted(self, shared):
+        client = FakeChangeSetClient(
+            [("FAILED", "The submitted information didn't contain changes.")]
+        )
+        assert self.create(shared, client) is None
+        assert client.calls[-1] == ("delete_change_set", "change-set-id")
+
+    def test_failed_change_set_raises(self, shared):
+        client = FakeChangeSetClient([("FAILED", "Template format error")])
+        with pytest.raises(Exception, match="Template format error"):
+            self.create(shared, client)
+
+    def test_change_set_diff(self, shared):
+        change_set = {
+            "Changes": [
+                {
+                    "ResourceChange": {
+                        "Action": "Modify",
+                        "LogicalResourceId": "Instance",
+                        "ResourceType": "AWS::EC2::Instance",
+                        "Replacement": "True",
+                        "Details": [
+                            {"Target": {"Attribute": "Properties", "Name": "ImageId"}},
+                            {"Target": {"Attribute": "Properties", "Name": "ImageId"}},
+                            {"Target": {"Attribute": "Tags"}},
+                        ],
+                    }
+                },
+                {
+                    "ResourceChange": {
+                        "Action": "Add",
+                        "LogicalResourceId": "Bucket",
+                        "ResourceType": "AWS::S3::Bucket",
+                    }
+                },
+            ]
+        }
+        assert shared.get_change_set_diff(change_set) == [
+            "Modify Instance (AWS::EC2::Instance), Replacement: True, "
+            "Changed: ImageId, Tags",
+            "Add Bucket (AWS::S3::Bucket)",
+        ]
+
+    def test_execute_change_set(self, shared):
+        client = FakeChangeSetClient(
+            [("CREATE_COMPLETE", "")],
+            ["UPDATE_IN_PROGRESS", "UPDATE_COMPLETE"],
+        )
+        change_set = client.describe_change_set("change-set-id")
+        stack = shared.execute_stack_change_set(client, change_set)
+        assert stack == {"StackStatus": "UPDATE_COMPLETE"}
+        assert ("execute_change_set", "change-set-id") in client.calls
+
+    def test_failed_update_raises_events(self, shared):
+        client = FakeChangeSetClient([], ["UPDATE_ROLLBACK_COMPLETE"])
+        with pytest.raises(Exception, match="Error 1: Bad"):
+            shared.wait_for_stack_update(client, "stack-id")
+
+
+@pytest.fixture
+def teardown_cft():
+    module = load_module(
+        os.path.join(XUI_DIR, "actions", "teardown_cft.py"),
+        "cft_teardown",
+        {
+            "botocore.exceptions": {"ClientError": ClientError},
+            "resourcehandlers.aws.models": {},
+            "common.methods": {},
+            "utilities.logger": {},
+            "infrastructure.models": {},
+        },
+    )
+    module.time = mock.Mock()
+    return module
+
+
+class FakeCloudFormationClient(object):
+    """
+    Deletes stacks immediately, or fails to for the stack names in fail_delete
+    """
+
+    def __init__(self, outputs=None, imports=None, fail_delete=()):
+        self.outputs = outputs or {}
+        self.imports = imports or {}
+        self.fail_delete = fail_delete
+        self.statuses = {}
+
+    def describe_stacks(self, StackName):
+        name = StackName.split("/")[1]
+        return {
+            "Stacks": [
+                {
+                    "StackName": name,
+                    "StackStatus": self.statuses.get(StackName, "CREATE_COMPLETE"),
+                    "Outputs": [
+                        {"ExportName": export}
+                        for export in self.outputs.get(name, [])
+                    ],
+                }
+            ]
+        }
+
+    def get_paginator(self, operation):
+        assert operation == "list_imports"
+        paginator = mock.Mock()
+        paginator.paginate = lambda ExportName: [
+            {"Imports": self.imports.get(ExportName, [])}
+        ]
+        return paginator
+
+    def delete_stack(self, StackName):
+        if StackName.split("/")[1] in self.fail_delete:
+            raise ClientError("Access denied")
+        self.statuses[StackName] = "DELETE_COMPLETE"
+
+
+def stack_id(name):
+    return f"arn:aws:cloudformation:us-east-1:123456789012:stack/{name}/1"
+
+
+class TestDeleteCftStacks:
+    def test_partial_failure(self, teardown_cft):
+        client = FakeCloudFormationClient(fail_delete=["b"])
+        stacks = {
+            stack_id(name): {"resource": None, "client": client}
+            for name in ["a", "b", "c"]
+        }
+
+        failed = teardown_cft.delete_cft_stacks(stacks)
+
+        assert list(failed) == [stack_id("b")]
+        assert "Access denied" in failed[stack_id("b")]
+        assert client.statuses == {
+            stack_id("a"): "DELETE_COMPLETE",
+            stack_id("c"): "DELETE_COMPLETE",
+        }
+
+    def test_exporting_stack_kept_when_importer_fails(self, teardown_cft):
+        client = FakeCloudFormationClient(
+            outputs={"network": ["vpc-id"]},
+            imports={"vpc-id": ["app"]},
+            fail_delete=["app"],
+        )
+        stacks = {
+            stack_id(name): {"resource": None, "client": client}
+            for name in ["network", "app"]
+        }
+
+        failed = teardown_cft.delete_cft_stacks(stacks)
+
+        assert set(failed) == {stack_id("network"), stack_id("app")}
+        assert client.statuses == {}
+
+    def test_importing_stack_deleted_first(self, teardown_cft):
+        client = FakeCloudFormationClient(
+            outputs={"network": ["vpc-id"]}, imports={"vpc-id": ["app"]}
+        )
+        deleted = []
+        delete_stack = client.delete_stack
+
+        def record_delete(StackName):
+            deleted.append(StackName)
+            delete_stack(StackName)
+
+        client.delete_stack = record_delete
+        stacks = {
+            stack_id(name): {"resource": None, "client": client}
+            for name in ["network", "app"]
+        }
+
+        assert teardown_cft.delete_cft_stacks(stacks) == {}
+        assert deleted == [stack_id("app"), stack_id("network")]
+
+
+class FakeRows(list):
+    def order_by(self, field):
+        return FakeRows(sorted(self, key=lambda row: getattr(row, field)))
+
+    def values_list(self, *fields, flat=False):
+        if flat:
+            return [getattr(row, fields[0]) for row in self]
+        return [tuple(getattr(row, field) for field in fields) for row in self]
+
+
+class FakeCustomField(object):
+    def __init__(self, field_id, name):
+        self.id = field_id
+        self.name = name
+
+
+class FakeCustomFieldValue(object):
+    rows = []
+    bulk_creates = 0
+
+    def __init__(self, field, str_value):
+        self.field = field
+        self.field_id = field.id
+        self.str_value = str_value
+
+
+class FakeCustomFieldValueManager(object):
+    def filter(self, field__in, str_value__in):
+        return FakeRows(
+            row
+            for row in FakeCustomFieldValue.rows
+            if row.field_id in field__in and row.str_value in str_value__in
+        )
+
+    def bulk_create(self, cfvs):
+        FakeCustomFieldValue.bulk_creates += 1
+        for cfv in cfvs:
+            cfv.id = len(FakeCustomFieldValue.rows) + 1
+            FakeCustomFieldValue.rows.append(cfv)
+
+
+FakeCustomFieldValue.objects = FakeCustomFieldValueManager()
+
+
+class FakeAttributes(object):
+    def __init__(self):
+        self.ids = set()
+
+    def filter(self, field__in):
+        field_ids = {cf.id for cf in field__in}
+        return FakeRows(
+            row
+            for row in FakeCustomFieldValue.rows
+            if row.id in self.ids and row.field_id in field_ids
+        )
+
+    def add(self, *ids):
+        self.ids.update(ids)
+
+    def remove(self, *ids):
+        self.ids.difference_update(ids)
+
+
+class TestWriteOutputsToResource:
+    @pytest.fixture(autouse=True)
+    def models(self, shared):
+        FakeCustomFieldValue.rows = []
+        FakeCustomFieldValue.bulk_creates = 0
+        self.fields = {}
+        shared.CustomFieldValue = FakeCustomFieldValue
+        shared.CustomField = types.SimpleNamespace(
+            objects=types.SimpleNamespace(
+                filter=lambda name__in: [
+                    cf for name, cf in self.fields.items() if name in name__in
+                ]
+            )
+        )
+        shared.get_cft_namespace = mock.Mock()
+
+        def create_cf(name, label, description, **kwargs):
+            cf = FakeCustomField(len(self.fields) + 1, name)
+            self.fields[name] = cf
+            return cf, True
+
+        shared.create_cf = mock.Mock(side_effect=create_cf)
+        self.resource = types.SimpleNamespace(attributes=FakeAttributes())
+
+    def get_values(self):
+        return {
+            row.field.name: row.str_value
+            for row in FakeCustomFieldValue.rows
+            if row.id in self.resource.attributes.ids
+        }
+
+    def write(self, shared, outputs):
+        shared.write_outputs_to_resource(
+            self.resource, {"Outputs": outputs}, "cft_1_"
+        )
+
+    def test_new_outputs(self, shared):
+        self.write(
+            shared,
+            [
+                {"OutputKey": "Url", "OutputValue": "http://a"},
+                {"OutputKey": "Ip", "OutputValue": "10.0.0.1"},
+            ],
+        )
+        assert self.get_values() == {
+            "cft_1_output_Url": "http://a",
+            "cft_1_output_Ip": "10.0.0.1",
+        }
+        assert FakeCustomFieldValue.bulk_creates == 1
+        shared.get_cft_namespace.assert_called_once()
+
+    def test_changed_output_replaces_value(self, shared):
+        self.write(shared, [{"OutputKey": "Url", "OutputValue": "http://a"}])
+        self.write(shared, [{"OutputKey": "Url", "OutputValue": "http://b"}])
+        assert self.get_values() == {"cft_1_output_Url": "http://b"}
+        assert shared.create_cf.call_count == 1
+
+    def test_existing_value_reused(self, shared):
+        self.write(shared, [{"OutputKey": "Url", "OutputValue": "http://a"}])
+        self.resource.attributes.ids.clear()
+        self.write(shared, [{"OutputKey": "Url", "OutputValue": "http://a"}])
+        assert self.get_values() == {"cft_1_output_Url": "http://a"}
+        assert FakeCustomFieldValue.bulk_creates == 1
+        assert len(FakeCustomFieldValue.rows) == 1
+
+    def test_no_outputs(self, shared):
+        shared.write_outputs_to_resource(self.resource, {}, "cft_1_")
+        assert self.resource.attributes.ids == set()
+
+
+DISCOVERY_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "cloudbolt",
+    "recurring-jobs",
+    "discover_cloudformation_stacks",
+    "Hook for Discover CloudFormation Stacks",
+    "Sub File for Hook of Discover CloudFormation Stacks Script.py",
+)
+
+
+class TestDiscoverStacks:
+    @pytest.fixture
+    def discovery(self):
+        module = load_module(
+            DISCOVERY_SCRIPT,
+            "discover_cloudformation_stacks",
+            {
+                "django.template.defaultfilters": {},
+                "django.db.models": {},
+                "common.methods": {},
+                "infrastructure.models": {},
+                "orders.models": {},
+                "resourcehandlers.aws.models": {},
+                "resources.models": {},
+            },
+        )
+        module.time = mock.Mock(**{"time.return_value": 0})
+        return module
+
+    def stack(self, name, region="us-east-1", **kwargs):
+        return dict(
+            kwargs,
+            StackId=f"arn:aws:cloudformation:{region}:123456789012:stack/{name}/1",
+            StackName=name,
+            StackStatus="CREATE_COMPLETE",
+        )
+
+    def test_compare_inventory(self, discovery):
+        managed = self.stack("managed")
+        drifted = self.stack("drifted")
+        orphan = self.stack("orphan")
+        nested = self.stack("nested", ParentId=managed["StackId"])
+        gone = self.stack("gone")
+        stacks = {
+            stack["StackId"]: stack for stack in [managed, drifted, orphan, nested]
+        }
+        resources = {
+            managed["StackId"]: "managed resource",
+            drifted["StackId"]: "drifted resource",
+            gone["StackId"]: "gone resource",
+        }
+
+        result = discovery.compare_inventory(
+            stacks, resources, {}, {drifted["StackId"]: "DRIFTED"}, []
+        )
+
+        assert result == ([managed, drifted], [drifted], [orphan], [gone["StackId"]])
+
+    def test_missing_stacks_in_failed_regions_not_reported(self, discovery):
+        rh = types.SimpleNamespace(id=1)
+        east = self.stack("east")
+        west = self.stack("west", region="us-west-2")
+        other_handler = self.stack("other")
+        unknown_handler = self.stack("unknown")
+        resources = {
+            stack["StackId"]: stack["StackName"]
+            for stack in [east, west, other_handler, unknown_handler]
+        }
+        handler_ids = {
+            east["StackId"]: 1,
+            west["StackId"]: 1,
+            other_handler["StackId"]: 2,
+        }
+
+        _, _, _, missing = discovery.compare_inventory(
+            {}, resources, handler_ids, {}, [(rh, "us-east-1")]
+        )
+
+        assert missing == [west["StackId"], other_handler["StackId"]]
+
+    def test_detect_region_drift(self, discovery):
+        client = mock.Mock()
+        client.detect_stack_drift.side_effect = [
+            {"StackDriftDetectionId": "d1"},
+            Exception("Stack is not in a valid state"),
+            {"StackDriftDetectionId": "d3"},
+        ]
+        client.describe_stack_drift_detection_status.side_effect = [
+            {"DetectionStatus": "DETECTION_COMPLETE", "StackDriftStatus": "DRIFTED"},
+            {"DetectionStatus": "DETECTION_IN_PROGRESS"},
+            {"DetectionStatus": "DETECTION_COMPLETE", "StackDriftStatus": "IN_SYNC"},
+        ]
+
+        drift_statuses = discovery.detect_region_drift(client, ["s1", "s2", "s3"])
+
+        assert drift_statuses == {"s1": "DRIFTED", "s2": "UNKNOWN", "s3": "IN_SYNC"}
+
+    def test_drift_detection_timeout(self, discovery):
+        client = mock.Mock()
+        client.detect_stack_drift.return_value = {"StackDriftDetectionId": "d1"}
+        discovery.time.time.side_effect = [0, discovery.DRIFT_DETECTION_TIMEOUT]
+
+        assert discovery.detect_region_drift(client, ["s1"]) == {"s1": "UNKNOWN"}
+
+
+class FakeCfvs(object):
+    def __init__(self, cfv):
+        self.cfv = cfv
+
+    def first(self):
+        return self.cfv
+
+
+def make_resource(values, blueprint_values=None):
+    def get_cfv(values, name):
+        if name not in values:
+            return None
+        return types.SimpleNamespace(value=values[name])
+
+    blueprint = None
+    if blueprint_values is not None:
+        blueprint = types.SimpleNamespace(
+            get_cfvs_for_custom_field=lambda name: FakeCfvs(
+                get_cfv(blueprint_values, name)
+            )
+        )
+    return types.SimpleNamespace(
+        get_cfv_for_custom_field=lambda name: get_cfv(values, name),
+        blueprint=blueprint,
+    )
+
+
+class TestGetResourceTemplate:
+    @pytest.fixture(autouse=True)
+    def template_store(self, shared):
+        store = {"resource-hash": "resource cft", "blueprint-hash": "blueprint cft"}
+        shared.get_stored_template = store.get
+
+    def test_stored_resource_template(self, shared):
+        resource = make_resource(
+            {
+                "cft_template_hash": "resource-hash",
+                "cloud_formation_template": "legacy cft",
+            }
+        )
+        assert shared.get_resource_template(resource) == "resource cft"
+
+    def test_falls_back_to_legacy_resource_template(self, shared):
+        resource = make_resource(
+            {
+                "cft_template_hash": "missing-hash",
+                "cloud_formation_template": "legacy cft",
+            },
+            {"cft_template_hash": "blueprint-hash"},
+        )
+        assert shared.get_resource_template(resource) == "legacy cft"
+
+    def test_falls_back_to_blueprint_template(self, shared):
+        resource = make_resource(
+            {},
+            {
+                "cft_template_hash": "blueprint-hash",
+                "cloud_formation_template": "legacy blueprint cft",
+            },
+        )
+        assert shared.get_resource_template(resource) == "blueprint cft"
+
+    def test_falls_back_to_legacy_blueprint_template(self, shared):
+        resource = make_resource(
+            {"cft_template_hash": ""},
+            {"cloud_formation_template": "legacy blueprint cft"},
+        )
+        assert shared.get_resource_template(resource) == "legacy blueprint cft"
+
+    def test_no_template(self, shared):
+        with pytest.raises(CloudBoltException):
+            shared.get_resource_template(make_resource({}, {}))
+
+
+class TestFetchTemplates:
+    TEMPLATES = {
+        "https://raw.example.com/main.json": json.dumps(
+            {
+                "Resources": {
+                    "Network": {
+                        "Type": "AWS::CloudFormation::Stack",
+                        "Properties": {"TemplateURL": "network.json"},
+                    },
+                    "Shared": {
+                        "Type": "AWS::CloudFormation::Stack",
+                        "Properties": {
+                            "TemplateURL": "https://bucket.s3.amazonaws.com/x.json"
+                        },
+                    },
+                }
+            }
+        ),
+        "https://raw.example.com/network.json": json.dumps(
+            {
+                "Resources": {
+                    "Subnets": {
+                        "Type": "AWS::CloudFormation::Stack",
+                        "Properties": {"TemplateURL": "subnets.json"},
+                    }
+                }
+            }
+        ),
+        "https://raw.example.com/subnets.json": json.dumps({"Resources": {}}),
+    }
+
+    @pytest.fixture
+    def fetched(self, shared):
+        fetched = []
+
+        def fetch(conn_info, url):
+            fetched.append(url)
+            return self.TEMPLATES.get(url)
+
+        shared.TEMPLATE_FETCHERS = dict(shared.TEMPLATE_FETCHERS, public=fetch)
+        return fetched
+
+    def test_fetchers_dispatched_by_conn_info_type(self, shared):
+        conn_info = object()
+        shared.ConnectionInfo = mock.Mock(
+            **{"objects.get.return_value": conn_info}
+        )
+        shared.get_conn_info_type = mock.Mock(return_value="gitlab")
+
+        assert shared.get_template_fetcher("3") == (
+            conn_info,
+            shared.get_template_from_gitlab,
+        )
+        assert shared.get_template_fetcher(0) == (
+            None,
+            shared.get_template_from_public,
+        )
+
+    def test_unsupported_conn_info_type(self, shared):
+        shared.ConnectionInfo = mock.Mock()
+        shared.get_conn_info_type = mock.Mock(return_value="bitbucket")
+
+        with pytest.raises(CloudBoltException):
+            shared.get_template_fetcher(3)
+
+    def test_get_cft_from_source(self, shared, fetched):
+        url = "https://raw.example.com/subnets.json"
+        assert shared.get_cft_from_source(0, url) == self.TEMPLATES[url]
+        with pytest.raises(Exception):
+            shared.get_cft_from_source(0, "https://raw.example.com/missing.json")
+
+    def test_nested_templates_fetched(self, shared, fetched):
+        root = "https://raw.example.com/main.json"
+
+        assert shared.get_cfts_from_source(0, root) == self.TEMPLATES
+        assert sorted(fetched) == sorted(self.TEMPLATES)
+
+    def test_root_template_not_fetched_again(self, shared, fetched):
+        root = "https://raw.example.com/main.json"
+
+        cfts = shared.get_cfts_from_source(0, root, cft=self.TEMPLATES[root])
+
+        assert cfts == self.TEMPLATES
+        assert root not in fetched
+
+    def test_missing_nested_template(self, shared):
+        shared.TEMPLATE_FETCHERS["public"] = lambda conn_info, url: (
+            self.TEMPLATES["https://raw.example.com/main.json"]
+            if url.endswith("main.json")
+            else None
+        )
+
+        with pytest.raises(Exception, match="network.json"):
+            shared.get_cfts_from_source(0, "https://raw.example.com/main.json")
+
+    def test_http_sessions_pooled_per_host(self, shared):
+        shared.requests = mock.Mock(Session=mock.Mock(side_effect=mock.Mock))
+
+        session = shared.get_http_session("https://github.com/a/b")
+
+        assert shared.get_http_session("https://github.com/c/d") is session
+        assert shared.get_http_session("https://gitlab.com/a/b") is not session
+
+    def test_http_get_timeout(self, shared):
+        shared.requests = mock.Mock(Session=mock.Mock(side_effect=mock.Mock))
+        url = "https://github.com/a/b"
+
+        shared.http_get(url, headers={})
+        shared.http_get(url, timeout=5)
+
+        session = shared.get_http_session(url)
+        assert session.get.call_args_list == [
+            mock.call(url, headers={}, timeout=shared.SOURCE_CONTROL_TIMEOUT),
+            mock.call(url, timeout=5),
+        ]
+
+
+def nested_stack(template_url, **parameters):
+    return {
+        "Type": "AWS::CloudFormation::Stack",
+        "Properties": {"TemplateURL": template_url, "Parameters": parameters},
+    }
+
+
+class TestNestedTemplates:
+    ROOT = "https://raw.example.com/stacks/main.json"
+    CFTS = {
+        ROOT: json.dumps(
+            {
+                "Parameters": {"VpcId": {}, "Env": {}, "Unused": {}},
+                "Resources": {
+                    "Network": nested_stack(
+                        "network/main.json",
+                        VpcId={"Ref": "VpcId"},
+                        Name={"Fn::Sub": "${Env}-${AWS::Region}"},
+                        Count="2",
+                    ),
+                    "Staged": nested_stack("https://bucket.s3.amazonaws.com/x.json"),
+                },
+            }
+        ),
+        "https://raw.example.com/stacks/network/main.json": json.dumps(
+            {
+                "Parameters": {"VpcId": {}, "Name": {}},
+                "Resources": {
+                    "Subnets": nested_stack("subnets.json", Vpc={"Ref": "VpcId"})
+                },
+            }
+        ),
+        "https://raw.example.com/stacks/network/subnets.json": json.dumps(
+            {"Parameters": {"Vpc": {}}, "Resources": {}}
+        ),
+    }
+
+    @pytest.fixture
+    def staged(self, shared):
+        staged = {}
+
+        def get_template_args(cft, s3_client):
+            url = f"https://bucket.s3.amazonaws.com/{len(staged)}.template"
+            staged[url] = cft
+            return {"TemplateURL": url}
+
+        shared.get_template_args = get_template_args
+        return staged
+
+    def test_build_parameter_graph(self, shared):
+        network = "https://raw.example.com/stacks/network/main.json"
+        subnets = "https://raw.example.com/stacks/network/subnets.json"
+
+        assert shared.build_parameter_graph(self.CFTS) == {
+            (self.ROOT, "VpcId"): [(network, "VpcId")],
+            (self.ROOT, "Env"): [(network, "Name")],
+            (network, "VpcId"): [(subnets, "Vpc")],
+        }
+
+    def test_package_nested_templates(self, shared, staged):
+        packaged = json.loads(
+            shared.package_nested_templates(self.CFTS, self.ROOT, mock.Mock())
+        )
+
+        # The deepest template is staged first, its parent points at it
+        subnets_url, network_url = staged
+        network = json.loads(staged[network_url])
+        assert network["Resources"]["Subnets"]["Properties"]["TemplateURL"] == (
+            subnets_url
+        )
+        resources = packaged["Resources"]
+        assert resources["Network"]["Properties"]["TemplateURL"] == network_url
+        assert resources["Staged"]["Properties"]["TemplateURL"] == (
+            "https://bucket.s3.amazonaws.com/x.json"
+        )
+        # The cached parse of the template is left as is
+        root = shared.get_template_content(self.CFTS[self.ROOT])
+        assert root["Resources"]["Network"]["Properties"]["TemplateURL"] == (
+            "network/main.json"
+        )
+
+    def test_template_without_nested_stacks_not_packaged(self, shared, staged):
+        subnets = "https://raw.example.com/stacks/network/subnets.json"
+
+        cft = shared.package_nested_templates(self.CFTS, subnets, mock.Mock())
+
+        assert cft == self.CFTS[subnets]
+        assert staged == {}
+
+    def test_missing_nested_template(self, shared, staged):
+        cfts = {self.ROOT: self.CFTS[self.ROOT]}
+
+        with pytest.raises(CloudBoltException, match="network/main.json"):
+            shared.package_nested_templates(cfts, self.ROOT, mock.Mock())
+
+
+class TestSaveCftToResource:
+    @pytest.fixture(autouse=True)
+    def store(self, shared):
+        shared.store_template = lambda cft: f"hash of {cft}"
+        shared.create_template_hash_cf = mock.Mock()
+        shared.create_nested_templates_cf = mock.Mock()
+
+    def test_nested_templates_saved(self, shared):
+        resource = mock.Mock()
+
+        shared.save_cft_to_resource(resource, "cft", {"https://a/b.json": "nested"})
+
+        assert resource.set_value_for_custom_field.call_args_list == [
+            mock.call("cft_template_hash", "hash of cft"),
+            mock.call(
+                shared.NESTED_TEMPLATES_FIELD,
+                json.dumps({"https://a/b.json": "hash of nested"}),
+            ),
+        ]
+        shared.create_nested_templates_cf.assert_called_once_with()
+
+    @pytest.mark.parametrize("nested_cfts", [None, {}])
+    def test_no_nested_templates(self, shared, nested_cfts):
+        resource = mock.Mock()
+
+        shared.save_cft_to_resource(resource, "cft", nested_cfts)
+
+        resource.set_value_for_custom_field.assert_called_once_with(
+            "cft_template_hash", "hash of cft"
+        )
+        shared.create_nested_templates_cf.assert_not_called()